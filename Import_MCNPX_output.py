@@ -9,18 +9,17 @@ Spyder Editor
 Use this class to read in and process rmesh data output by mcnpx.
 """
 
+import concurrent.futures
 import numpy as np
 import os
-import re
-import math
-from matplotlib.mlab import griddata
-import matplotlib.pyplot as plt
+import warnings
 
 
 def Import_MCNPX_output(filename,
                         DOSE_FACTOR=1.0, 
                         MESH_NUM=1,
-                        VERBOSE=0):
+                        VERBOSE=0,
+                        mesh_geometry="auto"):
     """ 
     ;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
     ;+
@@ -44,8 +43,8 @@ def Import_MCNPX_output(filename,
     ;Created on 8-06-2010 by Justin Mikell
     ;;Added removal of extra white space 8-19-2010 JM
     ;;Added number of particles simulated to return struct 8-28-2010 JM
+    ;;Read every mesh with block numeric reads, MESH_NUM="all" 2016 JM
     ;TODO:  
-    ;       -add support for multiple meshes
     ;       -add support for 1D
     ;       -add support 2D
     ;       
@@ -97,8 +96,18 @@ def Import_MCNPX_output(filename,
     ; :Keywords:
     ;    DOSE_FACTOR
     ;    POS_VOLUME_OBJ
-    ;    MESH_NUM
+    ;    MESH_NUM: 1-based mesh to return (default 1), a list of meshes, or "all".
+    ;              A list or "all" returns a list of dictionaries. Meshes after the
+    ;              last requested one are not read. See also index_MCNPX_output and
+    ;              read_MCNPX_mesh to load meshes lazily.
     ;    VERBOSE
+    ;    mesh_geometry: "auto" (default), "rectilinear", "spherical" or "cylindrical",
+    ;              or a list with one of these per mesh. Spherical/cylindrical smesh files
+    ;              omit the implicit 0 of the polar angle bounds, so there is one more 
+    ;              row of values per z than the header says. "auto" detects this from the
+    ;              polar angle bounds and the number of rows in the file; "spherical" and
+    ;              "cylindrical" prepend the 0 whenever the first polar bound is not 0;
+    ;              "rectilinear" never does.
     ;
     ; :Examples:
     ;         Please put an example::
@@ -113,152 +122,328 @@ def Import_MCNPX_output(filename,
                 Ported to python by Justin Mikell on July 21, 2016
                 No POS_VOLUME_OBJ support yet.
     """ 
-    f = open(filename, 'r')      
-    data = f.read()
-    f.close()
-    mylines = data.splitlines()
-    n_lines = len(mylines)
+    if(MESH_NUM == "all"):
+        wanted = None
+    else:
+        wanted = np.atleast_1d(MESH_NUM).astype(int)
+    
     print("Importing data from :{0}".format(filename))
-    if(VERBOSE > 0):
-       print("first lines of file preceding data are...")
-       for i in np.arange(9):
-          print("{0}:{1}".format(i,mylines[i]))
-            
-    print("Removing extra whitespace..")
-    for i in np.arange(len(mylines)):
-        mylines[i] = " ".join(mylines[i].split())
-    if(VERBOSE > 0):
-       print("first lines after removing extra whitespace...")
-       for i in np.arange(9):
-          print("{0}:'{1}'".format(i,mylines[i]))
-  
-    #get the number of particles simulated
+    result = {}
+    with open(filename, 'rb') as f:
+        header = _read_MCNPX_header(f, VERBOSE, mesh_geometry)
+        total_meshes = len(header['mesh_dimensions'])
+        if(wanted is not None and np.any(wanted > total_meshes)):
+            print("Warning mesh_num: {0} not found. Setting mesh_num=1".format(MESH_NUM))
+            wanted = np.array([1]) #1=-based counting for mesh
+        
+        for i in np.arange(total_meshes):
+            parse = (wanted is None) or ((i+1) in wanted)
+            mesh = _read_MCNPX_mesh_block(f, header, i, parse, VERBOSE)
+            if(parse):
+                mesh['tally_xyz'] = mesh['tally_xyz']*DOSE_FACTOR
+                result[i+1] = mesh
+                if(wanted is not None and len(result) == len(wanted)):
+                    #the remaining meshes are not needed
+                    break
+    
+    if(wanted is None):
+        return([result[i] for i in sorted(result.keys())])
+    if(np.ndim(MESH_NUM) == 0):
+        return(result[wanted[0]])
+    return([result[i] for i in wanted])
+
+
+def index_MCNPX_output(filename, VERBOSE=0, mesh_geometry="auto"):
+    """Scans an MCNPX mesh tally output file once without parsing the tally values
+    and returns an index for read_MCNPX_mesh:
+    {'filename':filename, 'nps':nps, 'header':header, 'offsets':[byte offset of the bounds of each mesh]}
+    The scan only counts newlines, so it is much cheaper than importing the file.
+    Whether each mesh has an implicit polar angle 0 (see mesh_geometry in 
+    Import_MCNPX_output) is decided during the scan and stored in the index."""
+    offsets = []
+    implicit_zero = []
+    with open(filename, 'rb') as f:
+        header = _read_MCNPX_header(f, VERBOSE, mesh_geometry)
+        for i in np.arange(len(header['mesh_dimensions'])):
+            offsets.append(f.tell())
+            implicit_zero.append(_read_MCNPX_mesh_block(f, header, i, False, VERBOSE)['implicit_zero'])
+    header['implicit_zero'] = implicit_zero
+    return({'filename':filename, 'nps':header['nps'], 'header':header, 'offsets':offsets})
+
+
+def read_MCNPX_mesh(index, MESH_NUM=1, DOSE_FACTOR=1.0, VERBOSE=0):
+    """Reads a single mesh (1-based MESH_NUM) using an index from index_MCNPX_output.
+    Only the bytes of that mesh are read. Returns the same dictionary as Import_MCNPX_output."""
+    assert 1 <= MESH_NUM <= len(index['offsets']), "mesh_num: {0} not found".format(MESH_NUM)
+    with open(index['filename'], 'rb') as f:
+        f.seek(index['offsets'][MESH_NUM-1])
+        mesh = _read_MCNPX_mesh_block(f, index['header'], MESH_NUM-1, True, VERBOSE)
+    mesh['tally_xyz'] = mesh['tally_xyz']*DOSE_FACTOR
+    return(mesh)
+
+
+_mesh_geometries = ["auto", "rectilinear", "spherical", "cylindrical"]
+
+
+def _read_MCNPX_header(f, VERBOSE=0, mesh_geometry="auto"):
+    """Reads the header lines of an MCNPX mesh tally output file opened in binary mode
+    and leaves f at the bounds of the first mesh."""
+    #lines: comment, number_of_meshes nps, 4 lines per mesh, one more line
+    mylines = [f.readline().decode() for i in np.arange(2)]
     npsline = mylines[1].split()
     nps = np.double(npsline[1])
-    total_meshes = np.uint(npsline[0])
-    if (MESH_NUM > total_meshes):
-        print("Warning mesh_num: {0} not found. Setting mesh_num=1".format(MESH_NUM))
-        MESH_NUM=1 #1=-based counting for mesh
-    
+    total_meshes = int(npsline[0])
+    mylines += [f.readline().decode() for i in np.arange(4*total_meshes+1)]
     if(VERBOSE > 0):
+        print("first lines of file preceding data are...")
+        for i in np.arange(len(mylines)):
+            print("{0}:{1}".format(i,mylines[i].rstrip()))
         print("nps: {0}".format(nps))
         print("total_meshes: {0}".format(total_meshes))
     
     #read in all the mesh dimensions
-    mesh_dimensions_dict = {}
+    mesh_dimensions = []
+    bounds_counts = []
     for i in np.arange(total_meshes):           
-        boundsline = mylines[np.int(3+4*i)].split()
+        boundsline = mylines[3+4*i].split()
         if(VERBOSE > 0):
             print("reading bounds for mesh {0}".format(i))
             print("boundsline:{0}".format(boundsline))
-        nx = np.long(boundsline[2])-1
-        ny = np.long(boundsline[3])-1
-        nz = np.long(boundsline[4])-1
-        
         #this will help with 1D and 2D arrays
-        if (nx == 0):
-            nx = nx+1
-        if (ny == 0):
-            ny = ny+1
-        if (nz == 0):
-            nz = nz+1
-        
-        mesh_dimensions_dict[i] = [nx,ny,nz]
+        nx = max(int(boundsline[2])-1, 1)
+        ny = max(int(boundsline[3])-1, 1)
+        nz = max(int(boundsline[4])-1, 1)
+        mesh_dimensions.append([nx,ny,nz])
+        bounds_counts.append([int(boundsline[2]), int(boundsline[3]), int(boundsline[4])])
     
-    #Each mesh consists of 3+2*ny*nz lines
-    # 3 comes from xb,yb,zb
-    # 2*nx*ny comes from the dose values and their uncertainties
-    first_xb_line = 7+4*(total_meshes-1) #this is past all the "header" info
-    xb_line = np.long(first_xb_line)
-    print("xb_line:{0}".format(xb_line))
-    for i in np.arange(total_meshes-1):
-        xb_line = np.long(xb_line + 3 + 2*mesh_dimensions_dict[i][1]*mesh_dimensions_dict[i][2])
+    if(isinstance(mesh_geometry, str)):
+        mesh_geometry = [mesh_geometry]*total_meshes
+    assert len(mesh_geometry) == total_meshes, "need one mesh_geometry per mesh ({0})".format(total_meshes)
+    for g in mesh_geometry:
+        assert g in _mesh_geometries, "mesh_geometry must be one of {0}".format(_mesh_geometries)
+    return({'nps':nps, 'mesh_dimensions':mesh_dimensions, 'bounds_counts':bounds_counts,
+            'mesh_geometry':list(mesh_geometry)})
+
+
+def _read_MCNPX_mesh_block(f, header, i, parse, VERBOSE=0):
+    """Reads mesh i (0-based) starting at its bounds lines. Each mesh consists of
+    3 lines of bounds followed by ny*nz lines of tally values and ny*nz lines of
+    fractional uncertainty; each line holds the nx values of one (y,z) row. The 
+    tally and uncertainty blocks are parsed with one numeric read each and reshaped 
+    in Fortran order (x fastest, then y, then z).
+    If parse is False the values are skipped and only 'dims' and 'implicit_zero' are returned."""
+    nx, ny, nz = header['mesh_dimensions'][i]
+    xb = _parse_values(f.readline())
+    yb = _parse_values(f.readline())
+    zb = _parse_values(f.readline())
     
-    print("xb_line:{0}".format(xb_line))
-    #read in xbounds, ybounds, zbounds
-    xb = np.array(mylines[xb_line].split(), dtype=np.float)
-    yb = np.array(mylines[xb_line+1].split(), dtype=np.float)    
-    zb = np.array(mylines[xb_line+2].split(), dtype=np.float)
+    rows = _read_lines(f, 2*ny*nz, keep=parse)
     
-    #now set nx,ny,nz based on the mesh we have selected to read
-    nx = mesh_dimensions_dict[MESH_NUM-1][0]
-    ny = mesh_dimensions_dict[MESH_NUM-1][1]
-    nz = mesh_dimensions_dict[MESH_NUM-1][2]
+    #see if ny,nz agree with rest of file, unless an index already decided
+    if('implicit_zero' in header):
+        implicit_zero = header['implicit_zero'][i]
+    else:
+        implicit_zero = _implicit_polar_zero(f, header, i, yb)
+    if(implicit_zero):
+        if(VERBOSE > 0):
+            print("mesh {0} is spherical/cylindrical with an implicit 0 in polar angle".format(i+1))
+        yb = np.append(0, yb)
+        ny = ny + 1
+        rows = rows + _read_lines(f, 2*nz, keep=parse)
+    
+    if(not parse):
+        return({'dims':[nx,ny,nz], 'implicit_zero':implicit_zero})
     
-    #see if ny,nz agree with rest of file
-    if (np.longlong(2)*ny*nz) != (n_lines-10):
-        print("This may be a spherical/cylindrical mesh with an implicit 0.")
-        if(yb[ny] == 180):
-            print("This appears to be a spherical/cylindrical mesh file")
-        ans = 'NA'
-        while ( ans.upper() != 'Y' and ans.upper() != 'N'):
-            print("Treat as spherical/cylindrical with implicit 0 in polar angle? [y/n]")
-            ans = input('[y/n]')
-        if ans.upper() == 'Y':
-            yb = np.append(0, yb)
-            ny = ny + 1
+    print("reading in dose and uncertainty values for mesh {0}...".format(i+1))
+    vals = _parse_values(rows)
+    n = nx*ny*nz
+    if(len(vals) != 2*n):
+        raise ValueError("mesh {0}: number of imported elements ({1}) doesnt match expected ({2})".format(i+1, len(vals), 2*n))
+    tally_xyz = vals[0:n].reshape([nx,ny,nz], order='F')
+    unc_xyz = vals[n:].reshape([nx,ny,nz], order='F')
+    return({'tally_xyz':tally_xyz, 'unc_xyz':unc_xyz, 'xb':xb, 'yb':yb, 'zb':zb,
+            'nps':header['nps'], 'dims':[nx,ny,nz]})
+
+
+def _implicit_polar_zero(f, header, i, yb):
+    """Decides whether mesh i, whose ny*nz rows of values and uncertainties were just 
+    read, is a spherical/cylindrical mesh whose polar angle bounds yb omit an implicit 0.
+    Such a mesh has one more row of nx values per z than the header says.
     
-    #create the funcrz
-    print("reading in dose values now...")
-    tally_xyz = np.ndarray([nx,ny,nz], dtype=np.double)
-    for k in np.arange(nz):
-        for j in np.arange(ny):
-            temp = np.array(mylines[np.long(ny*k+j+(xb_line+3))].split(), dtype=np.double) #data starts 3 lines after xb
-            if(VERBOSE > 0):
-                print("Line number: {0}".format(np.long(ny*k+j+(xb_line+4))))
-                print("total elements on line: {0}".format(len(temp)))
-            
-            if(len(temp) != nx):
-                print("number of imported elements doesnt match expected!!!")
-                exit(1)
-            tally_xyz[:,j,k] = temp
+    "spherical"/"cylindrical" decide from the bounds alone (first bound above 0).
+    Otherwise the numbers of tokens on the following lines are compared with the two
+    possible layouts, 2*nz extra rows or not, each followed by the end of the file
+    or the three bounds lines of the next mesh; "auto" takes the layout that matches 
+    and uses the bounds (first above 0, last at most 180) when both match.
+    f is left where it was."""
+    nx, ny, nz = header['mesh_dimensions'][i]
+    mesh_geometry = header['mesh_geometry'][i]
+    if(mesh_geometry in ("spherical", "cylindrical")):
+        return(bool(yb[0] > 0))
     
-    #now read the uncertainty    
-    print("reading in uncertainty values...")
-    unc_xyz = np.ndarray([nx,ny,nz], dtype=np.double)
-    for k in np.arange(nz):
-        for j in np.arange(ny):
-            temp = np.array(mylines[np.long(ny*k+j+ny*nz+(xb_line+3))].split(), dtype=np.double)
-            if(VERBOSE > 0):
-                print("Line number: {0}".format(np.long(ny*k+j+ny*nz+(xb_line+4))))
-                print("total elements on line: {0}".format(len(temp)))
-            
-            if(len(temp) != nx):
-                print("number of imported elements doesnt match expected!!!")
-                exit(1)
-            unc_xyz[:,j,k] = temp
+    if(i+1 < len(header['mesh_dimensions'])):
+        after = header['bounds_counts'][i+1]
+    else:
+        after = [0]
+    pos = f.tell()
+    counts = [len(f.readline().split()) for j in np.arange(2*nz+len(after))]
+    f.seek(pos)
+    plain = counts[0:len(after)] == after
+    implicit = counts == [nx]*(2*nz) + after
     
-    tally_xyz = tally_xyz*DOSE_FACTOR
-    return({'tally_xyz':tally_xyz, 'unc_xyz':unc_xyz, 'xb':xb, 'yb':yb, 'zb':zb, 'nps':nps})
+    if(mesh_geometry == "rectilinear"):
+        assert plain, "mesh {0} does not match its header, it may be spherical/cylindrical (mesh_geometry)".format(i+1)
+        return(False)
+    assert plain or implicit, "mesh {0} does not match its header and is not a spherical/cylindrical mesh with an implicit 0".format(i+1)
+    if(plain and implicit):
+        return(bool(yb[0] > 0 and yb[-1] <= 180))
+    return(implicit)
+
+
+def _parse_values(text):
+    """Parses whitespace separated numbers, raising ValueError on anything else."""
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        try:
+            return(np.fromstring(text, dtype=np.double, sep=' '))
+        except DeprecationWarning as e:
+            raise ValueError(str(e))
+
+
+def _read_lines(f, n, keep=True, block_size=1<<22):
+    """Reads the next n lines of the binary file f in blocks of block_size bytes
+    and leaves f at the start of the following line. Returns the bytes read, or
+    b'' if keep is False."""
+    chunks = []
+    count = 0
+    while(count < n):
+        pos = f.tell()
+        block = f.read(block_size)
+        if(not block):
+            break
+        c = block.count(b'\n')
+        if(count + c < n):
+            count += c
+            if(keep):
+                chunks.append(block)
+            continue
+        #the n-th line ends inside this block
+        idx = np.flatnonzero(np.frombuffer(block, np.uint8) == 10)[n - count - 1]
+        f.seek(pos + idx + 1)
+        count = n
+        if(keep):
+            chunks.append(block[0:(idx+1)])
+    return(b''.join(chunks))
     
 def calc_centers_from_bounds(arr):
     return (0.5*arr[0:-1] + 0.5*arr[1:])
     
-def add_in_quadrature(fileList):
-    """ This adds the results and uncertainty in quadrature assuming equal weights.
-    fileList: a list of filenames containing mdata to add/average together"""
-    w = 1/len(fileList)    
-    o = Import_MCNPX_output(fileList[0])
-    doseArr = w*o['tally_xyz']
-    uncArr2 = np.power(w*o['tally_xyz']*o['unc_xyz'],2)
-    for i in np.arange(1,len(fileList)):
-        o=Import_MCNPX_output(fileList[i])
-        doseArr = doseArr+w*o['tally_xyz']
-        uncArr2 = uncArr2+np.power(w*o['tally_xyz']*o['unc_xyz'],2)
+def add_in_quadrature(fileList, weights="equal", workers=1, **kwargs):
+    """ This averages the results and adds the uncertainty in quadrature.
+    fileList: a list of filenames containing mdata to add/average together
+    weights: "equal" (every file has the same weight), "nps" (each file is weighted
+             by its number of particles simulated), or a sequence with one weight per file.
+    workers: number of processes used to import the files. Each process reduces 
+             a contiguous share of fileList and the partial sums are merged in order, 
+             so only O(workers) meshes are in memory regardless of the number of files.
+    kwargs: passed on to Import_MCNPX_output.
+    
+    The running weighted mean is updated one file at a time (Welford), which also 
+    gives the batch to batch spread of the tally:
+    unc_xyz is the fractional uncertainty from the per file uncertainties added in quadrature,
+    unc_batch_xyz is the fractional standard error of the mean estimated from the spread
+    between the files (nan for a single file).
+    nps is the number of particles simulated in the last file, as for a single file,
+    and nps_total the number simulated in all files."""
+    if(isinstance(weights, str)):
+        assert weights in ("equal", "nps"), "weights must be equal, nps or a sequence"
+        weight_list = [weights]*len(fileList)
+    else:
+        assert len(weights) == len(fileList), "need one weight per file"
+        weight_list = list(weights)
+    
+    if(workers <= 1 or len(fileList) < 2):
+        acc = _quadrature_partial(fileList, weight_list, kwargs)
+    else:
+        bounds = np.linspace(0, len(fileList), min(workers, len(fileList))+1).astype(int)
+        groups = [(fileList[bounds[i]:bounds[i+1]], weight_list[bounds[i]:bounds[i+1]], kwargs) for i in np.arange(len(bounds)-1)]
+        acc = None
+        with concurrent.futures.ProcessPoolExecutor(max_workers=len(groups)) as pool:
+            for part in pool.map(_quadrature_partial_args, groups):
+                acc = part if acc is None else _merge_quadrature_partials(acc, part)
+    
+    doseArr = acc['mean']
+    W = acc['W']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        unc = np.sqrt(acc['S'])/W/doseArr
+        #unbiased variance of the weighted mean for reliability weights
+        sum_w2 = acc['sum_w2']
+        var_mean = acc['M2']/(W - sum_w2/W)*sum_w2/(W*W)
+        unc_batch = np.sqrt(var_mean)/doseArr
     
     return({'tally_xyz':doseArr,
-            'unc_xyz':np.sqrt(uncArr2)/doseArr,
-            'xb':o['xb'],
-            'yb':o['yb'],
-            'zb':o['zb'],
-            'nps':o['nps']})
+            'unc_xyz':unc,
+            'unc_batch_xyz':unc_batch,
+            'xb':acc['xb'],
+            'yb':acc['yb'],
+            'zb':acc['zb'],
+            'nps':acc['nps'],
+            'nps_total':acc['nps_total']})
+
+def _quadrature_partial(fileList, weight_list, kwargs):
+    """Imports the files one at a time and accumulates
+    W = sum(w), sum_w2 = sum(w^2), mean = weighted mean of the tally,
+    M2 = sum(w*(x - mean)^2) and S = sum((w*x*unc)^2)."""
+    acc = None
+    for i in np.arange(len(fileList)):
+        o = Import_MCNPX_output(fileList[i], **kwargs)
+        w = weight_list[i]
+        if(w == "equal"):
+            w = 1.
+        elif(w == "nps"):
+            w = o['nps']
+        w = float(w)
+        x = o['tally_xyz']
+        if(acc is None):
+            acc = {'W':w, 'sum_w2':w*w, 'mean':x.copy(), 'M2':np.zeros_like(x),
+                   'S':np.power(w*x*o['unc_xyz'],2), 'nps':o['nps'], 'nps_total':o['nps'],
+                   'xb':o['xb'], 'yb':o['yb'], 'zb':o['zb']}
+            continue
+        assert x.shape == acc['mean'].shape, "{0} does not have the same mesh as the other files".format(fileList[i])
+        acc['W'] += w
+        acc['sum_w2'] += w*w
+        delta = x - acc['mean']
+        acc['mean'] += (w/acc['W'])*delta
+        acc['M2'] += w*delta*(x - acc['mean'])
+        acc['S'] += np.power(w*x*o['unc_xyz'],2)
+        acc['nps'] = o['nps']
+        acc['nps_total'] += o['nps']
+    return(acc)
+
+def _quadrature_partial_args(args):
+    return(_quadrature_partial(*args))
+
+def _merge_quadrature_partials(a, b):
+    """Combines two partial sums from _quadrature_partial (Chan et al parallel update)."""
+    assert a['mean'].shape == b['mean'].shape, "the files do not all have the same mesh"
+    W = a['W'] + b['W']
+    delta = b['mean'] - a['mean']
+    a['M2'] += b['M2'] + delta*delta*(a['W']*b['W']/W)
+    a['mean'] += (b['W']/W)*delta
+    a['S'] += b['S']
+    a['sum_w2'] += b['sum_w2']
+    a['nps'] = b['nps']
+    a['nps_total'] += b['nps_total']
+    a['W'] = W
+    return(a)
     
 
 def geometry_r_theta(r,theta,L=0.35):
     """This calculates the geometry function according to TG43. 
-    r: radius in cm
-    theta: angle in degrees
+    r: radius in cm (scalar or array)
+    theta: angle in degrees (scalar or array, broadcast against r)
     L: active source length in cm
+    Points on the source axis (theta of 0 or 180) use 1/(r^2-L^2/4).
     
     @Reference:
         Perez-Calatayud et al "Dose Calculation for Photon-Emitting Brachytherapy Sources with Average
@@ -267,13 +452,98 @@ def geometry_r_theta(r,theta,L=0.35):
         2012
         
     """
-    if (theta == 0):
-        return(1/(r*r-L/2*L/2))
-    else:    
-        thetaR = math.radians(theta)
-        beta1 = np.arccos( (r*math.cos(thetaR) - L/2)/math.sqrt(r*r+L/2*L/2-L*r*math.cos(thetaR)))
-        beta2 = np.arccos( (r*math.cos(thetaR) + L/2)/math.sqrt(r*r+L/2*L/2+L*r*math.cos(thetaR)))
-        return((beta1-beta2)/(L*r*math.sin(thetaR)))
+    r, theta = np.broadcast_arrays(np.asarray(r, dtype=np.double), np.asarray(theta, dtype=np.double))
+    thetaR = np.radians(theta)
+    cos_t = np.cos(thetaR)
+    sin_t = np.sin(thetaR)
+    on_axis = (theta == 0) | (theta == 180)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        beta1 = np.arccos( (r*cos_t - L/2)/np.sqrt(r*r+L/2*L/2-L*r*cos_t))
+        beta2 = np.arccos( (r*cos_t + L/2)/np.sqrt(r*r+L/2*L/2+L*r*cos_t))
+        G = np.where(on_axis, 1/(r*r-L/2*L/2), (beta1-beta2)/(L*r*sin_t))
+    if(G.ndim == 0):
+        return(float(G))
+    return(G)
+
+def _find_bin_indices(centers, values, tol, name):
+    """Returns the index of the one bin center within +-tol of each value 
+    (strict inequalities, tol may be a scalar or one per value) using searchsorted. 
+    centers must be increasing."""
+    values = np.atleast_1d(np.asarray(values, dtype=np.double))
+    tol = np.broadcast_to(np.asarray(tol, dtype=np.double), values.shape)
+    lo = np.searchsorted(centers, values - tol, side='right')
+    hi = np.searchsorted(centers, values + tol, side='left')
+    count = hi - lo
+    assert np.all(count != 0), "did not find {0}index for {1}, check your values and smesh_tally...".format(name, values[count == 0])
+    assert np.all(count == 1), "found more than 1 {0}index for {1}, try decreasing the tolerance...".format(name, values[count > 1])
+    return(lo)
+
+def F_r_theta_table(smesh_tally, rlist, thetalist, drlist=0.001, dthetalist=0.001, L=0.35, zindex=0):
+    """ calculate the F(r,theta) table given a smesh tally from MC.
+    smesh_tally: the output from Import_MCNPX_output (or load_tally_store)
+    rlist: radii in cm, where you want to evaluate F(r,theta)
+    thetalist: angles in degrees where you want to evaluate F(r,theta)
+    drlist: tolerance (scalar or one per radius) for matching a radius to a bin center in cm
+    dthetalist: tolerance (scalar or one per angle) for matching an angle to a bin center in degrees
+    L: length (cm) of the active source
+    zindex: the index of the third mesh dimension to use
+    
+    All radii and angles are matched to bins in one searchsorted pass and only 
+    the needed tally values are read.
+    Returns {'F': (len(rlist), len(thetalist)) table,
+             'unc': fractional uncertainty of F, from the uncertainties of D(r,theta) 
+                    and D(r,90) added in quadrature (0 at 90 degrees),
+             'r': the bin centers found for rlist, 'theta': the bin centers found for thetalist}
+    """
+    rc = calc_centers_from_bounds(np.asarray(smesh_tally['xb']))
+    thetac = calc_centers_from_bounds(np.asarray(smesh_tally['yb']))
+    ri = _find_bin_indices(rc, rlist, drlist, "r")
+    ti = _find_bin_indices(thetac, thetalist, dthetalist, "theta")
+    t90 = _find_bin_indices(thetac, 90, dthetalist if np.ndim(dthetalist) == 0 else np.min(dthetalist), "90")[0]
+    
+    doseArr = smesh_tally['tally_xyz']
+    uncArr = smesh_tally['unc_xyz']
+    D_rtheta = np.asarray(doseArr[ri[:,None], ti[None,:], zindex])
+    D_r90 = np.asarray(doseArr[ri, t90, zindex])[:,None]
+    u_rtheta = np.asarray(uncArr[ri[:,None], ti[None,:], zindex])
+    u_r90 = np.asarray(uncArr[ri, t90, zindex])[:,None]
+    
+    G_r90 = geometry_r_theta(rc[ri], thetac[t90], L=L)[:,None]
+    G_rtheta = geometry_r_theta(rc[ri][:,None], thetac[ti][None,:], L=L)
+    
+    F = D_rtheta/D_r90*G_r90/G_rtheta
+    unc = np.where(ti[None,:] == t90, 0., np.sqrt(u_rtheta*u_rtheta + u_r90*u_r90))
+    return({'F':F, 'unc':unc, 'r':rc[ri], 'theta':thetac[ti]})
+
+def g_r_table(smesh_tally, rlist, drlist=0.001, L=0.35, dtheta=0.001, dr0=0.001, zindex=0):
+    """calculate the g_L(r) table given a smesh tally from MC.
+    smesh_tally: the output from Import_MCNPX_output (or load_tally_store)
+    rlist: the radii in cm, where you want to evaluate g_L(r)
+    drlist: tolerance (scalar or one per radius) for matching a radius to a bin center in cm
+    L: active length of source in cm
+    dtheta: tolerance for finding the 90 degree bin
+    dr0: tolerance for finding the 1 cm bin
+    Returns {'g': g_L(r), 'unc': fractional uncertainty of g_L(r) from the uncertainties 
+             of D(r,90) and D(1,90) added in quadrature (0 at 1 cm), 'r': the bin centers found}
+    """
+    rc = calc_centers_from_bounds(np.asarray(smesh_tally['xb']))
+    thetac = calc_centers_from_bounds(np.asarray(smesh_tally['yb']))
+    ri = _find_bin_indices(rc, rlist, drlist, "r")
+    r0 = _find_bin_indices(rc, 1, dr0, "r0")[0]
+    t90 = _find_bin_indices(thetac, 90, dtheta, "90")[0]
+    
+    doseArr = smesh_tally['tally_xyz']
+    uncArr = smesh_tally['unc_xyz']
+    D_r90 = np.asarray(doseArr[ri, t90, zindex])
+    u_r90 = np.asarray(uncArr[ri, t90, zindex])
+    D_r090 = doseArr[r0, t90, zindex]
+    u_r090 = uncArr[r0, t90, zindex]
+    G_r090 = geometry_r_theta(rc[r0], thetac[t90], L=L)
+    G_r90 = geometry_r_theta(rc[ri], thetac[t90], L=L)
+    
+    g = D_r90/D_r090*G_r090/G_r90
+    unc = np.where(ri == r0, 0., np.sqrt(u_r90*u_r90 + u_r090*u_r090))
+    return({'g':g, 'unc':unc, 'r':rc[ri]})
 
 def F_r_theta(smesh_tally, r, theta, L=0.35, dr=0.001, dtheta=0.001):
     """ calculate F(r,theta) given a smesh tally from MC.
@@ -285,69 +555,22 @@ def F_r_theta(smesh_tally, r, theta, L=0.35, dr=0.001, dtheta=0.001):
         This is used to identify index in smesh_tally
     dtheta: tolerance for checking for theta equivalence in cm
         This is used to identify index in smesh_tally
+    Use F_r_theta_table for more than a few points.
     """
-    rc = calc_centers_from_bounds(smesh_tally['xb'])
-    thetac = calc_centers_from_bounds(smesh_tally['yb'])
-    doseArr = smesh_tally['tally_xyz']
-    
-    #find r index
-    rindex = (rc < (r+dr)) & (rc > (r-dr))    
-    thetaindex = (thetac < (theta+dtheta)) & (thetac > (theta-dtheta))    
-    theta90index = (thetac < (90+dtheta)) & (thetac > (90-dtheta))
-    assert sum(rindex) != 0, "did not find rindex, check your r value and smesh_tally..."    
-    assert sum(rindex) == 1, "found more than 1 rindex, try decreasing dr..."
-    assert sum(thetaindex) != 0, "did not find thetaindex, check your theta value and smesh_tally..."    
-    assert sum(thetaindex) == 1, "found more than 1 thetaindex, try decreasing dtheta..."
-    assert sum(theta90index) != 0, "did not find 90index, check your theta value and smesh_tally..."    
-    assert sum(theta90index) == 1, "found more than 1 90index, try decreasing dtheta..."
-    
+    res = F_r_theta_table(smesh_tally, [r], [theta], drlist=dr, dthetalist=dtheta, L=L)
     print("Asked for F({0},{1})".format(r,theta))    
-    print("Found F({0},{1})".format(rc[rindex],thetac[thetaindex]))
-    D_rtheta = doseArr[rindex,thetaindex,0]
-    D_r90 = doseArr[rindex, theta90index, 0]
-    G_r90 = geometry_r_theta(rc[rindex], thetac[theta90index], L=L)
-    G_rtheta = geometry_r_theta(rc[rindex], thetac[thetaindex], L=L)
-    
-    return(D_rtheta/D_r90*G_r90/G_rtheta)
+    print("Found F({0},{1})".format(res['r'],res['theta']))
+    return(res['F'][0,0])
 
 def g_r(smesh_tally, r, L=0.35, dr=0.001, dtheta=0.001, dr0=0.001):
     """calculate g_L(r)
     smesh_tally: the tally_xyz output from Import_MCNPX_output
     r: the radius in cm, where you want to evaluate the g_L(r)
     L: active length of source in cm
+    Use g_r_table for more than a few radii.
     """
-    rc = calc_centers_from_bounds(smesh_tally['xb'])    
-    thetac = calc_centers_from_bounds(smesh_tally['yb'])
-    doseArr = smesh_tally['tally_xyz']
-    
-    #find r index
-    rindex = (rc < (r+dr)) & (rc > (r-dr))        
-    assert sum(rindex) != 0, "did not find rindex, check your r value and smesh_tally..."    
-    assert sum(rindex) == 1, "found more than 1 rindex, try decreasing dr..."
-    
-    #find r0 index
-    r0index = (rc < (1+dr0)) & (rc > (1-dr0))        
-    assert sum(r0index) != 0, "did not find rindex, check your r0 value and smesh_tally..."    
-    assert sum(r0index) == 1, "found more than 1 r0index, try decreasing dr..."
-
-    #find theta0 index    
-    theta90index = (thetac < (90+dtheta)) & (thetac > (90-dtheta))
-    assert sum(theta90index) != 0, "did not find 90index, check your theta value and smesh_tally..."    
-    assert sum(theta90index) == 1, "found more than 1 90index, try decreasing dtheta..."
-    
-    D_rtheta0 = doseArr[rindex, theta90index,0]
-    D_r0theta0 = doseArr[r0index, theta90index,0]
-    G_r090 = geometry_r_theta(rc[r0index],thetac[theta90index], L=L)  
-    G_r90 = geometry_r_theta(rc[rindex],thetac[theta90index], L=L)  
-    return(D_rtheta0/D_r0theta0*G_r090/G_r90)
+    return(g_r_table(smesh_tally, [r], drlist=dr, L=L, dtheta=dtheta, dr0=dr0)['g'][0])
 
 def list_F_r_theta(smesh_tally, rlist, thetalist, drlist, dthetalist):
     """ This just prints out a table of F(r,theta) defined by the list for you"""
-    res = np.ndarray([len(rlist), len(thetalist)], dtype=np.double)    
-    for i in np.arange(len(rlist)):
-        for j in np.arange(len(thetalist)):
-            res[i,j] = F_r_theta(smesh_tally, rlist[i], thetalist[j], dr=drlist[i], dtheta=dthetalist[j])
-            
-    return(res)
-    
-    
\ No newline at end of file
+    return(F_r_theta_table(smesh_tally, rlist, thetalist, drlist=drlist, dthetalist=dthetalist)['F'])
@@ -27,9 +27,128 @@ Created on Fri Aug 26 10:36:16 2016
 import numpy as np
 import os
 import re
-from matplotlib.mlab import griddata
 import matplotlib.pyplot as plt
-from scipy import interpolate
+from jkcm_decay import HALF_LIFE_H, eff_time_h, wall_time_from_eff_time_h
+
+def read_keyed_text(filename, comment_char="#"):
+    """
+    Single pass reader for the text format of the source data, g(r), F(r,theta)
+    and seed position files.
+    
+    Everything following comment_char is ignored, as are empty lines.
+    A line of the form "key: values" starts a field. The values on that line and
+    on all following lines up to the next "key:" line belong to that field
+    (e.g. "table:" followed by the rows of F(r,theta)).
+    Lines before the first field are returned as rows of tokens 
+    (e.g. the g(r) table and the seed position files).
+    
+    Returns (rows, fields) where rows is a list of lists of tokens and fields 
+    is a dictionary from key to the list of its tokens. Convert tokens with
+    np.array(tokens, dtype=np.double).
+    """
+    rows = []
+    fields = {}
+    tokens = None
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.split(comment_char, 1)[0]
+            head, sep, tail = line.partition(":")
+            key = head.strip()
+            if(sep and key.isidentifier()):
+                tokens = fields.setdefault(key, [])
+                tokens.extend(tail.split())
+                continue
+            words = line.split()
+            if(len(words) == 0):
+                continue
+            if(tokens is None):
+                rows.append(words)
+            else:
+                tokens.extend(words)
+    return(rows, fields)
+
+
+class jkcm_gr_interp:
+    """Pointwise interpolation of a 1D g(r) table.
+    
+    Radii outside the table use nearest neighbor extrapolation (TG43-U1 Appendix C).
+    kind is either "linear" or "loglinear"; the latter interpolates log(g(r)) linearly in r.
+    """
+    def __init__(self, radii, values, kind="linear"):
+        assert kind in ("linear", "loglinear"), "kind must be linear or loglinear"
+        self.radii = np.ascontiguousarray(radii, dtype=np.double)
+        self.values = np.ascontiguousarray(values, dtype=np.double)
+        assert np.all(np.diff(self.radii) > 0), "g(r) radii must be increasing"
+        self.kind = kind
+        if(kind == "loglinear"):
+            assert np.all(self.values > 0), "loglinear interpolation requires g(r) > 0"
+            self._fp = np.log(self.values)
+        else:
+            self._fp = self.values
+    
+    def __call__(self, r):
+        #np.interp clamps to the end values which is nearest neighbor extrapolation
+        result = np.interp(r, self.radii, self._fp)
+        if(self.kind == "loglinear"):
+            result = np.exp(result, out=result) if np.ndim(result) else np.exp(result)
+        return(result)
+
+
+class jkcm_frtheta_interp:
+    """Pointwise bilinear interpolation of a 2D F(r,theta) table.
+    
+    table has one row per angle and one column per radius. Evaluating arrays
+    of r and theta returns F at each (r[i],theta[i]) pair, not on the outer product.
+    Points outside the table use nearest neighbor extrapolation (TG43-U1 Appendix C).
+    """
+    def __init__(self, radii, thetas, table):
+        self.radii = np.ascontiguousarray(radii, dtype=np.double)
+        self.thetas = np.ascontiguousarray(thetas, dtype=np.double)
+        table = np.asarray(table, dtype=np.double)
+        assert table.shape == (len(self.thetas), len(self.radii)), "table must be len(thetas) x len(radii)"
+        assert np.all(np.diff(self.radii) > 0), "F(r,theta) radii must be increasing"
+        assert np.all(np.diff(self.thetas) > 0), "F(r,theta) thetas must be increasing"
+        
+        #pad by one row and column so that cells at the upper edges need no special case
+        self._n_r = len(self.radii) + 1
+        padded = np.zeros([len(self.thetas)+1, self._n_r])
+        padded[:-1, :-1] = table
+        padded[:-1, -1] = table[:, -1]
+        padded[-1, :] = padded[-2, :]
+        self._table = padded.ravel()
+        #slope along r within each cell, so only one multiply-add is needed per row
+        self._slope_r = np.zeros_like(padded)
+        self._slope_r[:, :-1] = padded[:, 1:] - padded[:, :-1]
+        self._slope_r = self._slope_r.ravel()
+        
+        self._r_index = np.arange(len(self.radii), dtype=np.double)
+        self._th_index = np.arange(len(self.thetas), dtype=np.double)
+    
+    def __call__(self, r, theta):
+        #fractional cell indices, clamped to the table which gives nearest neighbor extrapolation
+        fr = np.interp(r, self.radii, self._r_index)
+        ft = np.interp(theta, self.thetas, self._th_index)
+        #nan r or theta (e.g. a point at a source center, where theta is undefined) gives nan
+        bad = ~(np.isfinite(fr) & np.isfinite(ft))
+        if(np.any(bad)):
+            fr = np.where(bad, 0., fr)
+            ft = np.where(bad, 0., ft)
+        i = np.floor(fr)
+        j = np.floor(ft)
+        fr -= i
+        ft -= j
+        
+        k = (j*self._n_r + i).astype(np.intp)
+        low = self._table[k] + self._slope_r[k]*fr
+        k += self._n_r
+        high = self._table[k] + self._slope_r[k]*fr
+        high -= low
+        high *= ft
+        high += low
+        if(np.any(bad)):
+            high = np.where(bad, np.nan, high)
+        return(high)
+
 
 class jkcm_TG43_calc:
     """Use this class to 1) import 2D TG43 data and then use it to perform 2D TG43 calculations
@@ -79,6 +198,16 @@ class jkcm_TG43_calc:
         self.g_r_table = None
         self.g_r_interp_table_obj = None
         
+        #optional precomputed r^2*doserate/(Sk) on a uniform (r,theta) lattice
+        self.dose_rate_kernel = None
+        self.dose_rate_kernel_r0_cm = None
+        self.dose_rate_kernel_dr_cm = None
+        self.dose_rate_kernel_dtheta_degree = None
+        self.dose_rate_kernel_max_rel_dev = None
+        self.use_dose_rate_kernel = False
+        
+        #solid angle averaged anisotropy at aniso_table_radii_cm, for the 1D approximation
+        self.phi_an = None
         
 
         #These values will be changed when performing an n-seed calculation
@@ -87,12 +216,7 @@ class jkcm_TG43_calc:
         self.source_bottom = np.zeros([3]) #physical bottom of source            
         
         #These are constants, and will likely eventually be moved out of here
-        self.half_life_h_dict = {}        
-        self.half_life_h_dict["I-125"] = 59.4*24.
-        self.half_life_h_dict["Y-90"] = 64.1
-        self.half_life_h_dict["Ir-192"] = 73.8*24.
-        self.half_life_h_dict["Cs-131"] = 9.7*24.
-        self.half_life_h_dict["Pd-103"] = 17*24.
+        self.half_life_h_dict = dict(HALF_LIFE_H)
         
     
     def __str__(self):
@@ -120,65 +244,46 @@ class jkcm_TG43_calc:
         
         return(s)
     
-    def calc_eff_time(self, time_in_hours, infinite=False):
+    def calc_eff_time(self, time_in_hours, infinite=False, radionuclide=None):
         """This returns the effective time in hours of the implant. 
         It does this by performing evaluating the analytic expression representing
-        a simple exponential integral"""
-        
-        half_life_h_dict = self.half_life_h_dict
-        
-        
-        assert self.radionuclide in half_life_h_dict.keys(), "{0} is not listed radionuclides!"
-        
-        hl_h = half_life_h_dict[self.radionuclide]
-        mu = np.log(2)/hl_h
-        if(infinite == True):
-            eff_t = 1/mu
-        else:
-            eff_t = -1/mu * (np.exp(-1*mu*time_in_hours) - 1)
-        
-        return(eff_t)
+        a simple exponential integral. time_in_hours may be an array, and
+        radionuclide (default that of the source) an array of names; see jkcm_decay."""
+        if(radionuclide is None):
+            radionuclide = self.radionuclide
+        return(eff_time_h(time_in_hours, radionuclide, infinite=infinite, table=self.half_life_h_dict))
 
-    def calc_wall_time_from_eff_time(self, eff_time_in_hours):
+    def calc_wall_time_from_eff_time(self, eff_time_in_hours, radionuclide=None):
         """Returns the real or physical wall time in hours required based on 
-        the effective time input in hours. """
-        half_life_h_dict = self.half_life_h_dict
-        assert self.radionuclide in half_life_h_dict.keys(), "{0} is not listed radionuclides!"
-        
-        hl_h = half_life_h_dict[self.radionuclide]
-        mu = np.log(2)/hl_h
-        physical_time_h = -1/mu * np.log(1-mu*eff_time_in_hours)
-        return(physical_time_h)
+        the effective time input in hours (nan if it can not be reached). """
+        if(radionuclide is None):
+            radionuclide = self.radionuclide
+        return(wall_time_from_eff_time_h(eff_time_in_hours, radionuclide, table=self.half_life_h_dict))
         
     
     def eval_g_r_table(self, r):
-        if(r < np.min(self.g_r_radii_cm)):
-            return(self.g_r_table[0])
-        elif( r > np.max(self.g_r_radii_cm)):
-            return(self.g_r_table[-1])
-        else:
-            return(self.g_r_interp_table_obj(r))
+        """Evaluates g(r) for a scalar or an array of radii in cm. Radii outside
+        the table use nearest neighbor extrapolation."""
+        return(self.g_r_interp_table_obj(r))
             
     def _build_g_r_interp_table(self, kind='linear'):
         assert type(self.g_r_table) != type(None), "please import the gr table first!"
         assert type(self.g_r_radii_cm) != type(None), "please import the gr table first!"
-        #I catch the bounds error and correct via nearest neighbor extrapolation
-        self.g_r_interp_table_obj = interpolate.interp1d(self.g_r_radii_cm, self.g_r_table, kind=kind, bounds_error=True)
+        self.g_r_interp_table_obj = jkcm_gr_interp(self.g_r_radii_cm, self.g_r_table, kind=kind)
         print("finished building interpolation object for g_r table evaluation!")
         
     def eval_frtheta(self,r,theta):
+        """Evaluates F(r,theta) pointwise for scalars or arrays of the same shape
+        of r (cm) and theta (degrees)."""
         return(self.aniso_interp_table_obj(r,theta))
 
-    def _build_frtheta_interp_table(self, kind="linear", bounds_error=False):
+    def _build_frtheta_interp_table(self, kind="linear"):
         assert type(self.aniso_table) != type(None), "please import the anisotropy table first!"
         assert type(self.aniso_table_radii_cm) != type(None), "please import the anisotropy table first!"
         assert type(self.aniso_table_thetas_degree) != type(None), "please import the anisotropy table first!"
+        assert kind == "linear", "only linear interpolation of F(r,theta) is supported"
     
-        r_arr = self.aniso_table_radii_cm
-        th_arr = self.aniso_table_thetas_degree        
-        
-        rr,tt = np.meshgrid(r_arr,th_arr)
-        self.aniso_interp_table_obj = interpolate.interp2d(r_arr, th_arr, self.aniso_table, kind=kind, bounds_error=bounds_error)
+        self.aniso_interp_table_obj = jkcm_frtheta_interp(self.aniso_table_radii_cm, self.aniso_table_thetas_degree, self.aniso_table)
         print("finished building interpolation object for anisotropy evaluation\n")
         
     def G_r_theta(self, r, theta, theta_epsilon=0.001):
@@ -211,6 +316,23 @@ class jkcm_TG43_calc:
         result = numerator/denominator
         return(result)
         
+    def G_r_theta_points(self, r, theta, theta_epsilon=0.001):
+        """Array version of G_r_theta. r (cm) and theta (degrees) are arrays of
+        the same shape. The angle subtended by the active source is evaluated
+        with arctan2 instead of the arccos difference."""
+        effL = self.eff_source_length_cm
+        assert effL != None, "please import source data parameters first!"
+        
+        angle = np.radians(theta)
+        along = r*np.cos(angle)
+        away = r*np.sin(angle)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            beta = np.arctan2(away, along - effL/2.) - np.arctan2(away, along + effL/2.)
+            result = beta/(effL*away)
+            on_axis = (theta <= theta_epsilon) | (np.abs(theta-180) <= theta_epsilon)
+            result = np.where(on_axis, 1./(r*r - effL*effL/4), result)
+        return(result)
+
 
     def _calc_to_point(self, pos, verbose=0):
         """perform a TG43 calculation
@@ -268,9 +390,238 @@ class jkcm_TG43_calc:
         
         Returns a an array of length n corresponding to the dose rate at each point 
         from the current source position and orientation.
+        
+        Like _calc_to_point this is the doserate/(Sk).
         """
+        arr = np.asarray(arr, dtype=np.double).reshape(-1, 3)
+        point_vec = arr - self.source_center
+        r = np.sqrt(np.einsum('ij,ij->i', point_vec, point_vec))
+        along = point_vec.dot(self._unitVectorOfSource())
+        return(self._calc_rate_from_r_along(r, along))
         
+    def calc_to_points_from_sources(self, centers, tips, arr):
+        """
+        This calculates the doserate/(Sk) from several sources of this model
+        to the points defined in arr without changing the current source position.
+        
+        centers: an Sx3 array of source centers.
+        tips: an Sx3 array of source tips. Only the direction from center to tip is used.
+        arr: an Mx3 array representing spatial coordinates for each point of interest.
+        
+        Returns an SxM array, where element [i,j] is the doserate/(Sk) at point j 
+        from source i.
+        """
+        centers = np.asarray(centers, dtype=np.double).reshape(-1, 3)
+        tips = np.asarray(tips, dtype=np.double).reshape(-1, 3)
+        arr = np.asarray(arr, dtype=np.double).reshape(-1, 3)
+        
+        axis = tips - centers
+        axis = axis/np.sqrt(np.einsum('ij,ij->i', axis, axis))[:, np.newaxis]
+        
+        r2 = np.zeros([len(centers), len(arr)])
+        along = np.zeros([len(centers), len(arr)])
+        for k in np.arange(3):
+            d = arr[np.newaxis, :, k] - centers[:, k, np.newaxis]
+            r2 += d*d
+            along += d*axis[:, k, np.newaxis]
+        return(self._calc_rate_from_r_along(np.sqrt(r2), along))
+        
+    def calc_to_pairs_from_sources(self, centers, tips, arr, src_index, pt_index):
+        """
+        Like calc_to_points_from_sources, but only for the source-point pairs
+        (centers[src_index[k]], arr[pt_index[k]]).
         
+        Returns an array of length len(src_index) of doserate/(Sk).
+        """
+        centers = np.asarray(centers, dtype=np.double).reshape(-1, 3)
+        tips = np.asarray(tips, dtype=np.double).reshape(-1, 3)
+        arr = np.asarray(arr, dtype=np.double).reshape(-1, 3)
+        
+        axis = tips - centers
+        axis = axis/np.sqrt(np.einsum('ij,ij->i', axis, axis))[:, np.newaxis]
+        
+        d = arr[pt_index] - centers[src_index]
+        r = np.sqrt(np.einsum('ij,ij->i', d, d))
+        along = np.einsum('ij,ij->i', d, axis[src_index])
+        return(self._calc_rate_from_r_along(r, along))
+        
+    def calc_point_source_rate(self, r):
+        """
+        1D (point source) approximation of doserate/(Sk) at radii r in cm, TG43-U1 eq. 11 
+        with the line source geometry function:
+        
+        doserate = (Sk)*(drc)*G(r,90)/G(1,90)*g(r)*phi_an(r)
+        
+        phi_an(r) is the solid angle weighted average of the 2D dose at r, derived
+        from the F(r,theta) table (see _build_phi_an_table).
+        """
+        if(type(self.phi_an) == type(None)):
+            self._build_phi_an_table()
+        r = np.asarray(r, dtype=np.double)
+        grtheta = self.G_r_theta_points(r, np.full(r.shape, 90.))
+        gr0theta0 = self.G_r_theta(1,90)
+        phi = np.interp(r, self.aniso_table_radii_cm, self.phi_an)
+        return(self.dose_rate_constant_cGy_per_h_per_U*(grtheta/gr0theta0)*self.eval_g_r_table(r)*phi)
+        
+    def _build_phi_an_table(self, dtheta_deg=0.5):
+        """Integrates the 2D dose over solid angle at each radius in the F(r,theta) table:
+        phi_an(r) = 1/2 * integral of F(r,theta)*G(r,theta)/G(r,90)*sin(theta) dtheta"""
+        assert type(self.aniso_table) != type(None), "please import the anisotropy table first!"
+        th = np.linspace(0, 180, int(round(180./dtheta_deg))+1)
+        rr, tt = np.meshgrid(self.aniso_table_radii_cm, th, indexing='ij')
+        integrand = self.eval_frtheta(rr, tt)*self.G_r_theta_points(rr, tt)/self.G_r_theta_points(rr, np.full(rr.shape, 90.))*np.sin(np.radians(tt))
+        #trapezoid rule in theta
+        w = np.full(len(th), np.radians(th[1] - th[0]))
+        w[0] *= 0.5
+        w[-1] *= 0.5
+        self.phi_an = 0.5*integrand.dot(w)
+        
+    def max_rate_beyond(self, r_cm, dr_cm=0.05, dtheta_deg=0.5):
+        """Returns the largest doserate/(Sk) at any distance >= r_cm from a source, 
+        found by evaluating a (r,theta) lattice from r_cm out to the largest tabulated
+        radius. Beyond the tables g(r) is held constant, so the dose rate only falls 
+        with the geometry function."""
+        r_end = max(r_cm, np.max(self.g_r_radii_cm), np.max(self.aniso_table_radii_cm))
+        r = np.append(np.arange(r_cm, r_end, dr_cm), r_end)
+        th = np.linspace(0, 180, int(round(180./dtheta_deg))+1)
+        rr, tt = np.meshgrid(r, th, indexing='ij')
+        return(np.max(self._calc_rate_exact(rr, tt)))
+        
+    def _calc_rate_from_r_along(self, r, along):
+        """doserate/(Sk) for arrays of distances r from the source center and 
+        projections along of the point vectors on the source axis (both in cm).
+        If use_dose_rate_kernel is set, points covered by the kernel are looked up
+        in it and only the remaining points use the exact calculation."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cos_theta = np.clip(along/r, -1., 1.)
+        
+        if(self.use_dose_rate_kernel and type(self.dose_rate_kernel) != type(None)):
+            r_max = self.dose_rate_kernel_r0_cm + self.dose_rate_kernel_dr_cm*(self.dose_rate_kernel.shape[0]-1)
+            inside = (r >= self.dose_rate_kernel_r0_cm) & (r <= r_max)
+            #fractional theta index of the kernel lattice straight from the angle in radians
+            scale = 180./(np.pi*self.dose_rate_kernel_dtheta_degree)
+            if(np.all(inside)):
+                ft = np.arccos(cos_theta)
+                ft *= scale
+                return(self._lookup_dose_rate_kernel(r, ft))
+            result = np.empty(np.shape(r))
+            result[inside] = self._lookup_dose_rate_kernel(r[inside], np.arccos(cos_theta[inside])*scale)
+            outside = ~inside
+            result[outside] = self._calc_rate_exact(r[outside], np.degrees(np.arccos(cos_theta[outside])))
+            return(result)
+        
+        return(self._calc_rate_exact(r, np.degrees(np.arccos(cos_theta))))
+        
+    def _calc_rate_exact(self, r, theta):
+        """doserate/(Sk) for arrays of r (cm) and theta (degrees) from the TG43 tables."""
+        grtheta = self.G_r_theta_points(r, theta)
+        gr0theta0 = self.G_r_theta(1,90)
+        frtheta = self.eval_frtheta(r, theta)
+        gr = self.eval_g_r_table(r)
+        drc = self.dose_rate_constant_cGy_per_h_per_U
+        
+        return(drc*(grtheta/gr0theta0)*gr*frtheta)
+        
+    
+    def build_dose_rate_kernel(self, dr_cm=0.01, dtheta_deg=0.25, r_min_cm=None, r_max_cm=None):
+        """
+        This precomputes r^2*doserate/(Sk) = r^2*drc*G(r,theta)/G(1,90)*g(r)*F(r,theta)
+        on a uniform (r,theta) lattice so that later evaluations are index arithmetic
+        plus bilinear interpolation. The r^2 factor removes the inverse square 
+        fall off so the tabulated quantity varies slowly with r.
+        
+        dr_cm: lattice spacing in radius (cm)
+        dtheta_deg: lattice spacing in theta (degrees)
+        r_min_cm: smallest tabulated radius, default is the effective source length.
+        r_max_cm: largest tabulated radius, default is the largest radius in the g(r) and F(r,theta) tables.
+        
+        Points closer than r_min_cm or farther than r_max_cm always use the exact calculation.
+        Set use_dose_rate_kernel to True to use the kernel in calc_to_points.
+        
+        Returns the maximum relative deviation between the kernel and the exact 
+        calculation, evaluated at the centers of the lattice cells.
+        """
+        assert type(self.aniso_table) != type(None), "please import the anisotropy table first!"
+        assert type(self.g_r_table) != type(None), "please import the gr table first!"
+        assert self.eff_source_length_cm != None, "please import source data parameters first!"
+        
+        if(r_min_cm == None):
+            r_min_cm = self.eff_source_length_cm
+        if(r_max_cm == None):
+            r_max_cm = max(np.max(self.g_r_radii_cm), np.max(self.aniso_table_radii_cm))
+        
+        n_r = int(np.ceil((r_max_cm - r_min_cm)/dr_cm)) + 1
+        #the theta spacing is adjusted so that 180 degrees is on the lattice
+        n_th = int(np.ceil(180./dtheta_deg)) + 1
+        dtheta_deg = 180./(n_th - 1)
+        r_arr = r_min_cm + dr_cm*np.arange(n_r)
+        th_arr = dtheta_deg*np.arange(n_th)
+        
+        rr, tt = np.meshgrid(r_arr, th_arr, indexing='ij')
+        self.dose_rate_kernel = rr*rr*self._calc_rate_exact(rr, tt)
+        self.dose_rate_kernel_r0_cm = r_min_cm
+        self.dose_rate_kernel_dr_cm = dr_cm
+        self.dose_rate_kernel_dtheta_degree = dtheta_deg
+        
+        #compare with the exact calculation where the interpolation error is largest
+        rr = rr[:-1, :-1] + 0.5*dr_cm
+        tt = tt[:-1, :-1] + 0.5*dtheta_deg
+        exact = self._calc_rate_exact(rr, tt)
+        approx = self.eval_dose_rate_kernel(rr, tt)
+        self.dose_rate_kernel_max_rel_dev = np.max(np.abs(approx - exact)/np.abs(exact))
+        
+        print("built {0}x{1} dose rate kernel, max relative deviation from exact: {2}".format(n_r, n_th, self.dose_rate_kernel_max_rel_dev))
+        return(self.dose_rate_kernel_max_rel_dev)
+        
+    def eval_dose_rate_kernel(self, r, theta):
+        """doserate/(Sk) by bilinear interpolation of the precomputed kernel. 
+        r (cm) and theta (degrees) are arrays of the same shape and r must lie
+        within the kernel lattice."""
+        return(self._lookup_dose_rate_kernel(r, np.asarray(theta, dtype=np.double)/self.dose_rate_kernel_dtheta_degree))
+    
+    def _dose_rate_kernel_flat(self):
+        """The kernel flattened in C order and its differences along theta, kept
+        until the kernel array is replaced (e.g. by build_dose_rate_kernel or the cache).
+        They are stored in single precision (relative rounding 6e-8, far below the
+        interpolation error) so that twice as much of the kernel stays in cache."""
+        if(getattr(self, "_kernel_flat_of", None) is not self.dose_rate_kernel):
+            k = np.asarray(self.dose_rate_kernel, dtype=np.double)
+            slope = np.zeros_like(k)
+            slope[:, :-1] = k[:, 1:] - k[:, :-1]
+            self._kernel_flat = (np.ascontiguousarray(k, dtype=np.float32).ravel(), np.ascontiguousarray(slope, dtype=np.float32).ravel())
+            self._kernel_flat_of = self.dose_rate_kernel
+        return(self._kernel_flat)
+    
+    def _lookup_dose_rate_kernel(self, r, ft):
+        """Bilinear lookup at radii r (cm) and fractional theta indices ft. Neither
+        argument is modified. Only flat 1D gathers are used: two points per row with the precomputed theta slopes."""
+        n_r, n_th = self.dose_rate_kernel.shape
+        kernel, slope = self._dose_rate_kernel_flat()
+        r = np.asarray(r, dtype=np.double)
+        fr = np.array(r, dtype=np.double)
+        fr -= self.dose_rate_kernel_r0_cm
+        fr *= 1./self.dose_rate_kernel_dr_cm
+        i = fr.astype(np.intp)
+        np.clip(i, 0, n_r-2, out=i)
+        fr -= i
+        
+        ft = np.asarray(ft, dtype=np.double)
+        j = ft.astype(np.intp)
+        np.clip(j, 0, n_th-2, out=j)
+        ft = ft - j
+        
+        k = i*n_th
+        k += j
+        low = slope.take(k)*ft
+        low += kernel.take(k)
+        k += n_th
+        high = slope.take(k)*ft
+        high += kernel.take(k)
+        high -= low
+        high *= fr
+        high += low
+        high /= r*r
+        return(high)
     
     def _calcCenter(self, arr):
         return(0.5*arr[0:-1]+0.5*arr[1:])
@@ -324,36 +675,7 @@ class jkcm_TG43_calc:
 
 
         
-    def remove_comments(self, string_list, comment_char):
-        """ This removes all extra white space and
-        strings starting with the comment_char from input the string_list"""
-        #remove empty lines
-
-        new_list = string_list.copy()        
-        print("Removing extra whitespace..")
-        for i in np.arange(len(new_list)):
-            new_list[i] = " ".join(new_list[i].split())        
-        
-        pattern = re.compile("^[ ]*$")
-        remove_set = set()
-        for i in new_list:
-            q = pattern.match(i)
-            if(q != None):
-                remove_set.add(i)
-            else:
-                q = re.search(comment_char, i)
-                if( q != None):
-                    if(q.span()[0] == 0):
-                        remove_set.add(i)
-                    else:
-                        i = i[0:q.span()[0]]
-        
-        for i in remove_set:
-            new_list.remove(i)
-    
-        return(new_list)
-    
-    def import_gr_table(self, filename):
+    def import_gr_table(self, filename, kind="linear"):
         """
         This will import a text file referred to by filename.
         The test file format consists of comments indicated by "#".
@@ -363,6 +685,8 @@ class jkcm_TG43_calc:
         radius_cm g_r
         0.5 1.08
         ...
+        
+        kind: "linear" or "loglinear" interpolation of g(r) between table radii.
 
         Example:
         o = jkcm_TG43_calc()
@@ -370,40 +694,18 @@ class jkcm_TG43_calc:
         o.import_gr_table(filename)
         """
         print("trying to import gr table from: {0}".format(filename))
-    
-        f = open(filename, 'r')        
-        data = f.read()
-        f.close()
-        mylines = data.splitlines()
-        mylines = self.remove_comments(mylines, "#")
-     
-        #find the required parameter strings in file
-        pat = re.compile('^[ ]*radius_(.*) g_r[ ]*$')
-        r_index=-1
-        r_units=None
-        for i in range(len(mylines)):
-            q = pat.match(mylines[i])
-            if(q != None):
-                r_index = i
-                r_units = q.group(1)
-                break
-        
-
-        assert r_index != -1, "did not find radius field"
-        
-        
-        print("r_index:{0}\n".format(r_index))
-    
-        ta_list = mylines[(r_index+1):]
         
-        parse_str = " ".join(ta_list)
-        parsed = parse_str.split()
-        r_arr = parsed[0::2]
-        gr_arr = parsed[1::2]
-        r_arr = np.array(r_arr, dtype=np.float)
-        gr_arr = np.array(gr_arr, dtype=np.float)
+        rows, fields = read_keyed_text(filename, "#")
         
+        #the first row is the header, e.g. "radius_cm g_r"
+        assert len(rows) > 0, "did not find radius field"
+        q = re.match('^radius_(.*) g_r$', " ".join(rows[0]))
+        assert q != None, "did not find radius field"
+        r_units = q.group(1)
         
+        parsed = np.array([t for row in rows[1:] for t in row], dtype=np.double)
+        r_arr = parsed[0::2]
+        gr_arr = parsed[1::2]
         
         assert len(r_arr) == len(gr_arr), "inconsistent grtheta table size and radii!"
         assert str.upper(r_units) == "CM", "requiring radii in units of cm for now, current units:{0}".format(r_units)
@@ -412,9 +714,7 @@ class jkcm_TG43_calc:
         self.g_r_filename = filename
         self.g_r_table = gr_arr
         
-        self._build_g_r_interp_table()
-        
-        #return({"mylines":mylines, "r_arr":r_arr, "gr_arr":gr_arr,"r_units":r_units})
+        self._build_g_r_interp_table(kind=kind)
         
                 
     def import_aniso_table(self, filename, extrapolation="nn"):
@@ -449,65 +749,24 @@ class jkcm_TG43_calc:
         """
         
         print("trying to import anisotropy table from: {0}".format(filename))
-    
-        f = open(filename, 'r')        
-        data = f.read()
-        f.close()
-        mylines = data.splitlines()
-        mylines = self.remove_comments(mylines, "#")
-     
-        #find the required parameter strings in file
-        radius_pat = re.compile('^[ ]*radius_(.*):.*')
-        theta_pat = re.compile('^[ ]*theta_(.*):.*')
-        table_pat = re.compile('^[ ]*table:.*')
-        r_index=-1
-        r_units=None
-        th_index=-1
-        th_units=None
-        ta_index=-1
-        for i in range(len(mylines)):
-            q = radius_pat.match(mylines[i])
-            if(q != None):
-                r_index = i
-                r_units = q.group(1)
-                
-                break
-        for i in range(r_index, len(mylines)):
-            q = theta_pat.match(mylines[i])
-            if (q != None):
-                th_index = i
-                th_units = q.group(1)
-                break
-        
-        for i in range(th_index, len(mylines)):
-            q = table_pat.match(mylines[i])
-            if (q != None):
-                ta_index = i
-                break
-        assert r_index != -1, "did not find radius field"
-        assert th_index != -1, "did not find theta field"
-        assert ta_index != -1, "did not find table field"
-        
-        print("r_index:{0}\nth_index:{1}\nta_index{2}\n".format(r_index, th_index, ta_index))
-    
-        r_list = mylines[r_index:th_index]
-        th_list = mylines[th_index:ta_index]
-        ta_list = mylines[ta_index:]
         
-        r_str = " ".join(r_list)
-        r_str = r_str.split(sep=":")
-        r_str = r_str[1]
-        r_arr = np.array(r_str.split(), dtype=np.float)
+        rows, fields = read_keyed_text(filename, "#")
         
-        th_str = " ".join(th_list)
-        th_str = th_str.split(sep=":")
-        th_str = th_str[1]
-        th_arr = np.array(th_str.split(), dtype=np.float)
+        #find the required parameter fields in file
+        r_units = None
+        th_units = None
+        for key in fields.keys():
+            if(key.startswith("radius_") and r_units == None):
+                r_units = key[len("radius_"):]
+            elif(key.startswith("theta_") and th_units == None):
+                th_units = key[len("theta_"):]
+        assert r_units != None, "did not find radius field"
+        assert th_units != None, "did not find theta field"
+        assert "table" in fields, "did not find table field"
         
-        ta_str = " ".join(ta_list)
-        ta_str = ta_str.split(sep=":")
-        ta_str = ta_str[1]
-        ta_arr = np.array(ta_str.split(), dtype=np.float)
+        r_arr = np.array(fields["radius_" + r_units], dtype=np.double)
+        th_arr = np.array(fields["theta_" + th_units], dtype=np.double)
+        ta_arr = np.array(fields["table"], dtype=np.double)
         
         assert len(ta_arr) == len(r_arr)*len(th_arr), "inconsistent frtheta table size and radii and thetas!"
         ta_arr = ta_arr.reshape(len(th_arr), len(r_arr))
@@ -519,12 +778,12 @@ class jkcm_TG43_calc:
        #now check if theta goes to 90 or 180 (update frtheta and theta accordingly)
         if(max(th_arr) == 90):
             print("input table only goes to 90 degree, reflecting across 90 to generate complete table!")
-            temp_arr = np.zeros((2*len(th_arr)-1, len(r_arr)), dtype=np.float)
+            temp_arr = np.zeros((2*len(th_arr)-1, len(r_arr)), dtype=np.double)
             temp_arr[0:(len(th_arr)),:] = ta_arr
             temp_arr[(len(th_arr)-1):, :] = ta_arr[::-1,:]
             ta_arr = temp_arr
             
-            temp_arr = np.zeros(2*(len(th_arr))-1, dtype=np.float)
+            temp_arr = np.zeros(2*(len(th_arr))-1, dtype=np.double)
             temp_arr[0:len(th_arr)] = th_arr
             temp_arr[(len(th_arr)-1):] = (180 - th_arr)[::-1]
             th_arr = temp_arr
@@ -545,12 +804,10 @@ class jkcm_TG43_calc:
         self.aniso_table_thetas_degree = th_arr
         self.aniso_table_radii_cm = r_arr
         self.aniso_table = ta_arr
+        self.phi_an = None
         self.aniso_filename = filename
         
         self._build_frtheta_interp_table()
-        
-        #return({"mylines":mylines, "r_arr":r_arr, "th_arr":th_arr, "frtheta_arr":ta_arr,
-        #        "r_units":r_units, "th_units":th_units})
                 
         
     def import_source_data(self, filename):
@@ -585,27 +842,8 @@ class jkcm_TG43_calc:
         """
         
         print("trying to import source data from: {0}".format(filename))
-    
-        f = open(filename, 'r')        
-        data = f.read()
-        f.close()
-        mylines = data.splitlines()
-        mylines = self.remove_comments(mylines, "#")
-     
-        #find the required parameter strings in file
-        seed_length_cm_pat = re.compile('^[ ]*seed_length_cm:(.*)')
-        eff_source_length_cm_pat = re.compile('^[ ]*effective_source_length_cm:(.*)')
-        seed_diameter_cm_pat = re.compile('^[ ]*seed_diameter_cm:(.*)')
-        dose_rate_constant_cGy_per_U_per_h_pat = re.compile('^[ ]*dose_rate_constant_cGy_per_U_per_h:(.*)')
-        seed_model_name_pat = re.compile('^[ ]*seed_model_name:(.*)')
-        seed_radionuclide_pat = re.compile('^[ ]*seed_radionuclide:(.*)')
-        
-        sl_index=-1
-        esl_index = -1
-        sd_index = -1
-        drc_index = -1
-        smn_index = -1
-        sr_index = -1
+        
+        rows, fields = read_keyed_text(filename, "#")
         
         self.seed_length_cm = None  
         self.eff_source_length_cm = None
@@ -614,54 +852,16 @@ class jkcm_TG43_calc:
         self.source_name_model = None
         self.radionuclide = None        
         
-        for i in range(len(mylines)):
-            q = seed_length_cm_pat.match(mylines[i])
-            if(q != None):
-                sl_index = i                
-                self.seed_length_cm = np.float(q.group(1))
-                break
-        assert sl_index != -1, "did not find seed_length_cm field"
-            
-        for i in range(sl_index, len(mylines)):
-            q = eff_source_length_cm_pat.match(mylines[i])
-            if (q != None):
-                esl_index = i
-                self.eff_source_length_cm = np.float(q.group(1))
-                break
-        assert esl_index != -1, "did not find effective source length cm field"
-        
-        for i in range(esl_index, len(mylines)):
-            q = seed_diameter_cm_pat.match(mylines[i])
-            if (q != None):
-                sd_index = i
-                self.seed_diameter_cm = np.float(q.group(1))
-                break
-        assert sd_index != -1, "did not find seed diameter cm field"
-        
-        for i in range(sd_index, len(mylines)):
-            q = dose_rate_constant_cGy_per_U_per_h_pat.match(mylines[i])
-            if (q != None):
-                drc_index = i
-                self.dose_rate_constant_cGy_per_h_per_U = np.float(q.group(1))
-                break
-        assert drc_index != -1, "did not find dose_rate_constant field"
-        
-        for i in range(drc_index, len(mylines)):
-            q = seed_model_name_pat.match(mylines[i])
-            if (q != None):
-                smn_index = i
-                self.source_name_model = q.group(1).strip()
-                break
-        assert smn_index != -1, "did not find seed_model_name field"        
-        
-        for i in range(smn_index, len(mylines)):
-            q = seed_radionuclide_pat.match(mylines[i])
-            if (q != None):
-                sr_index = i
-                self.radionuclide = str.upper(q.group(1)).strip()
-                break
-        assert sr_index != -1, "did not find seed_radionuclide field"        
+        def field(key, description):
+            assert key in fields, "did not find {0} field".format(description)
+            return(" ".join(fields[key]))
         
+        self.seed_length_cm = float(field("seed_length_cm", "seed_length_cm"))
+        self.eff_source_length_cm = float(field("effective_source_length_cm", "effective source length cm"))
+        self.seed_diameter_cm = float(field("seed_diameter_cm", "seed diameter cm"))
+        self.dose_rate_constant_cGy_per_h_per_U = float(field("dose_rate_constant_cGy_per_U_per_h", "dose_rate_constant"))
+        self.source_name_model = field("seed_model_name", "seed_model_name").strip()
+        self.radionuclide = str.upper(field("seed_radionuclide", "seed_radionuclide")).strip()
 
         self.source_data_filename = filename
         
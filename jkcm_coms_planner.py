@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Use this module to solve for the seed strength of COMS eye plaques in bulk.
+
+For every plaque, prescription depth, prescription dose and implant duration
+plan_coms_batch returns the Sk per seed that delivers the prescription dose at
+the tumor apex (on the central axis at the prescription depth) and the dose at
+the standard points of the COMS hand calculation. The seeds of all plaques are
+stacked and the dose rate per U from every seed to every central axis depth is
+evaluated in one vectorized call; the seeds are then summed per plaque with
+np.add.reduceat, so the number of plaques, depths, doses and durations only
+changes the size of that one call.
+
+The plaque files (COMS_plaques/*.txt) assume the inner sclera is at z=0 and the
+outer sclera at z=-1 mm, so the central axis depths below are z in cm.
+
+Example:
+    from jkcm_coms_planner import plan_coms_batch, write_coms_table
+    res = plan_coms_batch("I125A_consensus", rx_depths_cm=[0.28, 0.48], rx_doses_Gy=[85], durations_h=[100, 168])
+    write_coms_table(res, "coms_commissioning.csv")
+"""
+
+import csv
+import glob
+import os
+import numpy as np
+from jkcm_TG43_calc import jkcm_TG43_calc, read_keyed_text
+from jkcm_source_model_cache import load_model
+
+PLAQUES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "COMS_plaques")
+
+#(name, central axis depth in cm); None is the tumor apex, i.e. the prescription depth
+STANDARD_POINTS = [("External Sclera", -0.1),
+                   ("Internal Sclera", 0.),
+                   ("COMS 5 mm", 0.5),
+                   ("Tumor apex", None),
+                   ("Eye Origin", 1.1),
+                   ("Opposite Retina", 2.2)]
+
+
+def read_plaque(filename):
+    """Returns (centers, tips) in cm as Sx3 arrays from a COMS plaque file
+    (seed id, center and tip in mm, see jkcm_samemodel_multisource_TG43.importSources)."""
+    rows, fields = read_keyed_text(filename, "#")
+    table = np.array([row[0:7] for row in rows[1:]], dtype=np.double).reshape(-1, 7)
+    table = table[np.argsort(table[:, 0], kind='stable')]
+    return(table[:, 1:4]/10., table[:, 4:7]/10.)
+
+
+def plaque_files(plaques_dir=None):
+    """All COMS plaque files in plaques_dir (default COMS_plaques/), smallest plaque first."""
+    if(plaques_dir is None):
+        plaques_dir = PLAQUES_DIR
+    files = glob.glob(os.path.join(plaques_dir, "COMS_*mm_plaque.txt"))
+    def size_mm(f):
+        digits = "".join(c for c in os.path.basename(f).split("mm")[0] if c.isdigit())
+        return(int(digits))
+    return(sorted(files, key=size_mm))
+
+
+def plan_coms_batch(model="I125A_consensus", files=None, rx_depths_cm=(0.5,), rx_doses_Gy=(85.,), durations_h=(100.,),
+                    points=None):
+    """
+    model: a jkcm_TG43_calc object with its tables loaded, or the name of a source model
+           (loaded with jkcm_source_model_cache.load_model).
+    files: the plaque files, default plaque_files().
+    rx_depths_cm: prescription depths (tumor apex) on the central axis in cm.
+    rx_doses_Gy: prescription doses in Gy.
+    durations_h: implant durations (wall time) in hours.
+    points: list of (name, depth_cm) to report, default STANDARD_POINTS. A depth of
+            None is the prescription depth.
+
+    Returns a dictionary with
+        'plaques': P plaque names, 'rx_depths_cm': D, 'rx_doses_Gy': R, 'durations_h': T,
+        'point_names': N names, 'point_depths_cm': (D, N) depth of each point,
+        'effective_time_h': T effective times,
+        'dose_rate_cGy_per_h_per_U': (P, D, N) total dose rate per U of seed strength,
+        'Sk_U': (P, D, R, T) seed strength per seed,
+        'point_doses_Gy': (P, D, R, T, N) doses at the points,
+        'seed_centers_cm': (S, 3) centers of the seeds of all plaques, plaque p owning
+                           seeds 'seed_starts'[p] to 'seed_starts'[p+1]-1 (or the last seed),
+        'seed_dose_rate_cGy_per_h_per_U': (S, D, N) dose rate per U from each seed to the points.
+    """
+    if(isinstance(model, jkcm_TG43_calc)):
+        calc_obj = model
+    else:
+        calc_obj = load_model(model)
+    if(files is None):
+        files = plaque_files()
+    assert len(files) > 0, "no plaque files found"
+    if(points is None):
+        points = STANDARD_POINTS
+    rx_depths_cm = np.atleast_1d(np.asarray(rx_depths_cm, dtype=np.double))
+    rx_doses_Gy = np.atleast_1d(np.asarray(rx_doses_Gy, dtype=np.double))
+    durations_h = np.atleast_1d(np.asarray(durations_h, dtype=np.double))
+
+    #stack the seeds of all plaques
+    centers = []
+    tips = []
+    starts = []
+    n = 0
+    for f in files:
+        c, t = read_plaque(f)
+        starts.append(n)
+        n += len(c)
+        centers.append(c)
+        tips.append(t)
+    centers = np.concatenate(centers)
+    tips = np.concatenate(tips)
+
+    #every depth that is needed, evaluated once
+    point_depths = np.array([[rx if d is None else d for (name, d) in points] for rx in rx_depths_cm], dtype=np.double).reshape(len(rx_depths_cm), len(points))
+    depths, inverse = np.unique(np.concatenate([point_depths.ravel(), rx_depths_cm]), return_inverse=True)
+    axis_pts = np.zeros([len(depths), 3])
+    axis_pts[:, 2] = depths
+
+    per_seed = calc_obj.calc_to_points_from_sources(centers, tips, axis_pts)
+    rate = np.add.reduceat(per_seed, starts, axis=0)   #P x unique depths, cGy/h/U
+
+    point_rate = rate[:, inverse[0:point_depths.size]].reshape(len(files), len(rx_depths_cm), len(points))
+    seed_rate = per_seed[:, inverse[0:point_depths.size]].reshape(len(centers), len(rx_depths_cm), len(points))
+    rx_rate = rate[:, inverse[point_depths.size:]]     #P x D
+
+    effT_h = np.asarray(calc_obj.calc_eff_time(durations_h), dtype=np.double)
+    #Sk = D_rx / (rate * effT), doses in Gy and rates in cGy/h
+    Sk = (100.*rx_doses_Gy[None, None, :, None])/(rx_rate[:, :, None, None]*effT_h[None, None, None, :])
+    doses = point_rate[:, :, None, None, :]*Sk[:, :, :, :, None]*effT_h[None, None, None, :, None]/100.
+
+    return({'plaques': [os.path.splitext(os.path.basename(f))[0] for f in files],
+            'rx_depths_cm': rx_depths_cm,
+            'rx_doses_Gy': rx_doses_Gy,
+            'durations_h': durations_h,
+            'point_names': [name for (name, d) in points],
+            'point_depths_cm': point_depths,
+            'effective_time_h': effT_h,
+            'dose_rate_cGy_per_h_per_U': point_rate,
+            'Sk_U': Sk,
+            'point_doses_Gy': doses,
+            'seed_centers_cm': centers,
+            'seed_starts': np.array(starts),
+            'seed_dose_rate_cGy_per_h_per_U': seed_rate})
+
+
+def write_coms_table(res, filename):
+    """Writes the result of plan_coms_batch as a CSV table with one row per
+    plaque, prescription depth, prescription dose and duration."""
+    with open(filename, 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(["plaque", "rx_depth_cm", "rx_dose_Gy", "duration_h", "effective_time_h", "Sk_U"] +
+                   ["{0} (Gy)".format(name) for name in res['point_names']])
+        for p in np.arange(len(res['plaques'])):
+            for d in np.arange(len(res['rx_depths_cm'])):
+                for r in np.arange(len(res['rx_doses_Gy'])):
+                    for t in np.arange(len(res['durations_h'])):
+                        w.writerow([res['plaques'][p], res['rx_depths_cm'][d], res['rx_doses_Gy'][r], res['durations_h'][t],
+                                    "{0:.4f}".format(res['effective_time_h'][t]), "{0:.4f}".format(res['Sk_U'][p, d, r, t])] +
+                                   ["{0:.3f}".format(v) for v in res['point_doses_Gy'][p, d, r, t]])
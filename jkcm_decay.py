@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Use this module for radioactive decay of implanted sources over arrays of
+durations and radionuclides.
+
+All functions broadcast their arguments with numpy rules: durations, dose rates
+and radionuclide names may be scalars or arrays, and mixed radionuclides are
+looked up once per distinct name. Radionuclide names are not case sensitive
+("Ir-192", "IR-192" and "ir-192" are the same).
+
+With mu = ln(2)/half_life and the initial dose rate Ddot0:
+    effective time       T_eff(t) = (1 - exp(-mu*t))/mu      (1/mu for a permanent implant)
+    cumulative dose      D(t) = Ddot0*T_eff(t)
+    wall time for T_eff  t = -ln(1 - mu*T_eff)/mu            (nan when T_eff >= 1/mu)
+
+Example:
+    from jkcm_decay import eff_time_h, dose_vs_time
+    eff_time_h([96, 100, 168], "I-125")
+    eff_time_h(100, ["I-125", "Pd-103", "Cs-131"])
+    dose_vs_time(rate_grid, np.arange(0, 200, 24), "I-125")   #shape (9,) + rate_grid.shape
+"""
+
+import numpy as np
+
+#half lives in hours
+HALF_LIFE_H = {"I-125": 59.4*24.,
+               "Y-90": 64.1,
+               "Ir-192": 73.8*24.,
+               "Cs-131": 9.7*24.,
+               "Pd-103": 17*24.}
+
+
+def half_life_h(nuclide, table=None):
+    """Returns the half life in hours of nuclide (a name or an array of names)
+    from table (default HALF_LIFE_H), ignoring case."""
+    if(table is None):
+        table = HALF_LIFE_H
+    upper = {str(k).upper(): v for k, v in table.items()}
+    names = np.asarray(nuclide)
+    unique, inverse = np.unique(np.char.upper(names.astype(str)).ravel(), return_inverse=True)
+    missing = [str(u) for u in unique if u not in upper]
+    assert len(missing) == 0, "{0} is not listed radionuclides!".format(missing)
+    values = np.array([upper[u] for u in unique], dtype=np.double)
+    return(values[inverse].reshape(names.shape))
+
+
+def decay_constant_per_h(nuclide, table=None):
+    """Returns mu = ln(2)/half life in 1/h."""
+    return(np.log(2)/half_life_h(nuclide, table))
+
+
+def _scalar(a):
+    """0-d results are returned as numpy scalars, like the scalar functions they replace."""
+    if(np.ndim(a) == 0):
+        return(a[()])
+    return(a)
+
+
+def eff_time_h(duration_h, nuclide, infinite=False, table=None):
+    """Returns the effective time in hours of implants of duration_h hours.
+    infinite: permanent implant (duration_h is then ignored)."""
+    mu = decay_constant_per_h(nuclide, table)
+    if(infinite):
+        return(_scalar(np.broadcast_to(1/mu, np.broadcast(np.asarray(duration_h), mu).shape).copy()))
+    t = np.asarray(duration_h, dtype=np.double)
+    return(_scalar(-np.expm1(-mu*t)/mu))
+
+
+def wall_time_from_eff_time_h(eff_time, nuclide, table=None):
+    """Returns the wall time in hours an implant must stay in to reach the
+    effective time eff_time (hours); nan when it can not be reached."""
+    mu = decay_constant_per_h(nuclide, table)
+    x = mu*np.asarray(eff_time, dtype=np.double)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(x < 1, -np.log1p(-x)/mu, np.nan)
+    return(_scalar(t))
+
+
+def dose_vs_time(initial_dose_rate, times_h, nuclide, table=None):
+    """Returns the cumulative dose at each of times_h for every initial dose rate.
+    The result has shape times_h.shape + initial_dose_rate.shape, e.g. a stack of
+    cumulative dose grids when initial_dose_rate is a dose rate grid. nuclide may be
+    a name or an array broadcastable against times_h."""
+    effT = np.asarray(eff_time_h(times_h, nuclide, table=table))
+    return(np.multiply.outer(effT, np.asarray(initial_dose_rate, dtype=np.double)))
+
+
+def time_to_dose(initial_dose_rate, dose, nuclide, table=None):
+    """Returns the wall time in hours needed to deliver dose with the initial
+    dose rate initial_dose_rate (same dose units per hour); arrays broadcast.
+    nan when the dose exceeds what a permanent implant delivers."""
+    with np.errstate(divide='ignore'):
+        eff = np.asarray(dose, dtype=np.double)/np.asarray(initial_dose_rate, dtype=np.double)
+    return(wall_time_from_eff_time_h(eff, nuclide, table))
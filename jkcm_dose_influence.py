@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Use this module to keep the dose from each source to a set of points so that
+changing source strengths, dwell times or the implant duration does not repeat
+the TG43 geometry calculation.
+
+The influence matrix A[i,j] is the dose rate per unit air kerma strength
+(cGy/h/U, i.e. dose per U*h) at point j from source i, with the sources in
+order of source ID. Doses for any strengths and dwell times are then
+    dose = A.T @ (Sk*dwell)
+which is a matrix-vector product.
+
+For large implants over large grids most entries are negligible, so the matrix
+can be built sparse (scipy.sparse CSC, a column per point) with a radius cutoff
+(only source-point pairs within cutoff_cm are evaluated, found with a KD-tree)
+and/or a dose rate threshold (entries below it are dropped). The points are
+processed chunk_size pairs at a time and each chunk is appended to the CSC arrays,
+so memory scales with the number of kept entries. truncation_report gives the
+memory used and a bound on the dose that was dropped.
+
+Example:
+    o = jkcm_samemodel_multisource_TG43()
+    o.initializeTG43model("I125A_consensus")
+    o.importSources("COMS_plaques/COMS_16mm_plaque.txt")
+    m = jkcm_dose_influence_matrix(o, pts)
+    m.dose(strengths=np.repeat(4.3, m.n_sources()), dwell_times=np.repeat(98.6, m.n_sources()))
+    o.source_center_dict[3] = o.source_center_dict[3] + [0, 0, 0.01]
+    m.dose()   #only the row of source 3 is recomputed
+"""
+
+import numpy as np
+import scipy.sparse
+from scipy.spatial import cKDTree
+
+
+class jkcm_dose_influence_matrix:
+    """Dose-influence matrix of the sources of a jkcm_samemodel_multisource_TG43 object.
+
+    The matrix is tied to the source geometry of that object: before it is used,
+    the centers and tips of all sources are compared with the ones the rows were
+    computed for, and only the rows of sources that moved (or were added) are
+    recomputed. Points can be appended, in which case only the new columns are computed.
+    """
+    def __init__(self, multisource, points=None, chunk_size=1000000, cutoff_cm=None, dose_threshold=None, sparse=None):
+        """multisource: a jkcm_samemodel_multisource_TG43 object with its sources imported.
+        points: an Mx3 array of points (same units as the sources, typically cm).
+        chunk_size: the number of source-point pairs evaluated at once.
+        cutoff_cm: if set, pairs farther apart than cutoff_cm are not evaluated (sparse only).
+        dose_threshold: if set, entries below this dose rate per U (cGy/h/U) are dropped (sparse only).
+        sparse: store a scipy.sparse CSC matrix, default True when cutoff_cm or dose_threshold is set."""
+        if(sparse is None):
+            sparse = (cutoff_cm is not None) or (dose_threshold is not None)
+        assert sparse or (cutoff_cm is None and dose_threshold is None), "cutoff_cm and dose_threshold need a sparse matrix"
+        self.multisource = multisource
+        self.chunk_size = chunk_size
+        self.cutoff_cm = cutoff_cm
+        self.dose_threshold = dose_threshold
+        self.sparse = sparse
+        self.points = np.zeros([0, 3])
+        self.matrix = scipy.sparse.csc_matrix((0, 0)) if sparse else np.zeros([0, 0])
+        self.source_ids = np.zeros([0], dtype=int)
+        self._centers = np.zeros([0, 3])
+        self._tips = np.zeros([0, 3])
+        self._calc_obj = None
+        self.n_rows_computed = 0 #for checking how much work an update did
+        if(points is not None):
+            self.append_points(points)
+
+    def n_sources(self):
+        return(len(self.source_ids))
+
+    def n_points(self):
+        return(len(self.points))
+
+    def _calc_block(self, centers, tips, pts):
+        """Dose rate per U from the given sources to pts, chunk_size pairs at a time."""
+        if(self.sparse):
+            return(self._calc_sparse_block(centers, tips, pts))
+        calc_obj = self.multisource.jkcm_TG43_calc_obj
+        out = np.zeros([len(centers), len(pts)])
+        step = max(int(self.chunk_size//max(len(centers), 1)), 1)
+        for si in np.arange(0, len(pts), step):
+            fi = min(si+step, len(pts))
+            out[:, si:fi] = calc_obj.calc_to_points_from_sources(centers, tips, pts[si:fi])
+        self.n_rows_computed += len(centers)
+        return(out)
+
+    def _calc_sparse_block(self, centers, tips, pts):
+        """Like _calc_block, but returns a CSC matrix holding only the pairs within
+        cutoff_cm and at or above dose_threshold. Each chunk of points is sorted by
+        point and appended to the data, indices and indptr arrays of the result."""
+        calc_obj = self.multisource.jkcm_TG43_calc_obj
+        n_src = len(centers)
+        tree = None
+        if(self.cutoff_cm is not None and n_src > 0):
+            tree = cKDTree(centers)
+        data = []
+        indices = []
+        counts = []
+        step = max(int(self.chunk_size//max(n_src, 1)), 1)
+        for si in np.arange(0, len(pts), step):
+            fi = min(si+step, len(pts))
+            p = pts[si:fi]
+            if(n_src == 0):
+                src_index = np.zeros([0], dtype=int)
+                pt_index = np.zeros([0], dtype=int)
+                vals = np.zeros([0])
+            elif(tree is not None):
+                pairs = tree.sparse_distance_matrix(cKDTree(p), self.cutoff_cm, output_type='ndarray')
+                src_index = pairs['i']
+                pt_index = pairs['j']
+                vals = calc_obj.calc_to_pairs_from_sources(centers, tips, p, src_index, pt_index)
+            else:
+                vals = calc_obj.calc_to_points_from_sources(centers, tips, p)
+                src_index, pt_index = np.indices(vals.shape).reshape(2, -1)
+                vals = vals.ravel()
+            if(self.dose_threshold is not None):
+                keep = vals >= self.dose_threshold
+                src_index = src_index[keep]
+                pt_index = pt_index[keep]
+                vals = vals[keep]
+            order = np.lexsort((src_index, pt_index))
+            data.append(vals[order])
+            indices.append(src_index[order].astype(np.int32))
+            counts.append(np.bincount(pt_index, minlength=len(p)))
+        self.n_rows_computed += n_src
+        indptr = np.zeros(len(pts)+1, dtype=np.int64)
+        if(len(counts) > 0):
+            np.cumsum(np.concatenate(counts), out=indptr[1:])
+            data = np.concatenate(data)
+            indices = np.concatenate(indices)
+        else:
+            data = np.zeros([0])
+            indices = np.zeros([0], dtype=np.int32)
+        return(scipy.sparse.csc_matrix((data, indices, indptr), shape=(n_src, len(pts))))
+    
+    def update(self):
+        """Brings the matrix up to date with the sources of the multisource object.
+        Rows of sources that were removed are dropped, rows of sources that were
+        added or moved are computed. If the TG43 model of the multisource object
+        was replaced every row is recomputed."""
+        src = self.multisource.sourceArrays()
+        if(self._calc_obj is not self.multisource.jkcm_TG43_calc_obj):
+            self.invalidate()
+            self._calc_obj = self.multisource.jkcm_TG43_calc_obj
+
+        old_row = {int(qid): i for i, qid in enumerate(self.source_ids)}
+        stale = []
+        kept = []
+        kept_from = []
+        for i, qid in enumerate(src["ids"]):
+            j = old_row.get(int(qid))
+            if(j is None or not (np.array_equal(self._centers[j], src["centers"][i]) and
+                                 np.array_equal(self._tips[j], src["tips"][i]))):
+                stale.append(i)
+            else:
+                kept.append(i)
+                kept_from.append(j)
+        stale = np.array(stale, dtype=int)
+        if(self.sparse):
+            if(len(stale) == 0 and kept_from == list(range(len(self.source_ids)))):
+                matrix = self.matrix
+            else:
+                #stack the kept rows and the new rows, then put them in source ID order
+                blocks = [scipy.sparse.csr_matrix(self.matrix)[kept_from],
+                          scipy.sparse.csr_matrix(self._calc_block(src["centers"][stale], src["tips"][stale], self.points))]
+                order = np.argsort(np.concatenate([kept, stale]), kind='stable')
+                matrix = scipy.sparse.csc_matrix(scipy.sparse.vstack(blocks).tocsr()[order])
+        else:
+            matrix = np.zeros([len(src["ids"]), len(self.points)])
+            matrix[kept] = self.matrix[kept_from]
+            if(len(stale) > 0 and len(self.points) > 0):
+                matrix[stale] = self._calc_block(src["centers"][stale], src["tips"][stale], self.points)
+
+        self.matrix = matrix
+        self.source_ids = src["ids"]
+        self._centers = src["centers"].copy()
+        self._tips = src["tips"].copy()
+        return(self)
+
+    def invalidate(self, source_ids=None):
+        """Marks the rows of source_ids (default all sources) for recomputation,
+        e.g. after changing the TG43 tables of the model in place."""
+        if(source_ids is None):
+            rows = np.arange(len(self.source_ids))
+        else:
+            rows = np.nonzero(np.isin(self.source_ids, source_ids))[0]
+        self._centers[rows] = np.nan
+
+    def append_points(self, points):
+        """Adds the Mx3 points and computes only their columns.
+        Returns the column indices of the new points."""
+        self.update()
+        points = np.asarray(points, dtype=np.double).reshape(-1, 3)
+        src = self.multisource.sourceArrays()
+        cols = self._calc_block(src["centers"], src["tips"], points)
+        first = len(self.points)
+        self.points = np.concatenate([self.points, points])
+        if(self.sparse):
+            self.matrix = scipy.sparse.hstack([self.matrix.reshape((len(src["ids"]), self.matrix.shape[1])), cols], format='csc')
+        else:
+            self.matrix = np.concatenate([self.matrix.reshape(len(src["ids"]), -1), cols], axis=1)
+        return(np.arange(first, len(self.points)))
+
+    def dose(self, strengths=None, dwell_times=None, dose_rate=False):
+        """Returns the dose (cGy) at every point for the given strengths (U) and dwell
+        times (h), arrays in order of source ID. Either defaults to the values in
+        the multisource object. With dose_rate the dose rate (cGy/h) is returned."""
+        self.update()
+        src = self.multisource.sourceArrays()
+        w = src["strengths"] if strengths is None else np.asarray(strengths, dtype=np.double)
+        if(not dose_rate):
+            w = w*(src["dwell_times"] if dwell_times is None else np.asarray(dwell_times, dtype=np.double))
+        assert len(w) == self.n_sources(), "need one strength/dwell time per source"
+        return(self.matrix.T.dot(w))
+
+    def dose_for_duration(self, duration_h, strengths=None):
+        """Returns the dose (cGy) at every point for a permanent or temporary implant
+        of duration_h hours, using the effective time of the radionuclide. 
+        An array of durations gives an array of shape (len(duration_h), M)."""
+        rate = self.dose(strengths=strengths, dose_rate=True)
+        duration_h = np.asarray(duration_h, dtype=np.double)
+        effT_h = np.asarray(self.multisource.jkcm_TG43_calc_obj.calc_eff_time(duration_h), dtype=np.double)
+        return(np.multiply.outer(effT_h, rate))
+    
+    def memory_bytes(self):
+        """The memory used by the matrix in bytes."""
+        if(self.sparse):
+            return(self.matrix.data.nbytes + self.matrix.indices.nbytes + self.matrix.indptr.nbytes)
+        return(self.matrix.nbytes)
+    
+    def truncation_report(self):
+        """Returns a dictionary describing the storage and truncation of the matrix:
+        nnz, density, memory_bytes, dense_memory_bytes,
+        max_bound_per_U: an upper bound on the dose rate per U (cGy/h/U, with every 
+            source at 1 U) that was dropped at any point; the sources beyond cutoff_cm
+            contribute at most max_rate_beyond(cutoff_cm) each, and the dropped entries
+            within the cutoff less than dose_threshold each. Multiply by the largest
+            Sk*t for a dose bound.
+        max_rel_bound: the largest ratio of that bound to the kept dose rate per U at a point,
+        n_points_empty: the number of points that no kept entry reaches (not in max_rel_bound)."""
+        self.update()
+        n_src = self.n_sources()
+        n_pts = self.n_points()
+        nnz = self.matrix.nnz if self.sparse else int(np.count_nonzero(self.matrix))
+        bound = np.zeros(n_pts)
+        if(self.sparse and n_pts > 0 and n_src > 0):
+            if(self.cutoff_cm is not None):
+                n_near = cKDTree(self._centers).query_ball_point(self.points, self.cutoff_cm, return_length=True)
+                far_rate = self.multisource.jkcm_TG43_calc_obj.max_rate_beyond(self.cutoff_cm)
+                bound += far_rate*(n_src - n_near)
+            else:
+                n_near = np.full(n_pts, n_src)
+            if(self.dose_threshold is not None):
+                kept = np.diff(self.matrix.indptr)
+                bound += self.dose_threshold*(n_near - kept)
+        kept_rate = np.asarray(self.matrix.sum(axis=0)).ravel()
+        empty = kept_rate <= 0
+        rel = bound[~empty]/kept_rate[~empty]
+        return({'nnz':nnz,
+                'density':nnz/max(n_src*n_pts, 1),
+                'memory_bytes':self.memory_bytes(),
+                'dense_memory_bytes':8*n_src*n_pts,
+                'max_bound_per_U':float(np.max(bound)) if n_pts > 0 else 0.,
+                'max_rel_bound':float(np.max(rel)) if len(rel) > 0 else 0.,
+                'n_points_empty':int(np.count_nonzero(empty))})
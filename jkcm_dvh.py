@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Use this module for dose-volume histograms (DVHs) of structures on a dose grid.
+
+jkcm_dvh accumulates the histograms chunk by chunk as the grid is evaluated
+(jkcm_samemodel_multisource_TG43.iter_dose_grid_chunks yields (si, fi, dose)
+chunks of the grid flattened in C order), so the full dose grid is never held
+in memory. The dose bins are fixed up front (n_bins bins from 0 to max_dose, doses
+above max_dose are kept in an overflow bin), which is what makes the histograms
+additive over chunks; the minimum, maximum and mean dose of each structure are
+tracked exactly. A voxel whose dose is not finite (a voxel at a source center gets
+nan) is counted in the overflow bin as receiving more than any finite dose and left
+out of the minimum, maximum and mean; its volume is reported as nan_volume.
+
+A structure is either
+    a boolean array with the shape of the grid (or flattened in C order), or
+    a function of an Nx3 array of points that returns N booleans, e.g. sphere(),
+    cylinder(), which is evaluated per chunk.
+The volume of a voxel is the product of its cell widths along x, y and z (np.gradient
+of the axes; 1 along an axis with a single value).
+
+Example:
+    o = jkcm_samemodel_multisource_TG43()
+    o.initializeTG43model("I125A_consensus")
+    o.importSources("COMS_plaques/COMS_16mm_plaque.txt")
+    o.setStrengthsInU(4.3)
+    structures = {"tumor": sphere([0, 0, 0.25], 0.3), "lens": sphere([0, 0, 2.0], 0.2)}
+    h = calc_dvh(o, structures, bounds=[[-1.2,1.2],[-1.2,1.2],[-0.1,2.3]], spacing=0.05, max_dose=50000.)
+    h.metrics(D=[100, 90, 50, 2], V=[8500])
+"""
+
+import numpy as np
+
+
+def sphere(center, radius):
+    """Structure of the points within radius of center."""
+    center = np.asarray(center, dtype=np.double).reshape(1, 3)
+    def inside(pts):
+        return(np.sum((pts - center)**2, axis=1) <= radius**2)
+    return(inside)
+
+
+def cylinder(p0, p1, radius):
+    """Structure of the points within radius of the segment p0 to p1 (e.g. a urethra)."""
+    p0 = np.asarray(p0, dtype=np.double).reshape(1, 3)
+    axis = np.asarray(p1, dtype=np.double).reshape(1, 3) - p0
+    length2 = np.sum(axis**2)
+    assert length2 > 0, "p0 and p1 must differ"
+    def inside(pts):
+        d = pts - p0
+        t = np.dot(d, axis[0])/length2
+        r2 = np.sum(d**2, axis=1) - t**2*length2
+        return((t >= 0) & (t <= 1) & (r2 <= radius**2))
+    return(inside)
+
+
+def _cell_widths(a):
+    if(len(a) < 2):
+        return(np.ones(len(a)))
+    return(np.abs(np.gradient(a)))
+
+
+class jkcm_dvh:
+    """Incremental dose-volume histograms of several structures on one grid."""
+    def __init__(self, axes, structures, max_dose, n_bins=1000):
+        """axes: [x, y, z] grid axes (see jkcm_samemodel_multisource_TG43.gridAxes).
+        structures: dictionary of name: structure, see the module description.
+        max_dose: upper edge of the last regular bin; doses above go to the overflow bin.
+        n_bins: number of dose bins of width max_dose/n_bins."""
+        assert max_dose > 0, "max_dose must be positive"
+        self.axes = [np.asarray(a, dtype=np.double) for a in axes]
+        self.shape = tuple(len(a) for a in self.axes)
+        self.n_voxels = int(np.prod(self.shape))
+        self.names = list(structures.keys())
+        self.structures = {}
+        for name in self.names:
+            s = structures[name]
+            if(not callable(s)):
+                s = np.asarray(s, dtype=bool)
+                assert s.size == self.n_voxels, "the mask of {0} does not match the grid".format(name)
+                s = s.reshape(-1)
+            self.structures[name] = s
+        self.max_dose = float(max_dose)
+        self.n_bins = int(n_bins)
+        self.bin_width = self.max_dose/self.n_bins
+        self.edges = self.bin_width*np.arange(self.n_bins + 1)
+        widths = [_cell_widths(a) for a in self.axes]
+        self._widths = widths
+        self._uniform = all(np.allclose(w, w[0]) for w in widths)
+        self._voxel_volume = np.prod([w[0] for w in widths])
+        #per structure: n_bins regular bins and the overflow bin
+        self.hist = {name: np.zeros(self.n_bins + 1) for name in self.names}
+        self.dose_min = {name: np.inf for name in self.names}
+        self.dose_max = {name: -np.inf for name in self.names}
+        self.dose_sum = {name: 0. for name in self.names}
+        self.nan_volume = {name: 0. for name in self.names}
+        self.n_voxels_added = 0
+
+    def _points(self, si, fi):
+        ix, iy, iz = np.unravel_index(np.arange(si, fi), self.shape)
+        return(np.column_stack([self.axes[0][ix], self.axes[1][iy], self.axes[2][iz]]))
+
+    def add_chunk(self, si, fi, dose):
+        """Adds the doses of voxels si to fi-1 (grid flattened in C order)."""
+        dose = np.asarray(dose, dtype=np.double).reshape(-1)
+        assert len(dose) == fi - si, "the chunk has {0} doses for {1} voxels".format(len(dose), fi - si)
+        finite = np.isfinite(dose)
+        all_finite = np.all(finite)
+        if(not all_finite):
+            dose = np.where(finite, dose, np.inf)
+        idx = np.minimum(np.floor(dose/self.bin_width), self.n_bins).astype(int)
+        np.maximum(idx, 0, out=idx)
+        if(self._uniform):
+            vol = None
+        else:
+            ix, iy, iz = np.unravel_index(np.arange(si, fi), self.shape)
+            vol = self._widths[0][ix]*self._widths[1][iy]*self._widths[2][iz]
+        pts = None
+        for name in self.names:
+            s = self.structures[name]
+            if(callable(s)):
+                if(pts is None):
+                    pts = self._points(si, fi)
+                inside = np.asarray(s(pts), dtype=bool)
+            else:
+                inside = s[si:fi]
+            if(not np.any(inside)):
+                continue
+            if(vol is None):
+                self.hist[name] += self._voxel_volume*np.bincount(idx[inside], minlength=self.n_bins + 1)
+            else:
+                v = vol[inside]
+                self.hist[name] += np.bincount(idx[inside], weights=v, minlength=self.n_bins + 1)
+            if(not all_finite):
+                f = finite[inside]
+                if(vol is None):
+                    self.nan_volume[name] += self._voxel_volume*np.count_nonzero(~f)
+                else:
+                    self.nan_volume[name] += np.sum(v[~f])
+                    v = v[f]
+                inside = inside & finite
+                if(not np.any(inside)):
+                    continue
+            d = dose[inside]
+            if(vol is None):
+                self.dose_sum[name] += self._voxel_volume*np.sum(d)
+            else:
+                self.dose_sum[name] += np.dot(v, d)
+            self.dose_min[name] = min(self.dose_min[name], np.min(d))
+            self.dose_max[name] = max(self.dose_max[name], np.max(d))
+        self.n_voxels_added += fi - si
+
+    def volume(self, name):
+        """Volume of the structure (cm^3 for a grid in cm) over the voxels added so far."""
+        return(np.sum(self.hist[name]))
+
+    def differential(self, name, relative=False):
+        """Returns (edges, volumes): the volume (percent of the structure if relative)
+        in each of the n_bins + 1 dose bins. The last bin is the overflow bin, from
+        max_dose to the maximum dose of the structure."""
+        edges = np.append(self.edges, max(self.dose_max[name], self.max_dose))
+        v = self.hist[name].copy()
+        if(relative):
+            v = 100.*v/max(self.volume(name), 1e-300)
+        return(edges, v)
+
+    def cumulative(self, name, relative=False):
+        """Returns (dose, volume): the cumulative DVH, the volume (percent if relative)
+        receiving at least dose, as a piecewise linear curve from the minimum to the
+        maximum finite dose of the structure through the bin edges in between.
+        The curve ends at nan_volume, the volume whose dose is not finite."""
+        total = self.volume(name)
+        nan_volume = self.nan_volume[name]
+        if(total - nan_volume <= 0):
+            return(np.zeros(0), np.zeros(0))
+        above = total - np.concatenate([[0.], np.cumsum(self.hist[name])[0:-1]])   #volume with dose >= edges
+        keep = (self.edges > self.dose_min[name]) & (self.edges < self.dose_max[name])
+        dose = np.concatenate([[self.dose_min[name]], self.edges[keep], [self.dose_max[name]]])
+        vol = np.concatenate([[total], above[keep], [nan_volume]])
+        if(self.dose_max[name] == self.dose_min[name]):
+            dose, vol = dose[[0, -1]], np.array([total, nan_volume])
+        if(relative):
+            vol = 100.*vol/total
+        return(dose, vol)
+
+    def V(self, name, dose, relative=True):
+        """Vx: the volume (percent of the structure if relative, else cm^3) receiving at least dose."""
+        d, v = self.cumulative(name, relative)
+        if(len(d) == 0):
+            return(np.zeros(np.shape(dose)) + np.nan)
+        if(d[0] == d[-1]):
+            return(np.where(np.asarray(dose) <= d[0], v[0], v[-1]))
+        return(np.interp(dose, d, v, left=v[0], right=v[-1]))
+
+    def D(self, name, volume, relative=True):
+        """Dx: the minimum dose to the hottest volume (percent of the structure if relative, else cm^3)."""
+        d, v = self.cumulative(name, relative)
+        volume = np.asarray(volume, dtype=np.double)
+        if(len(d) == 0):
+            return(np.zeros(volume.shape) + np.nan)
+        #last curve point with at least the requested volume, then interpolate to the next
+        k = np.clip(np.searchsorted(-v, -volume, side='right') - 1, 0, len(d) - 1)
+        k1 = np.minimum(k + 1, len(d) - 1)
+        dv = v[k] - v[k1]
+        frac = np.where(dv > 0, (v[k] - volume)/np.where(dv > 0, dv, 1.), 0.)
+        result = d[k] + np.clip(frac, 0., 1.)*(d[k1] - d[k])
+        return(np.where(volume > v[0], np.nan, result))
+
+    def metrics(self, names=None, D=(98, 90, 50, 2), V=()):
+        """Returns {name: {'volume', 'nan_volume', 'min', 'mean', 'max', 'D<x>':..., 'V<x>':...}} with
+        the Dx at the percent volumes D and the Vx (percent) at the doses V.
+        min, mean and max are over the voxels with a finite dose."""
+        if(names is None):
+            names = self.names
+        out = {}
+        for name in names:
+            total = self.volume(name)
+            finite = total - self.nan_volume[name]
+            m = {'volume': total,
+                 'nan_volume': self.nan_volume[name],
+                 'min': self.dose_min[name] if finite > 0 else np.nan,
+                 'mean': self.dose_sum[name]/finite if finite > 0 else np.nan,
+                 'max': self.dose_max[name] if finite > 0 else np.nan}
+            for x in D:
+                m["D{0:g}".format(x)] = float(self.D(name, x))
+            for x in V:
+                m["V{0:g}".format(x)] = float(self.V(name, x))
+            out[name] = m
+        return(out)
+
+
+def calc_dvh(multisource, structures, x=None, y=None, z=None, bounds=None, spacing=None, max_dose=None, n_bins=1000,
+             dose_rate=False, chunk_size=50000, cutoff_cm=None, far_field="drop"):
+    """Evaluates the dose of multisource on the grid (see gridAxes) chunk by chunk
+    with iter_dose_grid_chunks and returns the jkcm_dvh of structures.
+    cutoff_cm and far_field are passed on, see calc_at_points."""
+    assert max_dose is not None, "please supply max_dose for the dose bins"
+    axes = multisource.gridAxes(x, y, z, bounds, spacing)
+    dvh = jkcm_dvh(axes, structures, max_dose, n_bins)
+    for si, fi, dose in multisource.iter_dose_grid_chunks(*axes, dose_rate=dose_rate, chunk_size=chunk_size,
+                                                          cutoff_cm=cutoff_cm, far_field=far_field):
+        dvh.add_chunk(si, fi, dose)
+    return(dvh)
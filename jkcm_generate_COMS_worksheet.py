@@ -4,102 +4,172 @@ Created on Fri Nov 17 16:00:46 2017
 
 @author: jusmikel
 
-This file reads does the following:
+This file does the following for every COMS plaque and every source model:
     1) reads TG43 source data
     2) reads source positions in a COMS eyeplaque
-    3) writes an excel file XLSX file
-"""
+    3) writes an excel file XLSX file with the hand calc worksheet
+
+The doses of all plaques are computed for each source model in one vectorized
+evaluation (jkcm_coms_planner.plan_coms_batch). Each workbook has a worksheet
+per prescription depth with the prescription, the standard point doses and the
+contribution of every seed to every standard point. The workbooks are written
+with xlsxwriter in constant_memory mode (rows are written in order and flushed)
+and, with workers > 1, in parallel by a pool of processes.
 
+Example:
+    generate_coms_worksheets(out_dir="COMS_worksheets", rx_depths_cm=[0.28, 0.5], workers=4)
+"""
 
+import concurrent.futures
+import os
 import numpy as np
 import xlsxwriter
-
-#import the libraries
-#runfile('G:/data/src/TG43/jkcm_TG43_calc.py', wdir='G:/data/src/TG43')
-#runfile('G:/data/src/TG43/jkcm_samemodel_multisource_TG43.py', wdir='G:/data/src/TG43')
+from jkcm_coms_planner import plan_coms_batch, plaque_files, STANDARD_POINTS
+from jkcm_source_model_cache import load_model, list_models
 
 
 def create_top_rows(ws, comsname, titleformat, inputformat):
-                             
+    """Title and the fields to fill in by hand, written row by row for constant_memory."""
     ws.write("A1", comsname, titleformat)
     ws.merge_range("A3:B3", "Physicist Name:")
-    ws.merge_range("A4:B4", "Calc Date and Time:")
-    ws.merge_range("E3:F3", "Patient Name:")
-    ws.merge_range("E4:F4", "Patient Reg#:")
-             
     ws.merge_range('C3:D3','', inputformat)
-    ws.merge_range('C4:D4','', inputformat)
+    ws.merge_range("E3:F3", "Patient Name:")
     ws.merge_range('G3:H3','', inputformat)
+    ws.merge_range("A4:B4", "Calc Date and Time:")
+    ws.merge_range('C4:D4','', inputformat)
+    ws.merge_range("E4:F4", "Patient Reg#:")
     ws.merge_range('G4:H4','', inputformat)
-        
     return
 
 
-
-outfile = r"C:\Users\jusmikel\Desktop\test.xlsx"
-wb = xlsxwriter.Workbook(outfile)
-#add format for title 
-titleformat = wb.add_format()
-titleformat.set_bold()
-titleformat.set_font('Arial')
-titleformat.set_font_size(22)
-
-inputformat = wb.add_format()
-inputformat.set_bg_color('#FFBB99')
-
-                         
-                         
-ws = wb.add_worksheet()
-create_top_rows(ws,"10 mm Eyeplaque Hand Calc (IAI-125A)", titleformat, inputformat)
-    
-
-
-#location of your TG43 data
-rootDir="G:\data\src\TG43"
-sourceDir=rootDir+"\sources\I125A_consensus"
-frthetafile = sourceDir+"\I125A_frtheta.txt"
-grfile = sourceDir+"\I125A_gr.txt"
-sourcedatafile = sourceDir+"\I125A_source_data.txt"
-
-#create object for calculation
-o = jkcm_samemodel_multisource_TG43()
-#initialize object with TG43 data
-o.initializeTG43tables(frthetafile,grfile,sourcedatafile)
- 
-#display source information
-print(o.jkcm_TG43_calc_obj)
- 
-#file containing source locations (problem specified 10x10mm tumor, so add 1 mm margin and use 12x12COMS)
-source_positions_filename = rootDir+"\COMS_plaques\COMS_10mm_plaque.txt"
- 
-#import source positions
-o.importSources(source_positions_filename)
-
-#calc at point of interest (tumor apex)
-dose_cGy_arr_per_Sk_per_effT = o.calc_at_point([0,0,0.28])
-q = o.jkcm_TG43_calc_obj
-effT_h = q.calc_eff_time(100)
-dose_Gy_per_Sk = np.sum(dose_cGy_arr_per_Sk_per_effT)*effT_h/100
-Sk = 85/dose_Gy_per_Sk
-
-#calc other points of interest
-es_dose_Gy = np.sum(o.calc_at_point([0,0,-0.1]))*Sk*effT_h/100
-
-is_dose_Gy = np.sum(o.calc_at_point([0,0,0]))*Sk*effT_h/100
-
-c5_dose_Gy = np.sum(o.calc_at_point([0,0,0.5]))*Sk*effT_h/100
-
-ta_dose_Gy = np.sum(o.calc_at_point([0,0,0.28]))*Sk*effT_h/100
-
-eo_dose_Gy = np.sum(o.calc_at_point([0,0,1.1]))*Sk*effT_h/100
-
-or_dose_Gy = np.sum(o.calc_at_point([0,0,2.2]))*Sk*effT_h/100
-
-#return answers
-print("Sk for each seed = {0} U".format(Sk))
-print("External Sclera = {0} Gy".format(es_dose_Gy))
-print("Internal Sclera = {0} Gy".format(is_dose_Gy))
-print("COMS 5 mm = {0} Gy".format(c5_dose_Gy))
-print("Tumor apex = {0} Gy".format(ta_dose_Gy))
-print("Eye Origin = {0} Gy".format(eo_dose_Gy))
-print("Opposite Retina = {0} Gy".format(or_dose_Gy))
\ No newline at end of file
+def _plaque_title(plaque, model_name):
+    size = plaque.replace("COMS_", "").replace("_plaque", "").replace("mm", " mm")
+    return("{0} Eyeplaque Hand Calc ({1})".format(size, model_name))
+
+
+def write_coms_workbook(filename, title, model_info, point_names, rx_depths_cm, rx_dose_Gy, duration_h, effT_h,
+                        Sk_U, point_depths_cm, point_rate, seed_centers_cm, seed_rate):
+    """Writes one hand calc workbook for one plaque and source model, a worksheet per prescription depth.
+    model_info: list of (label, value) rows describing the source model.
+    Sk_U: D seed strengths, point_depths_cm and point_rate: (D, N),
+    seed_centers_cm: (S, 3), seed_rate: (S, D, N) dose rate per U from each seed (cGy/h/U)."""
+    wb = xlsxwriter.Workbook(filename, {'constant_memory': True})
+    titleformat = wb.add_format({'bold': True, 'font_name': 'Arial', 'font_size': 22})
+    inputformat = wb.add_format({'bg_color': '#FFBB99'})
+    boldformat = wb.add_format({'bold': True})
+    numformat = wb.add_format({'num_format': '0.000'})
+    rateformat = wb.add_format({'num_format': '0.0000'})
+    scale = effT_h/100.   #cGy/h to Gy over the implant
+    for d in np.arange(len(rx_depths_cm)):
+        ws = wb.add_worksheet("Rx depth {0:g} cm".format(rx_depths_cm[d]))
+        ws.set_column(0, 0, 22)
+        ws.set_column(1, 3 + 2*len(point_names), 14)
+        create_top_rows(ws, title, titleformat, inputformat)
+        row = 5
+        for label, value in model_info + [("Prescription depth (cm)", rx_depths_cm[d]),
+                                          ("Prescription dose (Gy)", rx_dose_Gy),
+                                          ("Implant duration (h)", duration_h),
+                                          ("Effective time (h)", effT_h),
+                                          ("Sk for each seed (U)", Sk_U[d])]:
+            ws.write(row, 0, label)
+            ws.write(row, 1, value, numformat if isinstance(value, float) else None)
+            row += 1
+
+        row += 1
+        ws.write_row(row, 0, ["Point", "Depth (cm)", "Dose rate per U (cGy/h/U)", "Dose (Gy)"], boldformat)
+        row += 1
+        for n in np.arange(len(point_names)):
+            ws.write(row, 0, point_names[n])
+            ws.write_number(row, 1, point_depths_cm[d, n], numformat)
+            ws.write_number(row, 2, point_rate[d, n], rateformat)
+            ws.write_number(row, 3, point_rate[d, n]*Sk_U[d]*scale, numformat)
+            row += 1
+
+        row += 1
+        ws.write(row, 0, "Seed contributions", boldformat)
+        row += 1
+        ws.write_row(row, 0, ["Seed", "x_c (cm)", "y_c (cm)", "z_c (cm)"] +
+                     ["{0} (cGy/h/U)".format(name) for name in point_names] +
+                     ["{0} (Gy)".format(name) for name in point_names], boldformat)
+        row += 1
+        doses = seed_rate[:, d, :]*Sk_U[d]*scale
+        for s in np.arange(len(seed_centers_cm)):
+            ws.write_number(row, 0, s + 1)
+            for k in np.arange(3):
+                ws.write_number(row, 1 + k, seed_centers_cm[s, k], numformat)
+            for n in np.arange(len(point_names)):
+                ws.write_number(row, 4 + n, seed_rate[s, d, n], rateformat)
+                ws.write_number(row, 4 + len(point_names) + n, doses[s, n], numformat)
+            row += 1
+        ws.write(row, 0, "Total", boldformat)
+        for n in np.arange(len(point_names)):
+            ws.write_number(row, 4 + n, np.sum(seed_rate[:, d, n]), rateformat)
+            ws.write_number(row, 4 + len(point_names) + n, np.sum(doses[:, n]), numformat)
+    wb.close()
+    return(filename)
+
+
+def _write_coms_workbook_job(kwargs):
+    return(write_coms_workbook(**kwargs))
+
+
+def generate_coms_worksheets(models=None, files=None, out_dir="COMS_worksheets", rx_depths_cm=(0.5,), rx_dose_Gy=85.,
+                             duration_h=100., points=None, workers=1):
+    """
+    Writes out_dir/<model>/<plaque>_<model>.xlsx for every source model and plaque.
+
+    models: source model names (see jkcm_source_model_cache.load_model), default all complete
+            models in sources/.
+    files: the plaque files, default jkcm_coms_planner.plaque_files().
+    rx_depths_cm: prescription depths, one worksheet each.
+    rx_dose_Gy, duration_h: the prescription dose (Gy) and implant duration (h).
+    points: list of (name, depth_cm), default jkcm_coms_planner.STANDARD_POINTS.
+    workers: number of processes writing workbooks. 1 writes serially.
+
+    Returns the list of workbook filenames.
+    """
+    if(models is None):
+        models = list_models()
+    if(files is None):
+        files = plaque_files()
+    if(points is None):
+        points = STANDARD_POINTS
+
+    jobs = []
+    for model in models:
+        calc_obj = load_model(model)
+        res = plan_coms_batch(calc_obj, files, rx_depths_cm, [rx_dose_Gy], [duration_h], points)
+        model_dir = os.path.join(out_dir, model)
+        if(not os.path.isdir(model_dir)):
+            os.makedirs(model_dir)
+        model_info = [("Source model", str(calc_obj.source_name_model)),
+                      ("Radionuclide", str(calc_obj.radionuclide)),
+                      ("Dose rate constant (cGy/h/U)", float(calc_obj.dose_rate_constant_cGy_per_h_per_U))]
+        stops = list(res['seed_starts'][1:]) + [len(res['seed_centers_cm'])]
+        for p in np.arange(len(res['plaques'])):
+            seeds = slice(res['seed_starts'][p], stops[p])
+            jobs.append({'filename': os.path.join(model_dir, "{0}_{1}.xlsx".format(res['plaques'][p], model)),
+                         'title': _plaque_title(res['plaques'][p], calc_obj.source_name_model),
+                         'model_info': model_info,
+                         'point_names': res['point_names'],
+                         'rx_depths_cm': res['rx_depths_cm'],
+                         'rx_dose_Gy': float(rx_dose_Gy),
+                         'duration_h': float(duration_h),
+                         'effT_h': float(res['effective_time_h'][0]),
+                         'Sk_U': res['Sk_U'][p, :, 0, 0],
+                         'point_depths_cm': res['point_depths_cm'],
+                         'point_rate': res['dose_rate_cGy_per_h_per_U'][p],
+                         'seed_centers_cm': res['seed_centers_cm'][seeds],
+                         'seed_rate': res['seed_dose_rate_cGy_per_h_per_U'][seeds]})
+
+    print("writing {0} workbooks to {1}".format(len(jobs), out_dir))
+    if(workers > 1):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            return(list(pool.map(_write_coms_workbook_job, jobs)))
+    return([_write_coms_workbook_job(job) for job in jobs])
+
+
+if __name__ == "__main__":
+    filenames = generate_coms_worksheets(workers=os.cpu_count() or 1)
+    for f in filenames:
+        print(f)
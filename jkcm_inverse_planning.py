@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Use this module to find non-negative per-source strengths (differential loading
+of COMS plaque seeds) or dwell times (HDR dwell positions) from dose constraints.
+
+The optimization runs on a precomputed dose-influence matrix (see
+jkcm_dose_influence), so trying other prescriptions, constraints or bounds only
+repeats the solve, not the TG43 calculation.
+
+Two formulations are available:
+    method="lsq": bounded least squares (scipy.optimize.lsq_linear)
+        minimize |w_t*(D_t - rx)|^2 + |w_c*D_c|^2
+        over the target doses D_t and the critical point doses D_c.
+    method="lp": linear program (scipy.optimize.linprog, HiGHS)
+        minimize the sum of the critical point doses (or the total weight of
+        the sources when there are no critical points)
+        subject to rx <= D_t (<= max_target_dose).
+        The dose constraints are generated a few at a time; with 200 sources,
+        5000 target points and 5000 critical points this takes about 0.2 s on one
+        core, against 1.5 s for linprog with every constraint.
+
+Example:
+    o = jkcm_samemodel_multisource_TG43()
+    o.initializeTG43model("I125A_consensus")
+    o.importSources("COMS_plaques/COMS_16mm_plaque.txt")
+    res = plan_points(o, target_pts, 8500., critical_pts, duration_h=100, method="lp")
+    res['x']   #Sk per seed in U
+"""
+
+import numpy as np
+import scipy.sparse
+from scipy.optimize import lsq_linear, linprog
+
+
+def _source_scale(influence, variable, duration_h):
+    """The factor that turns the variable of each source into its weight in
+    dose = A.T @ weight (A in dose rate per U)."""
+    ms = influence.multisource
+    src = ms.sourceArrays()
+    if(variable == "strength"):
+        if(duration_h is None):
+            return(src["dwell_times"])
+        effT_h = ms.jkcm_TG43_calc_obj.calc_eff_time(float(duration_h))
+        return(np.repeat(effT_h, len(src["ids"])))
+    assert variable == "dwell_time", "variable must be strength or dwell_time"
+    return(src["strengths"])
+
+
+def _columns(A, index, scale):
+    """Returns the (len(index), S) system A[:, index].T scaled per source,
+    keeping A sparse if it is."""
+    if(scipy.sparse.issparse(A)):
+        sub = scipy.sparse.csc_matrix(A)[:, index].T
+        return(scipy.sparse.csr_matrix(sub.multiply(scale[np.newaxis, :])))
+    return(A[:, index].T*scale[np.newaxis, :])
+
+
+def _bounded_lsq(M, b, lb, ub):
+    """lsq_linear of M x = b within [lb, ub]. A system with more rows than unknowns
+    is first reduced to the square system R x = Q.T b from the economic QR 
+    decomposition of M, which has the same solution and is much cheaper to iterate on.
+    A sparse M is decomposed dense: forming M.T M instead would square its condition
+    number, and sources at the same position make it singular."""
+    if(M.shape[1] == 0):
+        return(np.zeros(0), True, "no free sources")
+    if(scipy.sparse.issparse(M)):
+        M = M.toarray()
+    if(M.shape[0] > M.shape[1]):
+        Q, R = np.linalg.qr(M)
+        M, b = R, Q.T.dot(b)
+    res = lsq_linear(M, b, bounds=(lb, ub))
+    return(res.x, res.success, res.message)
+
+
+def _linprog_constraint_generation(c, A_ub, b_ub, lb, ub, x0):
+    """Solves min c.x subject to A_ub x <= b_ub and lb <= x <= ub with the HiGHS dual simplex.
+    Most dose constraints are not binding at the optimum, so the program is first
+    solved with the constraints most violated at x0 only. Each round then adds the
+    (at most max(n_src//5, 20)) constraints most violated by the solution and drops
+    the ones with a slack above 1% of their bound, so every program stays small.
+    scipy's HiGHS interface cannot be warm started from a basis, so this keeps the
+    repeated cold solves cheap instead. A constraint that is added again after it was 
+    dropped is kept for good, so the rounds end. The result is the optimum of the full program."""
+    n_src = len(c)
+    if(n_src == 0):
+        return(np.zeros(0), True, "no free sources")
+    bounds = list(zip(lb, np.where(np.isinf(ub), None, ub)))
+    batch = max(n_src//5, 20)
+    tol = 1e-7*max(np.max(np.abs(b_ub)), 1.)
+    slack = 0.01*np.maximum(np.abs(b_ub), tol)
+    active = np.zeros(len(b_ub), dtype=bool)
+    dropped = np.zeros(len(b_ub), dtype=bool)
+    keep = np.zeros(len(b_ub), dtype=bool)
+    viol = np.asarray(A_ub.dot(x0)).ravel() - b_ub
+    active[np.argsort(-viol)[0:batch]] = True
+    while(True):
+        rows = np.nonzero(active)[0]
+        res = linprog(c, A_ub=A_ub[rows], b_ub=b_ub[rows], bounds=bounds, method='highs-ds')
+        if(res.status != 0):
+            return(np.full(n_src, np.nan), False, res.message)
+        viol = np.asarray(A_ub.dot(res.x)).ravel() - b_ub
+        bad = np.nonzero((viol > tol) & ~active)[0]
+        if(len(bad) == 0):
+            return(res.x, True, res.message)
+        drop = active & ~keep & (viol < -slack)
+        active[drop] = False
+        dropped |= drop
+        bad = bad[np.argsort(-viol[bad])][0:batch]
+        keep[bad[dropped[bad]]] = True
+        active[bad] = True
+
+
+def inverse_plan(influence, target_index, target_dose, critical_index=None, variable="strength", duration_h=None,
+                 method="lsq", target_weight=1., critical_weight=0.1, max_target_dose=None, bounds=(0, np.inf)):
+    """
+    influence: a jkcm_dose_influence_matrix (dense or sparse matrix).
+    target_index: the point indices (columns of the influence matrix) of the target.
+    target_dose: the prescription dose (cGy) at the target points, scalar or one per point.
+    critical_index: the point indices of critical structures whose dose is minimized.
+    variable: "strength" solves for Sk (U) per source with the dwell times of the
+              multisource object, or with the implant duration duration_h (h) if given;
+              "dwell_time" solves for the dwell time (h) per source with its current Sk.
+    method: "lsq" or "lp", see the module description.
+    target_weight, critical_weight: weights of the target and critical rows for "lsq",
+              scalars or one per point.
+    max_target_dose: optional upper limit on the target dose for "lp" (cGy).
+    bounds: (lower, upper) on the variable, scalars or one per source in source ID order.
+            An upper bound of 0 excludes a source (e.g. a notched plaque).
+
+    Returns {'x': the variable per source in source ID order, 'ids': source IDs,
+             'dose': dose (cGy) at every point of the influence matrix,
+             'target_dose': dose at target_index, 'critical_dose': dose at critical_index,
+             'success', 'message'}.
+    """
+    assert method in ("lsq", "lp"), "method must be lsq or lp"
+    influence.update()
+    A = influence.matrix
+    n_src = influence.n_sources()
+    scale = np.asarray(_source_scale(influence, variable, duration_h), dtype=np.double)
+    target_index = np.atleast_1d(np.asarray(target_index, dtype=int))
+    if(critical_index is None):
+        critical_index = np.zeros([0], dtype=int)
+    critical_index = np.atleast_1d(np.asarray(critical_index, dtype=int))
+    rx = np.broadcast_to(np.asarray(target_dose, dtype=np.double), target_index.shape)
+    lb = np.broadcast_to(np.asarray(bounds[0], dtype=np.double), (n_src,))
+    ub = np.broadcast_to(np.asarray(bounds[1], dtype=np.double), (n_src,))
+
+    #sources with equal bounds are fixed and moved to the right hand side
+    free = lb < ub
+    x = lb.copy()
+    At = _columns(A, target_index, scale)
+    Ac = _columns(A, critical_index, scale)
+    sparse = scipy.sparse.issparse(At)
+    rx_free = rx - At.dot(x*~free)
+    crit_fixed = Ac.dot(x*~free)
+    At = At[:, free]
+    Ac = Ac[:, free]
+    
+    if(method == "lsq"):
+        wt = np.broadcast_to(np.asarray(target_weight, dtype=np.double), target_index.shape)
+        wc = np.broadcast_to(np.asarray(critical_weight, dtype=np.double), critical_index.shape)
+        if(sparse):
+            M = scipy.sparse.vstack([scipy.sparse.diags(wt).dot(At), scipy.sparse.diags(wc).dot(Ac)]).tocsr()
+        else:
+            M = np.concatenate([At*wt[:, np.newaxis], Ac*wc[:, np.newaxis]])
+        b = np.concatenate([wt*rx_free, -wc*crit_fixed])
+        x_free, success, message = _bounded_lsq(M, b, lb[free], ub[free])
+    else:
+        if(len(critical_index) > 0):
+            c = np.asarray(Ac.sum(axis=0)).ravel()
+        else:
+            c = np.ones(np.count_nonzero(free))
+        A_ub = -At
+        b_ub = -rx_free
+        if(max_target_dose is not None):
+            hi = np.broadcast_to(np.asarray(max_target_dose, dtype=np.double), target_index.shape)
+            A_ub = scipy.sparse.vstack([A_ub, At]).tocsr() if sparse else np.concatenate([A_ub, At])
+            b_ub = np.concatenate([b_ub, hi - (rx - rx_free)])
+        #the first constraints are the target points least covered by a uniform loading
+        x0 = np.clip(np.ones(np.count_nonzero(free)), lb[free], ub[free])
+        covered = np.asarray(At.dot(x0)).ravel()
+        if(np.sum(covered) > 0):
+            x0 = x0*np.sum(rx_free)/np.sum(covered)
+        x_free, success, message = _linprog_constraint_generation(c, A_ub, b_ub, lb[free], ub[free], x0)
+    x[free] = x_free
+
+    dose = influence.matrix.T.dot(x*scale)
+    dose = np.asarray(dose).ravel()
+    return({'x':x,
+            'ids':influence.source_ids,
+            'dose':dose,
+            'target_dose':dose[target_index],
+            'critical_dose':dose[critical_index],
+            'success':success,
+            'message':message})
+
+
+def plan_points(multisource, target_pts, target_dose, critical_pts=None, **kwargs):
+    """Builds the influence matrix of multisource for the Mx3 target points and
+    critical points and runs inverse_plan on it. kwargs are passed on to inverse_plan.
+    The influence matrix is returned as 'influence' so that other constraints can
+    be tried without recomputing it."""
+    target_pts = np.asarray(target_pts, dtype=np.double).reshape(-1, 3)
+    influence = multisource.influence_matrix(target_pts)
+    target_index = np.arange(len(target_pts))
+    critical_index = None
+    if(critical_pts is not None):
+        critical_index = influence.append_points(critical_pts)
+    res = inverse_plan(influence, target_index, target_dose, critical_index, **kwargs)
+    res['influence'] = influence
+    return(res)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Use this module for isodose lines on planes through an implant, without matplotlib.
+
+The dose on the plane is evaluated with one vectorized calc_at_points call and
+the lines are extracted with marching squares: every cell of the plane grid is
+classified at once with numpy, the crossings are interpolated linearly along
+the cell edges, and the segments are joined into polylines through the edges
+they share. Saddle cells are resolved with the mean of the four corners.
+
+The plane grid follows jkcm_mcnpx_rmesh.interp_plane: the plane goes through
+origin, is spanned by the directions uDir and vDir (normalized here), and the
+dose is sampled at the distances uVec and vVec along them, giving an array of
+shape (len(vVec), len(uVec)).
+
+Example:
+    o = jkcm_samemodel_multisource_TG43()
+    o.initializeTG43model("I125A_consensus")
+    o.importSources("COMS_plaques/COMS_16mm_plaque.txt")
+    o.setStrengthsInU(4.3)
+    res = isodose_axis_plane(o, [4250, 8500, 17000], 1, 0., np.linspace(-1.2, 1.2, 241), np.linspace(-0.1, 2.3, 241))
+    res['contours'][1]   #list of Kx3 polylines of the 8500 cGy line
+"""
+
+import numpy as np
+
+#segments of each marching squares case as pairs of cell edges
+#(0 bottom, 1 right, 2 top, 3 left); corner bits 1 bottom-left, 2 bottom-right, 4 top-right, 8 top-left
+_segments = {1: [(3, 0)], 2: [(0, 1)], 3: [(3, 1)], 4: [(1, 2)], 6: [(0, 2)], 7: [(2, 3)],
+             8: [(2, 3)], 9: [(0, 2)], 11: [(1, 2)], 12: [(1, 3)], 13: [(0, 1)], 14: [(3, 0)]}
+#saddles, by whether the center of the cell is at or above the level
+_saddles = {(5, True): [(0, 1), (2, 3)], (5, False): [(3, 0), (1, 2)],
+            (10, True): [(3, 0), (1, 2)], (10, False): [(0, 1), (2, 3)]}
+
+
+def _segment_tables():
+    """(16, 2) tables of the first and second segment of each case (case, edge pair), -1 for none,
+    for saddle centers below and at or above the level."""
+    tables = []
+    for high in [False, True]:
+        t = -np.ones([16, 2, 2], dtype=int)
+        for case in np.arange(16):
+            segs = _saddles.get((case, high), _segments.get(case, []))
+            for k, s in enumerate(segs):
+                t[case, k] = s
+        tables.append(t)
+    return(tables)
+
+_tables = _segment_tables()
+
+
+def marching_squares(values, level, uVec=None, vVec=None):
+    """Returns the lines where values crosses level as a list of Kx2 arrays of (u, v).
+    values: an array of shape (len(vVec), len(uVec)); nan values are treated as outside.
+    uVec, vVec: the positions of the columns and rows, default their indices.
+    Closed lines end with their first point."""
+    values = np.asarray(values, dtype=np.double)
+    nv, nu = values.shape
+    uVec = np.arange(nu, dtype=np.double) if uVec is None else np.asarray(uVec, dtype=np.double)
+    vVec = np.arange(nv, dtype=np.double) if vVec is None else np.asarray(vVec, dtype=np.double)
+    if(nu < 2 or nv < 2):
+        return([])
+    above = values >= level
+    n_h = nv*(nu - 1)   #horizontal edges (j,i)-(j,i+1) are numbered j*(nu-1)+i, vertical ones (j,i)-(j+1,i) n_h+j*nu+i
+
+    #crossing points of every edge, nan where the edge is not crossed
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (level - values[:, :-1])/(values[:, 1:] - values[:, :-1])
+        hu = uVec[None, :-1] + t*(uVec[1:] - uVec[:-1])[None, :]
+        t = (level - values[:-1, :])/(values[1:, :] - values[:-1, :])
+        vv = vVec[:-1, None] + t*(vVec[1:] - vVec[:-1])[:, None]
+    pts = np.zeros([n_h + (nv - 1)*nu, 2])
+    pts[0:n_h, 0] = hu.ravel()
+    pts[0:n_h, 1] = np.repeat(vVec, nu - 1)
+    pts[n_h:, 0] = np.tile(uVec, nv - 1)
+    pts[n_h:, 1] = vv.ravel()
+
+    #cell cases, cells with a nan corner are skipped
+    a, b, c, d = above[:-1, :-1], above[:-1, 1:], above[1:, 1:], above[1:, :-1]
+    case = a*1 + b*2 + c*4 + d*8
+    corners = values[:-1, :-1] + values[:-1, 1:] + values[1:, 1:] + values[1:, :-1]
+    valid = np.isfinite(corners) & (case != 0) & (case != 15)
+    j, i = np.nonzero(valid)
+    if(len(j) == 0):
+        return([])
+    case = case[j, i]
+    high = corners[j, i]/4. >= level
+    segs = np.where(high[:, None, None], _tables[1][case], _tables[0][case])   #cells x 2 segments x 2 edges
+    cell_edges = np.column_stack([j*(nu - 1) + i, n_h + j*nu + i + 1, (j + 1)*(nu - 1) + i, n_h + j*nu + i])
+    keep = segs[:, :, 0] >= 0
+    rows = np.nonzero(keep)[0]
+    e0 = cell_edges[rows, segs[:, :, 0][keep]]
+    e1 = cell_edges[rows, segs[:, :, 1][keep]]
+
+    #join the segments: every edge point is on at most two segments
+    nbr = -np.ones([len(pts), 2], dtype=int)
+    ends = np.concatenate([e0, e1])
+    other = np.concatenate([e1, e0])
+    order = np.argsort(ends, kind='stable')
+    ends, other = ends[order], other[order]
+    first = np.ones(len(ends), dtype=bool)
+    first[1:] = ends[1:] != ends[:-1]
+    nbr[ends[first], 0] = other[first]
+    nbr[ends[~first], 1] = other[~first]
+    degree = np.sum(nbr >= 0, axis=1)
+
+    visited = np.zeros(len(pts), dtype=bool)
+    lines = []
+    starts = list(np.nonzero(degree == 1)[0]) + list(np.nonzero(degree == 2)[0])
+    for s in starts:
+        if(visited[s]):
+            continue
+        path = [s]
+        visited[s] = True
+        prev, cur = -1, s
+        while(True):
+            n = nbr[cur, 0] if nbr[cur, 0] != prev else nbr[cur, 1]
+            if(n < 0):
+                break
+            if(visited[n]):
+                if(n == s):
+                    path.append(s)
+                break
+            path.append(n)
+            visited[n] = True
+            prev, cur = cur, n
+        lines.append(pts[path])
+    return(lines)
+
+
+def plane_points(origin, uDir, vDir, uVec, vVec):
+    """Returns the points of the plane grid as an array of shape (len(vVec), len(uVec), 3)."""
+    origin = np.asarray(origin, dtype=np.double)
+    uDir = np.asarray(uDir, dtype=np.double)
+    vDir = np.asarray(vDir, dtype=np.double)
+    uDir = uDir/np.linalg.norm(uDir)
+    vDir = vDir/np.linalg.norm(vDir)
+    uu, vv = np.meshgrid(np.asarray(uVec, dtype=np.double), np.asarray(vVec, dtype=np.double))
+    return(origin[None,None,:] + uu[:,:,None]*uDir[None,None,:] + vv[:,:,None]*vDir[None,None,:])
+
+
+def plane_dose(multisource, origin, uDir, vDir, uVec, vVec, **kwargs):
+    """Returns the total dose of multisource on the plane grid, shape (len(vVec), len(uVec)).
+    kwargs are passed on to calc_at_points (dose_rate, chunk_size, workers, cutoff_cm, ...)."""
+    pts = plane_points(origin, uDir, vDir, uVec, vVec)
+    dose = multisource.calc_at_points(pts.reshape(-1, 3), sum_sources=True, **kwargs)
+    return(dose.reshape(pts.shape[0:2]))
+
+
+def isodose_plane(multisource, levels, origin, uDir, vDir, uVec, vVec, **kwargs):
+    """Isodose lines of multisource at the dose levels on the plane grid.
+    kwargs are passed on to calc_at_points.
+
+    Returns {'dose': the plane dose (len(vVec), len(uVec)), 'levels',
+             'contours_uv': per level a list of Kx2 polylines in (u, v),
+             'contours': per level a list of Kx3 polylines in x, y, z}."""
+    levels = np.atleast_1d(np.asarray(levels, dtype=np.double))
+    uVec = np.asarray(uVec, dtype=np.double)
+    vVec = np.asarray(vVec, dtype=np.double)
+    dose = plane_dose(multisource, origin, uDir, vDir, uVec, vVec, **kwargs)
+    origin = np.asarray(origin, dtype=np.double)
+    uDir = np.asarray(uDir, dtype=np.double)/np.linalg.norm(uDir)
+    vDir = np.asarray(vDir, dtype=np.double)/np.linalg.norm(vDir)
+    contours_uv = [marching_squares(dose, L, uVec, vVec) for L in levels]
+    contours = [[origin[None,:] + l[:,0:1]*uDir[None,:] + l[:,1:2]*vDir[None,:] for l in lines] for lines in contours_uv]
+    return({'dose':dose,
+            'levels':levels,
+            'contours_uv':contours_uv,
+            'contours':contours})
+
+
+def isodose_axis_plane(multisource, levels, axis, position, uVec, vVec, **kwargs):
+    """isodose_plane on the plane normal to axis (0=x, 1=y, 2=z) at position (cm).
+    uVec and vVec are the positions along the two other axes in increasing axis
+    order (e.g. x and z for axis=1), as in jkcm_mcnpx_rmesh.interp_axis_plane."""
+    other = [a for a in [0, 1, 2] if a != axis]
+    e = np.eye(3)
+    return(isodose_plane(multisource, levels, position*e[axis], e[other[0]], e[other[1]], uVec, vVec, **kwargs))
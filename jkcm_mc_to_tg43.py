@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Use this module to go from MCNPX smesh batch files to a TG43 source model directory.
+
+The pipeline has three stages:
+    combine: the batch files are averaged with add_in_quadrature and written to
+             a tally store (jkcm_tally_store) in work_dir/combined.tally
+    tables:  F(r,theta) and g_L(r) with their uncertainties are extracted with
+             F_r_theta_table and g_r_table and written to work_dir/tables.npz
+    write:   <model>_frtheta.txt, <model>_gr.txt and <model>_source_data.txt are
+             written to out_dir in the formats read by import_aniso_table,
+             import_gr_table and import_source_data
+
+Every stage records a key of its inputs in work_dir/pipeline_manifest.json and is
+skipped when the key and its outputs are unchanged, so rerunning with another
+set of radii only redoes the tables and write stages and rerunning with new
+source data only redoes the write stage. The combine stage is redone when any
+batch file changed (size and mtime, then SHA-1).
+
+Example:
+    source_data = {"seed_length_cm":0.45, "effective_source_length_cm":0.3,
+                   "seed_diameter_cm":0.08, "dose_rate_constant_cGy_per_U_per_h":0.981,
+                   "seed_model_name":"IsoAid-IAI-125A", "seed_radionuclide":"I-125"}
+    run_pipeline(glob.glob("/home/justin/I125A/mdata*"), "I125A_mc", source_data,
+                 rlist=[0.25,0.5,1,2,3,5,7], thetalist=[0.25,1,2,3,5,10,20,30,45,60,75,90],
+                 drlist=0.005, dthetalist=0.05)
+"""
+
+import hashlib
+import json
+import os
+import time
+import numpy as np
+from Import_MCNPX_output import add_in_quadrature, F_r_theta_table, g_r_table
+from jkcm_tally_store import save_tally_store, load_tally_store, is_store_current, read_store_meta
+
+SOURCES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sources")
+MANIFEST_FILENAME = "pipeline_manifest.json"
+
+#the fields of the source data file, in the order they are written
+_source_data_fields = ["seed_length_cm", "effective_source_length_cm", "seed_diameter_cm",
+                       "dose_rate_constant_cGy_per_U_per_h", "seed_model_name", "seed_radionuclide"]
+
+
+def _key(obj):
+    return(hashlib.sha1(json.dumps(obj, sort_keys=True).encode()).hexdigest())
+
+
+def _as_list(v):
+    """Tolerances and lists of radii may be scalars, lists or arrays; this makes them JSON friendly."""
+    if(np.ndim(v) == 0):
+        return(float(v))
+    return([float(x) for x in v])
+
+
+def _read_manifest(work_dir):
+    try:
+        with open(os.path.join(work_dir, MANIFEST_FILENAME), 'r') as f:
+            return(json.load(f))
+    except (OSError, ValueError):
+        return({})
+
+
+def _write_manifest(work_dir, manifest):
+    filename = os.path.join(work_dir, MANIFEST_FILENAME)
+    tmp = filename + ".tmp{0}".format(os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, filename)
+
+
+def _format_row(values, fmt):
+    return(" ".join(fmt.format(v) for v in values))
+
+
+def write_frtheta_file(filename, radii, thetas, F, comments=()):
+    """Writes an F(r,theta) table (rows are angles) in the import_aniso_table format.
+    nan entries (no dose in the bin) are written as -1."""
+    F = np.where(np.isfinite(F), F, -1)
+    with open(filename, 'w') as f:
+        for c in comments:
+            f.write("# {0}\n".format(c))
+        f.write("radius_cm:\n")
+        f.write(_format_row(radii, "{0:g}") + "\n")
+        f.write("theta_deg:\n")
+        for th in thetas:
+            f.write("{0:g}\n".format(th))
+        f.write("table: \n")
+        for j in np.arange(len(thetas)):
+            f.write(_format_row(F[j,:], "{0:.4f}") + "\n")
+
+
+def write_gr_file(filename, radii, g, comments=()):
+    """Writes a g(r) table in the import_gr_table format."""
+    with open(filename, 'w') as f:
+        for c in comments:
+            f.write("# {0}\n".format(c))
+        f.write("radius_cm g_r\n")
+        for i in np.arange(len(radii)):
+            f.write("{0:g} {1:.4f}\n".format(radii[i], g[i]))
+
+
+def write_source_data_file(filename, source_data, comments=()):
+    """Writes the source data in the import_source_data format.
+    source_data: a dictionary with the keys of the source data file
+    (seed_length_cm, effective_source_length_cm, seed_diameter_cm,
+    dose_rate_constant_cGy_per_U_per_h, seed_model_name, seed_radionuclide)."""
+    missing = [k for k in _source_data_fields if k not in source_data]
+    assert len(missing) == 0, "source_data is missing {0}".format(missing)
+    with open(filename, 'w') as f:
+        for c in comments:
+            f.write("# {0}\n".format(c))
+        for k in _source_data_fields:
+            f.write("{0}: {1}\n".format(k, source_data[k]))
+
+
+def run_pipeline(mdata_files, model_name, source_data, rlist, thetalist, g_rlist=None,
+                 drlist=0.001, dthetalist=0.001, out_dir=None, work_dir=None,
+                 weights="nps", workers=1, force=False, **import_kwargs):
+    """
+    Builds the source model directory out_dir (default sources/<model_name>) from
+    the MCNPX smesh batch files mdata_files.
+
+    model_name: used for the file names <model_name>_frtheta.txt etc.
+    source_data: dictionary written to the source data file, see write_source_data_file.
+                 effective_source_length_cm is also the L used for the geometry function.
+    rlist, thetalist: radii (cm) and angles (degrees) of the F(r,theta) table.
+    g_rlist: radii of the g(r) table, default rlist.
+    drlist, dthetalist: tolerances for matching radii and angles to bin centers,
+                        scalars or one per value (see F_r_theta_table).
+    work_dir: where the combined tally, tables and manifest are kept, default out_dir/mc_pipeline.
+    weights, workers: passed on to add_in_quadrature.
+    force: redo every stage.
+    import_kwargs: passed on to Import_MCNPX_output (e.g. MESH_NUM).
+
+    Returns {'out_dir', 'files': [frtheta, gr, source_data], 'ran': the stages that were run}.
+    """
+    assert len(mdata_files) > 0, "no mdata files given"
+    if(out_dir is None):
+        out_dir = os.path.join(SOURCES_DIR, model_name)
+    if(work_dir is None):
+        work_dir = os.path.join(out_dir, "mc_pipeline")
+    for d in [out_dir, work_dir]:
+        if(not os.path.isdir(d)):
+            os.makedirs(d)
+    if(g_rlist is None):
+        g_rlist = rlist
+    mdata_files = sorted(os.path.abspath(f) for f in mdata_files)
+    L = float(source_data["effective_source_length_cm"])
+
+    manifest = {} if force else _read_manifest(work_dir)
+    ran = []
+
+    #combine, the tally store checks the batch files themselves
+    store = os.path.join(work_dir, "combined.tally")
+    #as read back from meta.json, so that tuples compare equal to the lists they become
+    combine_params = json.loads(json.dumps({"weights": weights if isinstance(weights, str) else _as_list(weights),
+                                            "import_kwargs": import_kwargs}))
+    if(force or not is_store_current(store, mdata_files) or read_store_meta(store)["provenance"] != combine_params):
+        print("combining {0} batch files".format(len(mdata_files)))
+        tally = add_in_quadrature(mdata_files, weights=weights, workers=workers, **import_kwargs)
+        save_tally_store(store, tally, mdata_files, **combine_params)
+        ran.append("combine")
+    meta = read_store_meta(store)
+    combine_key = _key({"sha1": [rec["sha1"] for rec in meta["source_files"]], "params": meta["provenance"]})
+
+    #tables
+    tables_file = os.path.join(work_dir, "tables.npz")
+    tables_key = _key({"combine": combine_key, "rlist": _as_list(rlist), "thetalist": _as_list(thetalist),
+                       "g_rlist": _as_list(g_rlist), "drlist": _as_list(drlist),
+                       "dthetalist": _as_list(dthetalist), "L": L})
+    if(manifest.get("tables") != tables_key or not os.path.isfile(tables_file)):
+        print("extracting F(r,theta) and g(r) tables")
+        tally = load_tally_store(store)
+        F = F_r_theta_table(tally, rlist, thetalist, drlist=drlist, dthetalist=dthetalist, L=L)
+        g_drlist = drlist if (np.ndim(drlist) == 0 or g_rlist is rlist) else np.min(drlist)
+        g = g_r_table(tally, g_rlist, drlist=g_drlist, L=L)
+        np.savez(tables_file, radii_cm=np.asarray(rlist, dtype=np.double),
+                 thetas_degree=np.asarray(thetalist, dtype=np.double),
+                 F=F['F'], F_unc=F['unc'], F_r_found=F['r'], F_theta_found=F['theta'],
+                 g_radii_cm=np.asarray(g_rlist, dtype=np.double),
+                 g=g['g'], g_unc=g['unc'], g_r_found=g['r'], nps=np.double(meta["nps"] if meta.get("nps_total") is None else meta["nps_total"]))
+        manifest["tables"] = tables_key
+        _write_manifest(work_dir, manifest)
+        ran.append("tables")
+
+    #write the source model files
+    files = [os.path.join(out_dir, "{0}_{1}.txt".format(model_name, s)) for s in ["frtheta", "gr", "source_data"]]
+    write_key = _key({"tables": tables_key, "model_name": model_name,
+                      "source_data": {k: str(source_data[k]) for k in source_data}})
+    if(manifest.get("write") != write_key or not all(os.path.isfile(f) for f in files)):
+        print("writing source model {0}".format(out_dir))
+        with np.load(tables_file) as t:
+            comments = ["Generated by jkcm_mc_to_tg43 on {0}".format(time.strftime("%Y-%m-%d %H:%M:%S")),
+                        "from {0} MCNPX batch files, nps = {1:g}".format(len(mdata_files), float(t['nps']))]
+            write_frtheta_file(files[0], t['radii_cm'], t['thetas_degree'], t['F'].T,
+                               comments + ["max fractional uncertainty of F(r,theta): {0:.4f}".format(np.nanmax(t['F_unc']))])
+            write_gr_file(files[1], t['g_radii_cm'], t['g'],
+                          comments + ["max fractional uncertainty of g(r): {0:.4f}".format(np.nanmax(t['g_unc']))])
+        write_source_data_file(files[2], source_data, comments[0:1])
+        manifest["write"] = write_key
+        _write_manifest(work_dir, manifest)
+        ran.append("write")
+
+    return({'out_dir':out_dir, 'files':files, 'ran':ran})
@@ -8,8 +8,9 @@ Use this class to read in and process rmesh data output by mcnpx.
 import numpy as np
 import os
 import re
-from matplotlib.mlab import griddata
 import matplotlib.pyplot as plt
+from jkcm_tally_store import save_tally_store, load_tally_store
+from Import_MCNPX_output import _parse_values
 
 class jkcm_mcnpx_rmesh:
     """This class represents an rmesh object output by mcnpx."""
@@ -40,120 +41,230 @@ class jkcm_mcnpx_rmesh:
         
     
                 
+    def _values(self, values):
+        if(values == "tally"):
+            return(self.tally_values)
+        assert values == "unc", "values must be tally or unc"
+        return(self.unc_values)
+    
+    def interp_points(self, x, y, z, values="tally", fill_value=np.nan):
+        """Trilinear interpolation of the voxel values (taken at the voxel centers)
+        at the points (x, y, z), arrays of the same shape.
+        The bin of each point is found by index arithmetic on the bounds (uniform 
+        axes) or searchsorted (non-uniform axes); no triangulation is done.
+        Between the outer voxel centers and the mesh bounds the edge values are used,
+        points outside the mesh bounds get fill_value.
+        values: "tally" or "unc"
+        """
+        x, y, z = np.broadcast_arrays(np.asarray(x, dtype=np.double), np.asarray(y, dtype=np.double), np.asarray(z, dtype=np.double))
+        T = self._values(values)
+        ix, wx = _axis_weights(self.xc(), x.ravel())
+        iy, wy = _axis_weights(self.yc(), y.ravel())
+        iz, wz = _axis_weights(self.zc(), z.ravel())
+        #gather the 8 corners from the flat array using the strides of the mesh
+        if(not (T.flags.c_contiguous or T.flags.f_contiguous)):
+            T = np.ascontiguousarray(T)
+        flat = T.reshape(-1, order='A')
+        sx, sy, sz = [st//T.itemsize for st in T.strides]
+        ox = [ix*sx, np.minimum(ix+1, self.nx()-1)*sx]
+        oy = [iy*sy, np.minimum(iy+1, self.ny()-1)*sy]
+        oz = [iz*sz, np.minimum(iz+1, self.nz()-1)*sz]
+        fx = [1-wx, wx]
+        fy = [1-wy, wy]
+        fz = [1-wz, wz]
+        res = np.zeros(x.size)
+        for a in [0, 1]:
+            for b in [0, 1]:
+                oxy = ox[a] + oy[b]
+                fxy = fx[a]*fy[b]
+                for c in [0, 1]:
+                    res += fxy*fz[c]*flat[oxy + oz[c]]
+        outside = ~(_inside(self.xb, x.ravel()) & _inside(self.yb, y.ravel()) & _inside(self.zb, z.ravel()))
+        res[outside] = fill_value
+        return(res.reshape(x.shape))
+    
+    def interp_axis_plane(self, axis, position, uVec, vVec, values="tally", fill_value=np.nan):
+        """Bilinear/trilinear interpolation on the plane normal to axis (0=x, 1=y, 2=z)
+        at position (cm). uVec and vVec are the positions along the two other axes
+        in increasing axis order (e.g. x and z for axis=1).
+        Returns an array of shape (len(vVec), len(uVec)).
+        The interpolation is separable, so only the two slabs of the mesh next to the 
+        plane are read and the cost is O(len(uVec)*len(vVec)) plus the size of a slab."""
+        T = self._values(values)
+        bounds = [self.xb, self.yb, self.zb]
+        centers = [self.xc(), self.yc(), self.zc()]
+        other = [a for a in [0, 1, 2] if a != axis]
+        uVec = np.atleast_1d(np.asarray(uVec, dtype=np.double))
+        vVec = np.atleast_1d(np.asarray(vVec, dtype=np.double))
+        
+        i0, w = _axis_weights(centers[axis], np.array([position], dtype=np.double))
+        i1 = min(i0[0]+1, T.shape[axis]-1)
+        slab = (1-w[0])*np.take(T, i0[0], axis=axis) + w[0]*np.take(T, i1, axis=axis)
+        
+        iu, wu = _axis_weights(centers[other[0]], uVec)
+        iu1 = np.minimum(iu+1, slab.shape[0]-1)
+        slab = slab[iu,:]*(1-wu)[:,None] + slab[iu1,:]*wu[:,None]
+        iv, wv = _axis_weights(centers[other[1]], vVec)
+        iv1 = np.minimum(iv+1, slab.shape[1]-1)
+        plane = slab[:,iv]*(1-wv)[None,:] + slab[:,iv1]*wv[None,:]
+        
+        if(not _inside(bounds[axis], np.array([position]))[0]):
+            plane[:] = fill_value
+        plane[~_inside(bounds[other[0]], uVec),:] = fill_value
+        plane[:,~_inside(bounds[other[1]], vVec)] = fill_value
+        return(plane.T)
+    
+    def interp_plane(self, origin, uDir, vDir, uVec, vVec, values="tally", fill_value=np.nan):
+        """Interpolates an oblique plane through origin spanned by the directions uDir and vDir
+        (normalized here) at the distances uVec and vVec (cm) along them.
+        Returns an array of shape (len(vVec), len(uVec))."""
+        origin = np.asarray(origin, dtype=np.double)
+        uDir = np.asarray(uDir, dtype=np.double)
+        vDir = np.asarray(vDir, dtype=np.double)
+        uDir = uDir/np.linalg.norm(uDir)
+        vDir = vDir/np.linalg.norm(vDir)
+        uu, vv = np.meshgrid(np.asarray(uVec, dtype=np.double), np.asarray(vVec, dtype=np.double))
+        pts = origin[None,None,:] + uu[:,:,None]*uDir[None,None,:] + vv[:,:,None]*vDir[None,None,:]
+        return(self.interp_points(pts[:,:,0], pts[:,:,1], pts[:,:,2], values=values, fill_value=fill_value))
+    
     def griddata_yplane(self, xVec, zVec, yindex=0):
-        """return the output from griddata at the y index supplied.
+        """return the tally interpolated at the y index supplied.
         xVec: positions to plot the data (e.g. np.linspace(-10,10,200))
-        yVec: positions to plot the data"""
-        xc = self.xc()
-        zc = self.zc()
-        nx = self.nx()
-        ny = self.ny()
-        nz = self.nz()        
-        e = np.reshape(np.repeat(xc, nz), [nx, nz])
-        e1 = np.reshape(np.repeat(zc, nx), [nx, nz], order='F')
-        imgPlane = griddata(e.flatten(), e1.flatten(), o.tally_values[:,yindex,:].flatten(), xVec, zVec, interp='linear')
-        return(imgPlane)
+        zVec: positions to plot the data
+        Returns an array of shape (len(zVec), len(xVec)), nan outside the mesh."""
+        return(self.interp_axis_plane(1, self.yc()[yindex], xVec, zVec))
+        
+    def import_from_mdata_ascii(self, filename, block_size=1<<24):
+        """ Reads an mdata file written by mcnpx.
         
-    def import_from_mdata_ascii(self, filename):
-        """ Example 
+        The header and bounds are read line by line. The vals section is read in 
+        blocks of block_size bytes and parsed straight into a preallocated array 
+        of 2*nxyz doubles, so memory use is set by the mesh size rather than 
+        the size of the text file.
+        
+        Example 
         o = jkcm_mcnpx_rmesh()
         filename = "/home/justin/001m"
         o.import_from_mdata_ascii(filename)
         """
-        
-        f = open(filename, 'r')        
-        data = f.read()
-        f.close()
-        mylines = data.splitlines()
-        #get nps associated with mdata
-        self.nps = np.longlong(mylines[0].split()[5])
-        
-       
-        #find the nx,ny,nz line
-        p = re.compile('^f .*')
-        j=0
-        for i in np.arange(len(mylines)):
-           if(p.match(mylines[i])):
-               j=i
-               break
-       
-        q = mylines[j].split()
-        nxyz = np.longlong(q[1])
-        nx = np.long(q[3])
-        ny = np.long(q[4])
-        nz = np.long(q[5])
-       
-        #allocate your arrays
-        self.tally_values= np.zeros([nxyz])
-        self.unc_values=np.zeros([nxyz])
-        self.xb = np.zeros([nx+1])
-        self.yb = np.zeros([ny+1])
-        self.zb = np.zeros([nz+1])
-       
-        #read in xbounds
-        t=0
-        for i in np.arange((j+1), len(mylines)):
-           t= t + len(mylines[i].split())
-           if(t == (nx+1)):
-               break
-        temp=''
-        for k in np.arange((j+1),i+1):
-            temp += mylines[k]
-        self.xb = np.array(temp.split(), dtype=np.double)
-        print("min/max xb: {0},{1}".format(min(self.xb),max(self.xb)))
-        #read in ybounds
-        j=i
-        t=0
-        for i in np.arange((j+1), len(mylines)):
-           t= t + len(mylines[i].split())
-           if(t == (ny+1)):
-               break
-        temp=''
-        for k in np.arange((j+1),i+1):
-            temp += mylines[k]
-        self.yb = np.array(temp.split(), dtype=np.double)
-        print("min/max yb: {0},{1}".format(min(self.yb),max(self.yb)))
-        #read in zbounds
-        j=i
-        t=0
-        for i in np.arange((j+1), len(mylines)):
-           t= t + len(mylines[i].split())
-           if(t == (nz+1)):
-               break
-        temp=''
-        for k in np.arange((j+1),i+1):
-            temp += mylines[k]
-        self.zb = np.array(temp.split(), dtype=np.double)
-        print("min/max zb: {0},{1}".format(min(self.zb),max(self.zb)))
-        
-        #advance to tally values
-        p = re.compile('^vals.*')
-        j=0
-        for i in np.arange(len(mylines)):
-           if(p.match(mylines[i])):
-               j=i
-               break
-        #read everything into an array
-        tempArr = np.zeros([2*nxyz])
-        si=0
-        fi=0
-        for i in np.arange((j+1),len(mylines)):
-            temp = np.asarray(mylines[i].split(), dtype=np.double)
-            fi = si + len(temp)
-            tempArr[si:fi] = temp
-            si = fi
-        
-        #separate absobred dose and uncertainty
-        self.unc_values = tempArr[1::2].reshape([nx,ny,nz],order='F')
-        self.tally_values = tempArr[0::2].reshape([nx,ny,nz], order='F')
-        #xc = 0.5*self.xb[0:-1] + 0.5*self.xb[1:]
-        #e= np.reshape(np.repeat(xc,nz),[nx,nz])
-        #e1=np.reshape(np.repeat(zc,nx), [nx,nz], order='F')
+        with open(filename, 'rb') as f:
+            #get nps associated with mdata
+            self.nps = np.longlong(f.readline().split()[5])
+            
+            #find the nx,ny,nz line
+            line = f.readline()
+            while(line and not line.startswith(b'f ')):
+                line = f.readline()
+            assert line, "did not find the f line with the mesh dimensions"
+            q = line.split()
+            nxyz = np.longlong(q[1])
+            nx = int(q[3])
+            ny = int(q[4])
+            nz = int(q[5])
+            
+            #read in x, y and z bounds, each may span several lines
+            self.xb = _read_n_values(f, nx+1)
+            print("min/max xb: {0},{1}".format(min(self.xb),max(self.xb)))
+            self.yb = _read_n_values(f, ny+1)
+            print("min/max yb: {0},{1}".format(min(self.yb),max(self.yb)))
+            self.zb = _read_n_values(f, nz+1)
+            print("min/max zb: {0},{1}".format(min(self.zb),max(self.zb)))
             
+            #advance to tally values
+            line = f.readline()
+            while(line and not line.startswith(b'vals')):
+                line = f.readline()
+            assert line, "did not find the vals section"
             
+            #read everything into an array of alternating values and uncertainties
+            tempArr = np.empty([2*nxyz])
+            _read_values_into(f, tempArr, block_size)
         
-           
-           
-       
-       
-            
\ No newline at end of file
+        #separate absorbed dose and uncertainty
+        self.unc_values = tempArr[1::2].reshape([nx,ny,nz],order='F')
+        self.tally_values = tempArr[0::2].reshape([nx,ny,nz], order='F')
+
+    
+    def save_to_store(self, path, source_files=(), **provenance):
+        """Writes the mesh to a binary tally store (see jkcm_tally_store)."""
+        save_tally_store(path, {'tally_xyz':self.tally_values,
+                                'unc_xyz':self.unc_values,
+                                'xb':self.xb,
+                                'yb':self.yb,
+                                'zb':self.zb,
+                                'nps':self.nps}, source_files, **provenance)
+    
+    def import_from_store(self, path, mmap=True):
+        """Reads the mesh from a binary tally store (see jkcm_tally_store).
+        With mmap the tally and uncertainty arrays are read-only memory maps,
+        so only the planes that are used are read from disk."""
+        tally = load_tally_store(path, mmap=mmap)
+        self.tally_values = tally['tally_xyz']
+        self.unc_values = tally['unc_xyz']
+        self.xb = np.asarray(tally['xb'])
+        self.yb = np.asarray(tally['yb'])
+        self.zb = np.asarray(tally['zb'])
+        self.nps = np.longlong(tally['nps'])
+
+
+def _axis_weights(centers, q):
+    """Returns (i0, w) so that q lies between centers[i0] and centers[i0+1] with
+    linear weight w on centers[i0+1]. Uniformly spaced centers are handled with
+    index arithmetic, others with searchsorted. q outside the centers is clamped."""
+    n = len(centers)
+    if(n == 1):
+        return(np.zeros(len(q), dtype=np.intp), np.zeros(len(q)))
+    d = np.diff(centers)
+    if(np.allclose(d, d[0])):
+        f = (q - centers[0])/d[0]
+    else:
+        i = np.clip(np.searchsorted(centers, q, side='right') - 1, 0, n-2)
+        f = i + (q - centers[i])/d[i]
+    f = np.clip(f, 0, n-1)
+    i0 = np.minimum(f.astype(np.intp), n-2)
+    return(i0, f - i0)
+
+def _inside(bounds, q):
+    return((q >= bounds[0]) & (q <= bounds[-1]))
+
+def _read_n_values(f, n):
+    """Reads whole lines from the binary file f until n numbers were read."""
+    vals = []
+    count = 0
+    while(count < n):
+        line = f.readline()
+        assert line, "unexpected end of file while reading {0} values".format(n)
+        v = _parse_values(line)
+        vals.append(v)
+        count += len(v)
+    vals = np.concatenate(vals)
+    assert len(vals) == n, "expected {0} values, found {1}".format(n, len(vals))
+    return(vals)
+
+def _read_values_into(f, out, block_size):
+    """Fills out with the numbers read from the binary file f, block_size bytes
+    at a time. Each block is cut at its last newline and the remainder is carried
+    into the next block, so no number is split. Reading stops once out is full."""
+    n = len(out)
+    si = 0
+    rest = b''
+    while(si < n):
+        block = f.read(block_size)
+        if(block):
+            data = rest + block
+            cut = data.rfind(b'\n') + 1
+            if(cut == 0):
+                rest = data
+                continue
+            rest = data[cut:]
+            data = data[:cut]
+        else:
+            data = rest
+            rest = b''
+        v = _parse_values(data)
+        fi = min(si + len(v), n)
+        out[si:fi] = v[0:(fi-si)]
+        si = fi
+        if(not block):
+            break
+    assert si == n, "expected {0} values in the vals section, found {1}".format(n, si)
@@ -5,13 +5,22 @@ Created on Tue Sep  6 16:44:44 2016
 @author: jusmikel
 """
 
+import concurrent.futures
 import csv
 import numpy as np
 import os
 import re
-from matplotlib.mlab import griddata
 import matplotlib.pyplot as plt
 from scipy import interpolate
+from scipy.spatial import cKDTree
+from multiprocessing import shared_memory
+from jkcm_TG43_calc import jkcm_TG43_calc, read_keyed_text
+from jkcm_source_model_cache import load_model
+from jkcm_dose_influence import jkcm_dose_influence_matrix
+from jkcm_dvh import calc_dvh
+
+#default number of source-point pairs evaluated at once, bounds the temporary arrays
+PAIR_CHUNK_SIZE = 100000
 
 class jkcm_samemodel_multisource_TG43:
     """This class is used when you have multiple seeds or dwell positions 
@@ -33,6 +42,7 @@ class jkcm_samemodel_multisource_TG43:
         self.source_strength_dict = {} #each looked up value returns a single scalar
         self.dwell_time_units = "h"
         self.source_table_filename = None
+        self.last_cutoff_error_bound = None #set by calculations that drop distant sources
     
     def listSources(self):
         """This prints out the sources in order of source ID."""
@@ -50,24 +60,250 @@ class jkcm_samemodel_multisource_TG43:
         self.jkcm_TG43_calc_obj.import_aniso_table(frthetafile)
         self.jkcm_TG43_calc_obj.import_gr_table(grfile)
         self.jkcm_TG43_calc_obj.import_source_data(sourcedatafile)
+    
+    def initializeTG43model(self, name, **kwargs):
+        """Loads the source model name (e.g. "I125A_consensus") through the binary
+        source model cache. kwargs are passed on to jkcm_source_model_cache.load_model."""
+        self.jkcm_TG43_calc_obj = load_model(name, **kwargs)
      
     def calc_at_point(self, pos):
-        """This loops through all the sources changing the source position and direction and then
-        calculating the dose from each source at the given point pos. It returns an array of length N 
+        """This calculates the dose from each source at the given point pos. It returns an array of length N 
         that corresponds to the dose at pos from the sorted source ID."""
-        keys = self.source_center_dict.keys()
-        sort_keys = np.sort(list(keys))
-        result = np.zeros(len(sort_keys))
-        for i in np.arange(len(sort_keys)):
-            c = self.source_center_dict[sort_keys[i]]
-            t = self.source_tip_dict[sort_keys[i]]
-            time = self.source_dwell_time_dict[sort_keys[i]]
-            strength = self.source_strength_dict[sort_keys[i]]
-            self.jkcm_TG43_calc_obj.setSourceCenterAndTipPos(c[0],c[1],c[2], t[0],t[1],t[2])
-            result[i] = self.jkcm_TG43_calc_obj._calc_to_point(pos)*time*strength
+        return(self.calc_at_points(np.reshape(pos, (1, 3)))[:, 0])
+    
+    def influence_matrix(self, arr, **kwargs):
+        """Returns a jkcm_dose_influence_matrix of the dose per U*h from each source 
+        to the Mx3 points arr. Use it when the same points are evaluated for several 
+        strengths, dwell times or durations; it follows later moves of the sources.
+        kwargs: chunk_size, and cutoff_cm and/or dose_threshold for a sparse matrix 
+        (see jkcm_dose_influence_matrix).
         
-        return(result)
+        Example, sparse matrix of a prostate implant on a 2 mm grid:
+        m = o.influence_matrix(o.gridPoints(bounds=[[-3,3],[-3,3],[-3,3]], spacing=0.2), cutoff_cm=3.)
+        print(m.truncation_report())
+        """
+        return(jkcm_dose_influence_matrix(self, arr, **kwargs))
+    
+    def dvh(self, structures, max_dose, **kwargs):
+        """Returns the jkcm_dvh of structures (name: mask or function of points, see jkcm_dvh)
+        accumulated over the grid chunk by chunk, so the dose grid is never held in memory.
+        kwargs: the grid (x, y, z or bounds and spacing), n_bins, dose_rate, chunk_size,
+        cutoff_cm and far_field, see jkcm_dvh.calc_dvh.
+        
+        Example:
+        h = o.dvh({"tumor": sphere([0,0,0.25], 0.3)}, 50000., bounds=[[-1,1],[-1,1],[0,1]], spacing=0.05)
+        h.metrics(D=[90], V=[8500])
+        """
+        return(calc_dvh(self, structures, max_dose=max_dose, **kwargs))
+    
+    def gridPoints(self, x=None, y=None, z=None, bounds=None, spacing=None):
+        """Returns the voxels of the grid defined by gridAxes as an Nx3 array in 
+        C order (x slowest, z fastest), the order used by iter_dose_grid_chunks."""
+        xa, ya, za = self.gridAxes(x, y, z, bounds, spacing)
+        g = np.meshgrid(xa, ya, za, indexing='ij')
+        return(np.column_stack([g[0].ravel(), g[1].ravel(), g[2].ravel()]))
+    
+    def sourceArrays(self):
+        """Returns the sources as arrays in order of source ID:
+        {"ids":S, "centers":Sx3, "tips":Sx3, "dwell_times":S, "strengths":S}"""
+        sort_keys = np.sort(list(self.source_center_dict.keys()))
+        return({"ids":sort_keys,
+                "centers":np.array([self.source_center_dict[i] for i in sort_keys], dtype=np.double).reshape(-1, 3),
+                "tips":np.array([self.source_tip_dict[i] for i in sort_keys], dtype=np.double).reshape(-1, 3),
+                "dwell_times":np.array([self.source_dwell_time_dict[i] for i in sort_keys], dtype=np.double),
+                "strengths":np.array([self.source_strength_dict[i] for i in sort_keys], dtype=np.double)})
+    
+    def calc_at_points(self, arr, sum_sources=False, chunk_size=PAIR_CHUNK_SIZE, dose_rate=False, workers=1, executor="process",
+                       cutoff_cm=None, far_field="drop"):
+        """This calculates the dose from all sources to all points in one vectorized pass.
+        
+        arr: an Mx3 array of points (same units as the source positions, typically cm).
+        sum_sources: if True the contributions of all sources are summed.
+        chunk_size: the number of source-point pairs evaluated at once. This bounds 
+        the size of the temporary arrays.
+        dose_rate: if True the dose rate is returned instead of the dose (i.e. dwell times are not applied).
+        workers: number of processes (or threads) to split the points over. 1 runs serially.
+        executor: "process" or "thread", see _calc_tiles.
+        cutoff_cm: if set, only sources whose centers are within cutoff_cm of a point
+        are evaluated with the full 2D formalism. The sources near each point are found
+        with a KD-tree over the source centers.
+        far_field: what to do with sources beyond cutoff_cm:
+            "drop": ignore them. An upper bound on the dose that was dropped at any 
+            point is stored in last_cutoff_error_bound.
+            "point": use the 1D point source approximation (calc_point_source_rate).
+        
+        Returns an SxM array of the dose at each point from the sorted source ID,
+        or an array of length M if sum_sources is True."""
+        arr = np.asarray(arr, dtype=np.double).reshape(-1, 3)
+        state = self._tileState(sum_sources, chunk_size, dose_rate, cutoff_cm, far_field)
+        state["points"] = arr
+        if(sum_sources):
+            shape = (len(arr),)
+        else:
+            shape = (len(state["weight"]), len(arr))
+        
+        tile = max(len(arr), 1)
+        if(workers > 1 and len(arr) > 1):
+            tile = int(np.ceil(len(arr)/(4.*workers)))
+        return(self._calc_tiles(state, shape, len(arr), tile, workers, executor))
+    
+    def _sourceWeights(self, src, dose_rate):
+        if(dose_rate):
+            return(src["strengths"])
+        return(src["dwell_times"]*src["strengths"])
+    
+    def _tileState(self, sum_sources, chunk_size, dose_rate, cutoff_cm, far_field):
+        """Collects everything _calc_tile needs into a dictionary."""
+        src = self.sourceArrays()
+        state = {"calc_obj":self.jkcm_TG43_calc_obj,
+                 "centers":src["centers"],
+                 "tips":src["tips"],
+                 "weight":self._sourceWeights(src, dose_rate),
+                 "sum_sources":sum_sources,
+                 "chunk_size":chunk_size,
+                 "points":None,
+                 "axes":None,
+                 "cutoff_cm":cutoff_cm,
+                 "far_field":far_field}
+        if(cutoff_cm is not None):
+            assert far_field in ("drop", "point"), "far_field must be drop or point"
+            if(far_field == "drop"):
+                state["tree"] = cKDTree(src["centers"])
+                state["max_far_rate"] = self.jkcm_TG43_calc_obj.max_rate_beyond(cutoff_cm)
+            else:
+                #build the 1D table here so each worker does not have to
+                self.jkcm_TG43_calc_obj.calc_point_source_rate(1.)
+        return(state)
+    
+    def _calc_tiles(self, state, shape, n_points, tile, workers, executor):
+        """Evaluates the points in tiles of length tile, serially if workers is 1, 
+        otherwise on a pool of workers. Every tile writes its own slice of the output,
+        so the result does not depend on the order in which tiles finish.
+        
+        executor="thread" shares all arrays directly; NumPy releases the GIL in the
+        heavy array operations.
+        executor="process" pickles the source model once per worker process and 
+        passes the points and the output through shared memory, so only the tile
+        bounds are sent per task. On platforms that spawn processes this module 
+        must be importable by the workers.
+        """
+        starts = np.arange(0, n_points, tile)
+        stops = np.minimum(starts + tile, n_points)
+        
+        if(workers <= 1 or len(starts) <= 1):
+            state["out"] = np.zeros(shape)
+            bounds = [_calc_tile(state, si, fi) for si, fi in zip(starts, stops)]
+            result = state["out"]
+        elif(executor == "thread"):
+            state["out"] = np.zeros(shape)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                bounds = list(pool.map(lambda si, fi: _calc_tile(state, si, fi), starts, stops))
+            result = state["out"]
+        else:
+            assert executor == "process", "executor must be process or thread"
+            blocks = []
+            try:
+                out_shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape))*8, 8))
+                blocks.append(out_shm)
+                pts_spec = None
+                if(state["points"] is not None):
+                    pts_shm = shared_memory.SharedMemory(create=True, size=max(state["points"].nbytes, 8))
+                    blocks.append(pts_shm)
+                    np.ndarray(state["points"].shape, dtype=np.double, buffer=pts_shm.buf)[:] = state["points"]
+                    pts_spec = (pts_shm.name, state["points"].shape)
+                
+                shared_state = dict(state)
+                shared_state["points"] = None
+                with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_parallel_init,
+                                                            initargs=(shared_state, pts_spec, (out_shm.name, shape))) as pool:
+                    bounds = list(pool.map(_parallel_tile, starts, stops))
                 
+                out = np.ndarray(shape, dtype=np.double, buffer=out_shm.buf)
+                result = out.copy()
+                del out
+            finally:
+                for b in blocks:
+                    b.close()
+                    b.unlink()
+        
+        if(state["cutoff_cm"] is not None and state["far_field"] == "drop"):
+            self.last_cutoff_error_bound = max(bounds + [0.])
+        else:
+            self.last_cutoff_error_bound = None
+        return(result)
+    
+    def gridAxes(self, x=None, y=None, z=None, bounds=None, spacing=None):
+        """Returns the grid axes [x, y, z] either as given or generated from
+        bounds = [[xmin,xmax],[ymin,ymax],[zmin,zmax]] and spacing (a scalar 
+        or one value per axis). Generated axes include both bounds when the
+        spacing divides the range."""
+        if(bounds is None):
+            assert x is not None and y is not None and z is not None, "please supply x, y, z or bounds and spacing"
+            return([np.asarray(x, dtype=np.double), np.asarray(y, dtype=np.double), np.asarray(z, dtype=np.double)])
+        
+        assert spacing is not None, "please supply the grid spacing with bounds"
+        bounds = np.asarray(bounds, dtype=np.double).reshape(3, 2)
+        spacing = np.broadcast_to(np.asarray(spacing, dtype=np.double), (3,))
+        axes = []
+        for k in np.arange(3):
+            n = int(np.floor((bounds[k, 1] - bounds[k, 0])/spacing[k] + 1e-9)) + 1
+            axes.append(bounds[k, 0] + spacing[k]*np.arange(n))
+        return(axes)
+    
+    def iter_dose_grid_chunks(self, x=None, y=None, z=None, bounds=None, spacing=None, dose_rate=False, chunk_size=50000,
+                              cutoff_cm=None, far_field="drop"):
+        """This evaluates the dose on the grid defined by gridAxes in chunks of 
+        chunk_size voxels. It yields (si, fi, dose) where dose holds the dose at 
+        voxels si to fi-1 of the grid flattened in C order (x slowest, z fastest).
+        Only one chunk of points and doses is held in memory at a time."""
+        xa, ya, za = self.gridAxes(x, y, z, bounds, spacing)
+        shape = (len(xa), len(ya), len(za))
+        n_voxels = shape[0]*shape[1]*shape[2]
+        pts = np.zeros([min(chunk_size, n_voxels), 3])
+        for si in np.arange(0, n_voxels, chunk_size):
+            fi = min(si+chunk_size, n_voxels)
+            ix, iy, iz = np.unravel_index(np.arange(si, fi), shape)
+            p = pts[0:(fi-si)]
+            p[:, 0] = xa[ix]
+            p[:, 1] = ya[iy]
+            p[:, 2] = za[iz]
+            yield(si, fi, self.calc_at_points(p, sum_sources=True, dose_rate=dose_rate, cutoff_cm=cutoff_cm, far_field=far_field))
+    
+    def calc_dose_grid(self, x=None, y=None, z=None, bounds=None, spacing=None, dose_rate=False, chunk_size=50000, workers=1, executor="process",
+                       cutoff_cm=None, far_field="drop"):
+        """This returns the total dose (or the dose rate if dose_rate is True) from all
+        sources on a 3D grid as an array of shape (len(x), len(y), len(z)).
+        
+        The grid is given either by the axis vectors x, y, z or by bounds and spacing 
+        (see gridAxes). It is evaluated chunk_size voxels at a time so the temporary 
+        memory does not grow with the size of the grid. With workers > 1 the chunks 
+        are distributed over a pool of processes (or threads), see _calc_tiles; each
+        worker then holds the temporaries of at most chunk_size voxels (and at most
+        PAIR_CHUNK_SIZE source-point pairs) at a time, as in the serial path.
+        cutoff_cm and far_field limit which sources are fully evaluated, see calc_at_points.
+        
+        Example:
+        dose = o.calc_dose_grid(bounds=[[-1.2,1.2],[-1.2,1.2],[-0.1,2.2]], spacing=0.1, workers=8)
+        """
+        xa, ya, za = self.gridAxes(x, y, z, bounds, spacing)
+        shape = (len(xa), len(ya), len(za))
+        n_voxels = shape[0]*shape[1]*shape[2]
+        if(workers > 1 and n_voxels > chunk_size):
+            pairs = min(PAIR_CHUNK_SIZE, chunk_size*max(len(self.source_center_dict), 1))
+            state = self._tileState(True, pairs, dose_rate, cutoff_cm, far_field)
+            state["axes"] = (xa, ya, za)
+            return(self._calc_tiles(state, (n_voxels,), n_voxels, chunk_size, workers, executor).reshape(shape))
+        
+        result = np.zeros(n_voxels)
+        bound = 0.
+        for si, fi, dose in self.iter_dose_grid_chunks(xa, ya, za, dose_rate=dose_rate, chunk_size=chunk_size,
+                                                       cutoff_cm=cutoff_cm, far_field=far_field):
+            result[si:fi] = dose
+            if(self.last_cutoff_error_bound is not None):
+                bound = max(bound, self.last_cutoff_error_bound)
+        if(cutoff_cm is not None and far_field == "drop"):
+            self.last_cutoff_error_bound = bound
+        return(result.reshape(shape))
         
     def importSources(self, filename):
         """ This imports sources from a text file that is of the following format:
@@ -82,25 +318,15 @@ class jkcm_samemodel_multisource_TG43:
         I use whitespace delimiters. The last two columns (dwelltime) and (airkermastrength) are optional.
         sourceid sourcecenterx sourcecentery sourcecenterz sourcetipx sourcetipy sourcetipz angle 
         """
-        f = open(filename, 'r')        
-        data = f.read()
-        f.close()
         self.source_table_filename = filename
-        mylines = data.splitlines()
-        mylines = self.jkcm_TG43_calc_obj.remove_comments(mylines, "#")
-        print("header in file: {0}".format(mylines[0]))
-        for row in mylines[1:]:
-            q = row.split()
-            qid = np.int(q[0])
-            qxc = q[1]
-            qyc = q[2]
-            qzc = q[3]
-            qxt = q[4]
-            qyt = q[5]
-            qzt = q[6]
-            #ignore the other points in records
-            self.source_center_dict[qid] = np.array([qxc,qyc,qzc], dtype=np.float)/10.
-            self.source_tip_dict[qid] = np.array([qxt,qyt,qzt], dtype=np.float)/10.
+        rows, fields = read_keyed_text(filename, "#")
+        print("header in file: {0}".format(" ".join(rows[0])))
+        #ignore the other points in records
+        table = np.array([row[0:7] for row in rows[1:]], dtype=np.double).reshape(-1, 7)
+        for i in np.arange(len(table)):
+            qid = int(table[i, 0])
+            self.source_center_dict[qid] = table[i, 1:4]/10.
+            self.source_tip_dict[qid] = table[i, 4:7]/10.
             self.source_dwell_time_dict[qid] = 1.
             self.source_strength_dict[qid] = 1.
     
@@ -108,11 +334,79 @@ class jkcm_samemodel_multisource_TG43:
         """ Sk should be in U. It is applied to all seeds in the collection"""
         for i in self.source_strength_dict.keys():
             self.source_strength_dict[i] = Sk
+
+
+def _calc_tile(state, si, fi):
+    """Evaluates the dose from all sources to points si to fi-1 and writes it 
+    into state["out"]. The points are either state["points"] or the voxels of 
+    the grid state["axes"] flattened in C order.
     
-            
-        
-        
+    Returns the upper bound on the dose dropped at any of the points when 
+    distant sources are dropped, otherwise 0."""
+    if(state["axes"] is None):
+        pts = state["points"][si:fi]
+    else:
+        xa, ya, za = state["axes"]
+        ix, iy, iz = np.unravel_index(np.arange(si, fi), (len(xa), len(ya), len(za)))
+        pts = np.column_stack((xa[ix], ya[iy], za[iz]))
+    
+    calc_obj = state["calc_obj"]
+    centers = state["centers"]
+    tips = state["tips"]
+    weight = state["weight"]
+    out = state["out"]
+    cutoff = state["cutoff_cm"]
+    bound = 0.
+    step = max(int(state["chunk_size"]//max(len(weight), 1)), 1)
+    for ci in np.arange(0, len(pts), step):
+        cf = min(ci+step, len(pts))
+        p = pts[ci:cf]
+        if(cutoff is None):
+            per_Sk = calc_obj.calc_to_points_from_sources(centers, tips, p)
+        elif(state["far_field"] == "drop"):
+            pairs = state["tree"].sparse_distance_matrix(cKDTree(p), cutoff, output_type='ndarray')
+            src_index = pairs['i']
+            pt_index = pairs['j']
+            per_Sk = np.zeros([len(weight), len(p)])
+            per_Sk[src_index, pt_index] = calc_obj.calc_to_pairs_from_sources(centers, tips, p, src_index, pt_index)
+            near_weight = np.bincount(pt_index, weights=weight[src_index], minlength=len(p))
+            if(len(p) > 0):
+                bound = max(bound, state["max_far_rate"]*np.max(np.sum(weight) - near_weight))
+        else:
+            r2 = np.zeros([len(weight), len(p)])
+            for k in np.arange(3):
+                d = p[np.newaxis, :, k] - centers[:, k, np.newaxis]
+                r2 += d*d
+            r = np.sqrt(r2)
+            near = r <= cutoff
+            src_index, pt_index = np.nonzero(near)
+            per_Sk = np.empty([len(weight), len(p)])
+            per_Sk[src_index, pt_index] = calc_obj.calc_to_pairs_from_sources(centers, tips, p, src_index, pt_index)
+            far = ~near
+            per_Sk[far] = calc_obj.calc_point_source_rate(r[far])
         
+        per_Sk *= weight[:, np.newaxis]
+        if(state["sum_sources"]):
+            #summing over axis 0 adds the sources in order for every point, so
+            #the result does not depend on how the points were tiled
+            out[(si+ci):(si+cf)] = per_Sk.sum(axis=0)
+        else:
+            out[:, (si+ci):(si+cf)] = per_Sk
+    return(bound)
 
-        
-        
\ No newline at end of file
+_worker_state = {}
+
+def _parallel_init(state, pts_spec, out_spec):
+    """Process pool initializer: attaches to the shared input and output arrays."""
+    _worker_state.clear()
+    _worker_state.update(state)
+    if(pts_spec is not None):
+        shm = shared_memory.SharedMemory(name=pts_spec[0])
+        _worker_state["_pts_shm"] = shm
+        _worker_state["points"] = np.ndarray(pts_spec[1], dtype=np.double, buffer=shm.buf)
+    shm = shared_memory.SharedMemory(name=out_spec[0])
+    _worker_state["_out_shm"] = shm
+    _worker_state["out"] = np.ndarray(out_spec[1], dtype=np.double, buffer=shm.buf)
+
+def _parallel_tile(si, fi):
+    return(_calc_tile(_worker_state, si, fi))
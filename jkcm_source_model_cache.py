@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Use this module to load TG43 source models from a compiled binary cache.
+
+A source model is a directory under sources/ holding the three text files read by
+jkcm_TG43_calc:
+    <model>_frtheta.txt      (import_aniso_table)
+    <model>_gr.txt           (import_gr_table)
+    <model>_source_data.txt  (import_source_data)
+
+The first load parses the text files and writes the parsed tables (and any dose
+rate kernel that was requested) to an .npz file. Later loads read the .npz file
+only. The cache is rebuilt when any of the text files changed: a file whose
+modification time and size match the cache is trusted, otherwise its SHA-1 hash
+is compared with the hash stored in the cache.
+
+Example:
+    from jkcm_source_model_cache import load_model
+    o = load_model("I125A_consensus")
+    o.setSourceCenterAndTipPos(0,0,0, 0,0,0.225)
+    o.calc_to_points(pts)
+"""
+
+import glob
+import hashlib
+import os
+import numpy as np
+from jkcm_TG43_calc import jkcm_TG43_calc, jkcm_frtheta_interp, jkcm_gr_interp
+
+CACHE_VERSION = 2
+CACHE_SUFFIX = "_tg43cache.npz"
+SOURCES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sources")
+
+_scalar_fields = ["seed_length_cm", "eff_source_length_cm", "seed_diameter_cm",
+                  "dose_rate_constant_cGy_per_h_per_U"]
+_string_fields = ["source_name_model", "radionuclide"]
+_table_fields = ["aniso_table_thetas_degree", "aniso_table_radii_cm", "aniso_table",
+                 "g_r_radii_cm", "g_r_table"]
+_kernel_fields = ["dose_rate_kernel", "dose_rate_kernel_r0_cm", "dose_rate_kernel_dr_cm",
+                  "dose_rate_kernel_dtheta_degree", "dose_rate_kernel_max_rel_dev"]
+#kernels are stored with their build_dose_rate_kernel arguments and the g(r) interpolation
+#baked into them, [dr_cm, dtheta_deg, r_min_cm, r_max_cm, g_r_kind code] (nan for None),
+#so that a request can be matched to a cached kernel
+_g_r_kind_codes = {"linear": 0., "loglinear": 1.}
+_kernel_record_fields = _kernel_fields + ["kernel_args"]
+_model_patterns = ["*_frtheta.txt", "*_gr.txt", "*_source_data.txt"]
+
+
+def model_files(model_dir):
+    """Returns the [frtheta, gr, source_data] filenames in model_dir."""
+    files = []
+    for pattern in _model_patterns:
+        found = glob.glob(os.path.join(model_dir, pattern))
+        assert len(found) == 1, "expected one {0} file in {1}, found {2}".format(pattern, model_dir, len(found))
+        files.append(found[0])
+    return(files)
+
+
+def list_models(sources_dir=None):
+    """Returns the names of the complete source models (one frtheta, gr and
+    source_data file each) under sources_dir, default sources/."""
+    if(sources_dir is None):
+        sources_dir = SOURCES_DIR
+    names = []
+    for name in sorted(os.listdir(sources_dir)):
+        d = os.path.join(sources_dir, name)
+        if(os.path.isdir(d) and all(len(glob.glob(os.path.join(d, pattern))) == 1
+                                    for pattern in _model_patterns)):
+            names.append(name)
+    return(names)
+
+
+def _sha1(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return(h.hexdigest())
+
+
+def _file_stamp(filename):
+    st = os.stat(filename)
+    return(st.st_mtime_ns, st.st_size)
+
+
+def cache_filename(model_dir, cache_dir=None):
+    """The cache lives next to the text files unless cache_dir is given."""
+    name = os.path.basename(os.path.normpath(model_dir))
+    if(cache_dir is None):
+        return(os.path.join(model_dir, name + CACHE_SUFFIX))
+    return(os.path.join(cache_dir, name + CACHE_SUFFIX))
+
+
+def _cache_is_valid(cache, files):
+    """Returns (valid, stamps_changed). stamps_changed is True when a file was
+    touched but its contents did not change, so the cache should be rewritten
+    with the new modification times."""
+    if(int(cache["cache_version"]) != CACHE_VERSION):
+        return(False, False)
+    if(list(cache["source_files"]) != [os.path.basename(f) for f in files]):
+        return(False, False)
+    stamps_changed = False
+    for i in np.arange(len(files)):
+        mtime_ns, size = _file_stamp(files[i])
+        if(mtime_ns == int(cache["source_mtime_ns"][i]) and size == int(cache["source_size"][i])):
+            continue
+        if(_sha1(files[i]) != str(cache["source_sha1"][i])):
+            return(False, False)
+        stamps_changed = True
+    return(True, stamps_changed)
+
+
+def _read_cache(filename):
+    with np.load(filename, allow_pickle=False) as f:
+        return({k: f[k] for k in f.files})
+
+
+def _write_cache(filename, o, files, kernels):
+    """Writes the parsed tables of o and the kernels (a list of dictionaries with
+    the _kernel_record_fields) to filename. The file is written next to its final name
+    and renamed, so readers never see a partially written cache."""
+    data = {"cache_version": np.array(CACHE_VERSION),
+            "source_files": np.array([os.path.basename(f) for f in files]),
+            "source_mtime_ns": np.array([_file_stamp(f)[0] for f in files], dtype=np.int64),
+            "source_size": np.array([_file_stamp(f)[1] for f in files], dtype=np.int64),
+            "source_sha1": np.array([_sha1(f) for f in files])}
+    for k in _scalar_fields:
+        data[k] = np.array(getattr(o, k), dtype=np.double)
+    for k in _string_fields:
+        data[k] = np.array(getattr(o, k))
+    for k in _table_fields:
+        data[k] = np.asarray(getattr(o, k), dtype=np.double)
+    data["n_kernels"] = np.array(len(kernels))
+    for i in np.arange(len(kernels)):
+        for k in _kernel_record_fields:
+            data["{0}_{1}".format(k, i)] = np.asarray(kernels[i][k], dtype=np.double)
+
+    tmp = filename + ".tmp{0}".format(os.getpid())
+    with open(tmp, 'wb') as f:
+        np.savez(f, **data)
+    os.replace(tmp, filename)
+
+
+def _model_from_cache(cache, files, g_r_kind):
+    o = jkcm_TG43_calc()
+    for k in _scalar_fields:
+        setattr(o, k, float(cache[k]))
+    for k in _string_fields:
+        setattr(o, k, str(cache[k]))
+    for k in _table_fields:
+        setattr(o, k, cache[k])
+    o.aniso_filename, o.g_r_filename, o.source_data_filename = files
+    o.aniso_interp_table_obj = jkcm_frtheta_interp(o.aniso_table_radii_cm, o.aniso_table_thetas_degree, o.aniso_table)
+    o.g_r_interp_table_obj = jkcm_gr_interp(o.g_r_radii_cm, o.g_r_table, kind=g_r_kind)
+    return(o)
+
+
+def _cached_kernels(cache):
+    kernels = []
+    if("n_kernels" not in cache):
+        return(kernels)
+    for i in np.arange(int(cache["n_kernels"])):
+        kernels.append({k: cache["{0}_{1}".format(k, i)] for k in _kernel_record_fields})
+    return(kernels)
+
+
+def load_model(name, sources_dir=None, cache_dir=None, g_r_kind="linear", kernel=None):
+    """
+    Returns a jkcm_TG43_calc object with the tables of the source model name loaded.
+
+    name: the model directory under sources_dir (e.g. "I125A_consensus"), or a path to a model directory.
+    sources_dir: the directory holding the model directories, default is sources/ next to this file.
+    cache_dir: where to keep the cache file, default is the model directory.
+    g_r_kind: "linear" or "loglinear" interpolation of g(r).
+    kernel: None, or a dictionary of build_dose_rate_kernel arguments (e.g. {"dr_cm":0.01, "dtheta_deg":0.25}).
+        The kernel is taken from the cache when one was built with the same arguments and g_r_kind,
+        otherwise it is built and added to the cache. use_dose_rate_kernel is set on the returned object.
+    """
+    if(sources_dir is None):
+        sources_dir = SOURCES_DIR
+    model_dir = os.path.join(sources_dir, name)
+    if(not os.path.isdir(model_dir) and os.path.isdir(name)):
+        model_dir = name
+    assert os.path.isdir(model_dir), "did not find source model directory {0}".format(model_dir)
+    files = model_files(model_dir)
+    cfile = cache_filename(model_dir, cache_dir)
+
+    cache = None
+    rewrite = False
+    if(os.path.isfile(cfile)):
+        try:
+            cache = _read_cache(cfile)
+            valid, rewrite = _cache_is_valid(cache, files)
+        except (OSError, ValueError, KeyError):
+            valid = False
+        if(not valid):
+            cache = None
+
+    if(cache is None):
+        print("building source model cache: {0}".format(cfile))
+        o = jkcm_TG43_calc()
+        o.import_aniso_table(files[0])
+        o.import_gr_table(files[1], kind=g_r_kind)
+        o.import_source_data(files[2])
+        kernels = []
+        rewrite = True
+    else:
+        o = _model_from_cache(cache, files, g_r_kind)
+        kernels = _cached_kernels(cache)
+
+    if(kernel is not None):
+        args = {"dr_cm":0.01, "dtheta_deg":0.25, "r_min_cm":None, "r_max_cm":None}
+        args.update(kernel)
+        key = np.array([args["dr_cm"], args["dtheta_deg"], args["r_min_cm"], args["r_max_cm"],
+                        _g_r_kind_codes[g_r_kind]], dtype=np.double)
+        found = None
+        for k in kernels:
+            if(np.shape(k["kernel_args"]) == key.shape and np.allclose(k["kernel_args"], key, equal_nan=True)):
+                found = k
+                break
+        if(found is None):
+            o.build_dose_rate_kernel(**args)
+            found = {k: getattr(o, k) for k in _kernel_fields}
+            found["kernel_args"] = key
+            kernels.append(found)
+            rewrite = True
+        else:
+            o.dose_rate_kernel = found["dose_rate_kernel"]
+            for k in _kernel_fields[1:]:
+                setattr(o, k, float(found[k]))
+        o.use_dose_rate_kernel = True
+
+    if(rewrite):
+        try:
+            _write_cache(cfile, o, files, kernels)
+        except OSError as e:
+            print("could not write source model cache {0}: {1}".format(cfile, e))
+    return(o)
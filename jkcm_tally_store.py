@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Use this module to keep MCNPX mesh tallies in a binary store instead of re-parsing ASCII.
+
+A store is a directory holding one .npy file per array and a meta.json file:
+    tally_xyz.npy, unc_xyz.npy   (nx, ny, nz), in the order they were imported
+    xb.npy, yb.npy, zb.npy       voxel boundaries
+    meta.json                    nps, dims, the list of arrays and provenance
+                                 (source files with size, mtime and SHA-1, import arguments)
+
+load_tally_store memory maps the arrays, so loading takes milliseconds and only
+the parts of the mesh that are indexed (e.g. the (r, theta) rows used by F_r_theta
+and g_r, or a y-plane) are read from disk. The dictionary it returns has the same
+keys as Import_MCNPX_output, so it can be passed to F_r_theta, g_r and list_F_r_theta.
+
+Example:
+    from jkcm_tally_store import MCNPX_output_to_store
+    o = MCNPX_output_to_store("/home/justin/mdata01")  #converts once, later calls only load
+    F_r_theta(o, 1, 30)
+"""
+
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+STORE_VERSION = 1
+STORE_SUFFIX = ".tally"
+META_FILENAME = "meta.json"
+
+
+def _sha1(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return(h.hexdigest())
+
+
+def _source_record(filename):
+    st = os.stat(filename)
+    return({"filename": os.path.abspath(filename),
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "sha1": _sha1(filename)})
+
+
+def _json_number(v):
+    """nps may be a numpy integer or a float (summed over batches)."""
+    v = float(v)
+    if(v.is_integer()):
+        return(int(v))
+    return(v)
+
+
+def store_path(filename, mesh_num=1):
+    """The default store for mesh mesh_num of filename, next to filename."""
+    if(mesh_num == 1):
+        return(filename + STORE_SUFFIX)
+    return("{0}_mesh{1}{2}".format(filename, mesh_num, STORE_SUFFIX))
+
+
+def save_tally_store(path, tally, source_files=(), **provenance):
+    """
+    Writes a tally to the store directory path.
+    tally: a dictionary from Import_MCNPX_output or add_in_quadrature. Every numpy
+           array in it is written to its own .npy file.
+    source_files: the files the tally was imported from, recorded so that
+                  is_store_current can tell when the store is out of date.
+    provenance: any other JSON serializable values to record (e.g. DOSE_FACTOR=1.0).
+    meta.json is removed first and written last, so a store whose write was
+    interrupted is never loaded.
+    """
+    if(not os.path.isdir(path)):
+        os.makedirs(path)
+    meta_file = os.path.join(path, META_FILENAME)
+    if(os.path.isfile(meta_file)):
+        os.remove(meta_file)
+
+    arrays = []
+    for k in sorted(tally.keys()):
+        if(isinstance(tally[k], np.ndarray)):
+            np.save(os.path.join(path, k + ".npy"), tally[k])
+            arrays.append(k)
+    assert "tally_xyz" in arrays, "tally has no tally_xyz array"
+
+    meta = {"store_version": STORE_VERSION,
+            "arrays": arrays,
+            "nps": _json_number(tally["nps"]) if "nps" in tally else None,
+            "nps_total": _json_number(tally["nps_total"]) if "nps_total" in tally else None,
+            "dims": [int(n) for n in tally["tally_xyz"].shape],
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "source_files": [_source_record(f) for f in source_files],
+            "provenance": provenance}
+    tmp = meta_file + ".tmp{0}".format(os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(tmp, meta_file)
+
+
+def read_store_meta(path):
+    """Returns the contents of meta.json of the store at path."""
+    with open(os.path.join(path, META_FILENAME), 'r') as f:
+        meta = json.load(f)
+    assert meta["store_version"] == STORE_VERSION, "unsupported tally store version in {0}".format(path)
+    return(meta)
+
+
+def load_tally_store(path, mmap=True):
+    """
+    Returns the tally in the store at path as a dictionary with the keys of
+    Import_MCNPX_output (tally_xyz, unc_xyz, xb, yb, zb, nps, dims) plus meta, and
+    nps_total for a tally combined by add_in_quadrature.
+    mmap: if True the arrays are read-only memory maps and only the elements
+          that are indexed are read, otherwise the arrays are read into memory.
+    """
+    meta = read_store_meta(path)
+    mode = 'r' if mmap else None
+    tally = {}
+    for k in meta["arrays"]:
+        tally[k] = np.load(os.path.join(path, k + ".npy"), mmap_mode=mode, allow_pickle=False)
+    tally["nps"] = meta["nps"]
+    if(meta.get("nps_total") is not None):
+        tally["nps_total"] = meta["nps_total"]
+    tally["dims"] = list(meta["dims"])
+    tally["meta"] = meta
+    return(tally)
+
+
+def is_store_current(path, source_files):
+    """True when the store at path exists and was written from source_files as they
+    are now. A file whose size and modification time match is trusted, otherwise its
+    SHA-1 hash is compared."""
+    try:
+        meta = read_store_meta(path)
+    except (OSError, ValueError, KeyError, AssertionError):
+        return(False)
+    records = meta["source_files"]
+    if(len(records) != len(source_files)):
+        return(False)
+    for rec, filename in zip(records, source_files):
+        if(rec["filename"] != os.path.abspath(filename) or not os.path.isfile(filename)):
+            return(False)
+        st = os.stat(filename)
+        if(st.st_size != rec["size"]):
+            return(False)
+        if(st.st_mtime_ns != rec["mtime_ns"] and _sha1(filename) != rec["sha1"]):
+            return(False)
+    return(True)
+
+
+def MCNPX_output_to_store(filename, path=None, MESH_NUM=1, DOSE_FACTOR=1.0, mmap=True, **kwargs):
+    """
+    Converts mesh MESH_NUM of an MCNPX mesh tally output file to a store (default
+    store_path(filename, MESH_NUM)) unless an up to date store already exists, and
+    returns load_tally_store of it. kwargs are passed on to Import_MCNPX_output.
+    """
+    from Import_MCNPX_output import Import_MCNPX_output
+    if(path is None):
+        path = store_path(filename, MESH_NUM)
+    provenance = {"importer": "Import_MCNPX_output", "MESH_NUM": MESH_NUM, "DOSE_FACTOR": DOSE_FACTOR}
+    if(not (is_store_current(path, [filename]) and read_store_meta(path)["provenance"] == provenance)):
+        print("converting {0} to tally store {1}".format(filename, path))
+        tally = Import_MCNPX_output(filename, DOSE_FACTOR=DOSE_FACTOR, MESH_NUM=MESH_NUM, **kwargs)
+        save_tally_store(path, tally, [filename], **provenance)
+    return(load_tally_store(path, mmap=mmap))
+
+
+def mdata_to_store(filename, path=None, mmap=True):
+    """
+    Converts an mdata file written by mcnpx to a store (default store_path(filename))
+    unless an up to date store already exists, and returns a jkcm_mcnpx_rmesh
+    with the arrays loaded from the store.
+    """
+    from jkcm_mcnpx_rmesh import jkcm_mcnpx_rmesh
+    if(path is None):
+        path = store_path(filename)
+    o = jkcm_mcnpx_rmesh()
+    provenance = {"importer": "jkcm_mcnpx_rmesh.import_from_mdata_ascii"}
+    if(not (is_store_current(path, [filename]) and read_store_meta(path)["provenance"] == provenance)):
+        print("converting {0} to tally store {1}".format(filename, path))
+        o.import_from_mdata_ascii(filename)
+        o.save_to_store(path, [filename], **provenance)
+    o.import_from_store(path, mmap=mmap)
+    return(o)
@@ -15,7 +15,7 @@ directory="G:\data\Agx100_I125"
 fileList = glob.glob("{0}\mdata*".format(directory))
 
 #import the mdata smesh results
-o = add_in_quadrature(fileList) #answer yes to implicit
+o = add_in_quadrature(fileList) #the implicit 0 in polar angle of the smesh files is detected automatically
 
 
 #Reproduce the F(r,theta) in Mourtada et al AgX100 TG43 parameters Brachytherapy 2011.
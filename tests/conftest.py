@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""Shared fixtures. The modules live at the top of the repository, which is put on sys.path here."""
+
+import os
+import sys
+import numpy as np
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if(REPO_DIR not in sys.path):
+    sys.path.insert(0, REPO_DIR)
+
+SOURCES_DIR = os.path.join(REPO_DIR, "sources")
+MODEL_DIR = os.path.join(SOURCES_DIR, "I125A_consensus")
+PLAQUES_DIR = os.path.join(REPO_DIR, "COMS_plaques")
+
+
+def load_tg43(model_dir=MODEL_DIR, g_r_kind="linear"):
+    """A jkcm_TG43_calc object read straight from the text tables (no cache)."""
+    from jkcm_TG43_calc import jkcm_TG43_calc
+    from jkcm_source_model_cache import model_files
+    frtheta, gr, source_data = model_files(model_dir)
+    o = jkcm_TG43_calc()
+    o.import_aniso_table(frtheta)
+    o.import_gr_table(gr, kind=g_r_kind)
+    o.import_source_data(source_data)
+    return(o)
+
+
+def load_multisource(plaque="COMS_16mm_plaque.txt", Sk=4.3, dwell_h=100.):
+    """A jkcm_samemodel_multisource_TG43 object with the seeds of a COMS plaque."""
+    from jkcm_samemodel_multisource_TG43 import jkcm_samemodel_multisource_TG43
+    o = jkcm_samemodel_multisource_TG43()
+    o.jkcm_TG43_calc_obj = load_tg43()
+    o.importSources(os.path.join(PLAQUES_DIR, plaque))
+    o.setStrengthsInU(Sk)
+    for k in o.source_dwell_time_dict:
+        o.source_dwell_time_dict[k] = dwell_h
+    return(o)
+
+
+def scalar_dose(ms, pts):
+    """Reference SxM dose from the baseline one source, one point path (_calc_to_point)."""
+    src = ms.sourceArrays()
+    q = ms.jkcm_TG43_calc_obj
+    out = np.zeros([len(src["ids"]), len(pts)])
+    for s in np.arange(len(src["ids"])):
+        c, t = src["centers"][s], src["tips"][s]
+        q.setSourceCenterAndTipPos(c[0], c[1], c[2], t[0], t[1], t[2])
+        for j in np.arange(len(pts)):
+            out[s, j] = q._calc_to_point(np.asarray(pts[j], dtype=np.double))
+        out[s] *= src["strengths"][s]*src["dwell_times"][s]
+    return(out)
+
+
+@pytest.fixture
+def tg43():
+    return(load_tg43())
+
+
+@pytest.fixture
+def coms16():
+    return(load_multisource())
+
+
+def write_smesh(filename, meshes, nps=1e6, implicit=(), seed=0, values=None):
+    """Writes an MCNPX mesh tally output file of random meshes.
+    meshes: list of (xb, yb, zb). For the mesh indices in implicit the polar angle
+    bounds yb start at 0, which is left out of the file and of the header count.
+    values: optional list of (tally, unc) per mesh to write instead of random ones.
+    Returns a list of (tally, unc) per mesh."""
+    rng = np.random.default_rng(seed)
+    lines = ["comment line", "{0} {1:.5E}".format(len(meshes), nps)]
+    for i, (xb, yb, zb) in enumerate(meshes):
+        ny_header = len(yb) - 1 if i in implicit else len(yb)
+        lines += ["particle", "  1 2 {0} {1} {2}".format(len(xb), ny_header, len(zb)), "energy", "ignore"]
+    lines += ["extra"]
+    out = []
+    for i, (xb, yb, zb) in enumerate(meshes):
+        nx, ny, nz = len(xb) - 1, len(yb) - 1, len(zb) - 1
+        tally = rng.random([nx, ny, nz])
+        unc = 0.1*rng.random([nx, ny, nz])
+        if(values is not None):
+            tally, unc = values[i]
+        out.append((tally, unc))
+        for b in (xb, yb[1:] if i in implicit else yb, zb):
+            lines.append(" " + " ".join("{0:.10E}".format(v) for v in b))
+        for arr in (tally, unc):
+            for k in range(nz):
+                for j in range(ny):
+                    lines.append(" " + " ".join("{0:.10E}".format(v) for v in arr[:, j, k]))
+    with open(filename, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    return(out)
+
+
+def write_mdata(filename, nx, ny, nz, per_line=4, seed=0):
+    """Writes an mdata file of a random mesh, bounds 6 per line and per_line
+    (value, uncertainty) pairs per line in Fortran order. Returns xb, yb, zb, tally, unc."""
+    rng = np.random.default_rng(seed)
+    xb = np.linspace(-1, 1, nx+1)
+    yb = np.linspace(-2, 2, ny+1)
+    zb = np.linspace(0, 3, nz+1)
+    tally = rng.random([nx, ny, nz])
+    unc = 0.1*rng.random([nx, ny, nz])
+    pairs = np.empty(2*nx*ny*nz)
+    pairs[0::2] = tally.ravel(order='F')
+    pairs[1::2] = unc.ravel(order='F')
+    with open(filename, 'w') as f:
+        f.write("mdata test x y z 123456789\n")
+        f.write("some header\n")
+        f.write("f {0} 0 {1} {2} {3}\n".format(nx*ny*nz, nx, ny, nz))
+        for b in (xb, yb, zb):
+            for i in range(0, len(b), 6):
+                f.write(" " + " ".join("{0:.10E}".format(v) for v in b[i:i+6]) + "\n")
+        f.write("vals\n")
+        for i in range(0, len(pairs), 2*per_line):
+            f.write(" ".join("{0:.10E}".format(v) for v in pairs[i:i+2*per_line]) + "\n")
+    return(xb, yb, zb, tally, unc)
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import csv
+import os
+import numpy as np
+import pytest
+from conftest import PLAQUES_DIR, load_multisource, scalar_dose
+from jkcm_coms_planner import plan_coms_batch, plaque_files, write_coms_table, STANDARD_POINTS
+
+
+def test_plaque_files_are_sorted_by_size():
+    files = plaque_files()
+    assert len(files) > 1
+    sizes = [int(os.path.basename(f).split("_")[1].replace("mm", "")) for f in files]
+    assert sizes == sorted(sizes)
+
+
+def test_plan_against_per_plaque_scalar_loop(tg43):
+    files = [os.path.join(PLAQUES_DIR, f) for f in ["COMS_12mm_plaque.txt", "COMS_16mm_plaque.txt", "COMS_20mm_plaque.txt"]]
+    rx_depths = [0.28, 0.5]
+    rx_doses = [70., 85.]
+    durations = [100., 168.]
+    res = plan_coms_batch(tg43, files, rx_depths, rx_doses, durations)
+    effT = np.array([tg43.calc_eff_time(t) for t in durations])
+    np.testing.assert_allclose(res['effective_time_h'], effT)
+
+    n = 0
+    for p in np.arange(len(files)):
+        #dose rate per U from the scalar path, one plaque at a time
+        ms = load_multisource(os.path.basename(files[p]), Sk=1., dwell_h=1.)
+        for d in np.arange(len(rx_depths)):
+            depths = [rx_depths[d] if z is None else z for (name, z) in STANDARD_POINTS]
+            pts = np.column_stack([np.zeros(len(depths)), np.zeros(len(depths)), depths])
+            seed_rate = scalar_dose(ms, pts)
+            rate = np.sum(seed_rate, axis=0)
+            rx_rate = np.sum(scalar_dose(ms, np.array([[0., 0., rx_depths[d]]])))
+            np.testing.assert_allclose(res['dose_rate_cGy_per_h_per_U'][p, d], rate, rtol=1e-10)
+            np.testing.assert_allclose(res['seed_dose_rate_cGy_per_h_per_U'][n:n+len(seed_rate), d], seed_rate, rtol=1e-10)
+            for r in np.arange(len(rx_doses)):
+                for t in np.arange(len(durations)):
+                    Sk = 100.*rx_doses[r]/(rx_rate*effT[t])
+                    assert res['Sk_U'][p, d, r, t] == pytest.approx(Sk, rel=1e-10)
+                    np.testing.assert_allclose(res['point_doses_Gy'][p, d, r, t], rate*Sk*effT[t]/100., rtol=1e-10)
+                    #the tumor apex gets the prescription dose
+                    assert res['point_doses_Gy'][p, d, r, t, 3] == pytest.approx(rx_doses[r], rel=1e-10)
+        assert res['seed_starts'][p] == n
+        n += len(seed_rate)
+    assert len(res['seed_centers_cm']) == n
+
+
+def test_write_coms_table(tg43, tmp_path):
+    files = plaque_files()[0:2]
+    res = plan_coms_batch(tg43, files, [0.5], [85.], [100., 168.])
+    f = str(tmp_path / "table.csv")
+    write_coms_table(res, f)
+    with open(f) as fh:
+        rows = list(csv.reader(fh))
+    assert rows[0][-len(STANDARD_POINTS):] == ["{0} (Gy)".format(name) for (name, d) in STANDARD_POINTS]
+    assert len(rows) == 1 + 2*2
+    assert float(rows[1][5]) == round(res['Sk_U'][0, 0, 0, 0], 4)
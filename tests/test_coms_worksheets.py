@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+import numpy as np
+import pytest
+pytest.importorskip("xlsxwriter")
+from jkcm_coms_planner import plan_coms_batch, plaque_files, STANDARD_POINTS
+from jkcm_generate_COMS_worksheet import generate_coms_worksheets
+
+NS = {"m": "http://schemas.openxmlformats.org/spreadsheetml/2006/main"}
+
+
+def _read_workbook(filename):
+    """Returns {sheet name: [rows]} with each row a {column letter: value} dictionary."""
+    book = {}
+    with zipfile.ZipFile(filename) as z:
+        names = [s.get("name") for s in ET.fromstring(z.read("xl/workbook.xml")).iter("{%s}sheet" % NS["m"])]
+        for i in np.arange(len(names)):
+            rows = []
+            for r in ET.fromstring(z.read("xl/worksheets/sheet{0}.xml".format(i + 1))).iter("{%s}row" % NS["m"]):
+                row = {}
+                for c in r.findall("m:c", NS):
+                    col = re.match("[A-Z]+", c.get("r")).group(0)
+                    if(c.get("t") == "inlineStr"):
+                        row[col] = c.find("m:is/m:t", NS).text
+                    elif(c.find("m:v", NS) is not None):
+                        row[col] = float(c.find("m:v", NS).text)
+                rows.append(row)
+            book[names[i]] = rows
+    return(book)
+
+
+def _row(rows, label, start=0):
+    """Index of the first row at or after start labelled label in column A."""
+    for i in np.arange(start, len(rows)):
+        if(rows[i].get("A") == label):
+            return(i)
+    raise KeyError(label)
+
+
+def test_workbooks_against_plan_coms_batch(tmp_path):
+    files = plaque_files()[0:2]
+    rx_depths = [0.28, 0.5]
+    filenames = generate_coms_worksheets(models=["I125A_consensus"], files=files, out_dir=str(tmp_path),
+                                         rx_depths_cm=rx_depths, rx_dose_Gy=85., duration_h=100.)
+    res = plan_coms_batch("I125A_consensus", files, rx_depths, [85.], [100.])
+    assert filenames == [os.path.join(str(tmp_path), "I125A_consensus", "{0}_I125A_consensus.xlsx".format(p))
+                         for p in res['plaques']]
+    stops = list(res['seed_starts'][1:]) + [len(res['seed_centers_cm'])]
+    N = len(STANDARD_POINTS)
+    for p in np.arange(len(filenames)):
+        assert os.path.isfile(filenames[p])
+        book = _read_workbook(filenames[p])
+        assert list(book.keys()) == ["Rx depth 0.28 cm", "Rx depth 0.5 cm"]
+        for d in np.arange(len(rx_depths)):
+            rows = book["Rx depth {0:g} cm".format(rx_depths[d])]
+            assert rows[_row(rows, "Prescription depth (cm)")]["B"] == rx_depths[d]
+            Sk = rows[_row(rows, "Sk for each seed (U)")]["B"]
+            assert Sk == pytest.approx(res['Sk_U'][p, d, 0, 0], rel=1e-12)
+            #the point table
+            first = _row(rows, "Point") + 1
+            for n in np.arange(N):
+                row = rows[first + n]
+                assert row["A"] == res['point_names'][n]
+                assert row["B"] == pytest.approx(res['point_depths_cm'][d, n], rel=1e-12)
+                assert row["C"] == pytest.approx(res['dose_rate_cGy_per_h_per_U'][p, d, n], rel=1e-12)
+                assert row["D"] == pytest.approx(res['point_doses_Gy'][p, d, 0, 0, n], rel=1e-12)
+            assert rows[_row(rows, "Tumor apex", first)]["D"] == pytest.approx(85., rel=1e-12)
+            #one row per seed of this plaque, then the totals
+            first = _row(rows, "Seed") + 1
+            total = _row(rows, "Total", first)
+            seeds = np.arange(res['seed_starts'][p], stops[p])
+            assert total - first == len(seeds)
+            for s in np.arange(len(seeds)):
+                row = rows[first + s]
+                assert row["A"] == s + 1
+                values = [row[chr(ord("B") + k)] for k in np.arange(3 + 2*N)]
+                np.testing.assert_allclose(values[0:3], res['seed_centers_cm'][seeds[s]], rtol=1e-12)
+                np.testing.assert_allclose(values[3:3+N], res['seed_dose_rate_cGy_per_h_per_U'][seeds[s], d], rtol=1e-12)
+            totals = [rows[total][chr(ord("E") + k)] for k in np.arange(2*N)]
+            np.testing.assert_allclose(totals[0:N], res['dose_rate_cGy_per_h_per_U'][p, d], rtol=1e-12)
+            np.testing.assert_allclose(totals[N:], res['point_doses_Gy'][p, d, 0, 0], rtol=1e-12)
+
+
+def test_parallel_workbooks_match_serial(tmp_path):
+    files = plaque_files()[0:2]
+    serial = generate_coms_worksheets(models=["I125A_consensus"], files=files, out_dir=str(tmp_path/"serial"))
+    parallel = generate_coms_worksheets(models=["I125A_consensus"], files=files, out_dir=str(tmp_path/"parallel"), workers=2)
+    assert len(parallel) == len(serial) == 2
+    for a, b in zip(serial, parallel):
+        assert os.path.basename(a) == os.path.basename(b)
+        assert _read_workbook(a) == _read_workbook(b)
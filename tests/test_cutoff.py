@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from conftest import load_tg43
+from jkcm_samemodel_multisource_TG43 import jkcm_samemodel_multisource_TG43
+
+
+def _implant(n=60, seed=0):
+    rng = np.random.default_rng(seed)
+    o = jkcm_samemodel_multisource_TG43()
+    o.jkcm_TG43_calc_obj = load_tg43()
+    centers = rng.uniform(-2, 2, size=(n, 3))
+    for i in np.arange(n):
+        o.source_center_dict[i] = centers[i]
+        o.source_tip_dict[i] = centers[i] + [0, 0, 0.2]
+        o.source_dwell_time_dict[i] = 1.
+        o.source_strength_dict[i] = rng.uniform(0.3, 0.6)
+    return(o)
+
+
+def test_dropped_dose_is_within_the_reported_bound():
+    o = _implant()
+    pts = np.random.default_rng(1).uniform(-3, 3, size=(500, 3))
+    full = o.calc_at_points(pts)
+    cut = o.calc_at_points(pts, cutoff_cm=1.5)
+    src = o.sourceArrays()
+    d = np.sqrt(np.sum((src["centers"][:, None, :] - pts[None, :, :])**2, axis=2))
+    near = d <= 1.5
+    np.testing.assert_allclose(cut[near], full[near], rtol=1e-12)
+    assert np.all(cut[~near] == 0)
+    dropped = (full - cut).sum(axis=0)
+    assert o.last_cutoff_error_bound > 0
+    assert np.all(dropped <= o.last_cutoff_error_bound*(1 + 1e-12))
+    #the bound of a grid is the largest bound of its chunks
+    o.calc_dose_grid(bounds=[[-2, 2], [-2, 2], [-2, 2]], spacing=0.5, cutoff_cm=1.5, chunk_size=100)
+    assert o.last_cutoff_error_bound > 0
+
+
+def test_point_source_far_field_is_the_solid_angle_average():
+    o = _implant()
+    q = o.jkcm_TG43_calc_obj
+    th = np.linspace(0, 180, 3601)
+    w = np.sin(np.radians(th))
+    for r in [1., 2., 4.]:
+        average = np.sum(q._calc_rate_exact(np.full(len(th), r), th)*w)/np.sum(w)
+        np.testing.assert_allclose(q.calc_point_source_rate(r), average, rtol=2e-4)
+    pts = np.random.default_rng(2).uniform(-3, 3, size=(300, 3))
+    full = o.calc_at_points(pts)
+    approx = o.calc_at_points(pts, cutoff_cm=1.5, far_field="point")
+    assert o.last_cutoff_error_bound is None
+    src = o.sourceArrays()
+    d = np.sqrt(np.sum((src["centers"][:, None, :] - pts[None, :, :])**2, axis=2))
+    near = d <= 1.5
+    np.testing.assert_allclose(approx[near], full[near], rtol=1e-12)
+    np.testing.assert_allclose(approx[~near], src["strengths"][:, None].repeat(len(pts), axis=1)[~near]*q.calc_point_source_rate(d[~near]), rtol=1e-12)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import math
+import numpy as np
+import pytest
+from scipy.integrate import quad
+from jkcm_decay import (HALF_LIFE_H, half_life_h, eff_time_h, wall_time_from_eff_time_h,
+                        dose_vs_time, time_to_dose)
+
+
+def _eff_time(t, nuclide):
+    mu = math.log(2)/HALF_LIFE_H[nuclide]
+    return(-math.expm1(-mu*t)/mu)
+
+
+@pytest.mark.parametrize("nuclide", sorted(HALF_LIFE_H.keys()))
+def test_eff_time_against_analytic(nuclide):
+    t = np.array([0., 1e-6, 24., 100., 168., 2000.])
+    np.testing.assert_allclose(eff_time_h(t, nuclide), [_eff_time(v, nuclide) for v in t], rtol=1e-12)
+    #the integral of the decaying dose rate
+    mu = math.log(2)/HALF_LIFE_H[nuclide]
+    assert eff_time_h(100., nuclide) == pytest.approx(quad(lambda s: math.exp(-mu*s), 0, 100.)[0], rel=1e-10)
+    assert eff_time_h(100., nuclide, infinite=True) == pytest.approx(1/mu, rel=1e-12)
+    #wall time is the inverse, well conditioned within a few half lives
+    t = t[t < 5*HALF_LIFE_H[nuclide]]
+    np.testing.assert_allclose(wall_time_from_eff_time_h(eff_time_h(t, nuclide), nuclide), t, rtol=1e-9, atol=1e-12)
+    assert np.isnan(wall_time_from_eff_time_h(1/mu, nuclide))
+    assert np.isnan(wall_time_from_eff_time_h(2/mu, nuclide))
+
+
+def test_mixed_nuclides_and_case():
+    names = np.array([["I-125", "pd-103"], ["IR-192", "Cs-131"]])
+    t = np.array([100., 200.])
+    res = eff_time_h(t, names)
+    assert res.shape == (2, 2)
+    expected = [[_eff_time(100., "I-125"), _eff_time(200., "Pd-103")],
+                [_eff_time(100., "Ir-192"), _eff_time(200., "Cs-131")]]
+    np.testing.assert_allclose(res, expected, rtol=1e-12)
+    assert half_life_h("ir-192") == HALF_LIFE_H["Ir-192"]
+    assert np.ndim(eff_time_h(100., "I-125")) == 0
+    with pytest.raises(AssertionError, match="SR-90"):
+        eff_time_h(100., ["I-125", "Sr-90"])
+    #another table
+    assert eff_time_h(10., "X", table={"x": 10.}) == pytest.approx(10/(2*math.log(2)), rel=1e-12)
+
+
+def test_dose_vs_time_and_time_to_dose():
+    rate = np.array([[1., 2., 3.], [4., 5., 6.]])
+    times = np.array([0., 24., 100., 1000.])
+    D = dose_vs_time(rate, times, "I-125")
+    assert D.shape == (4, 2, 3)
+    for i in np.arange(len(times)):
+        np.testing.assert_allclose(D[i], rate*_eff_time(times[i], "I-125"), rtol=1e-12)
+    np.testing.assert_allclose(time_to_dose(rate, D[2], "I-125"), np.full(rate.shape, 100.), rtol=1e-9)
+    mu = math.log(2)/HALF_LIFE_H["I-125"]
+    assert np.isnan(time_to_dose(1., 1.01/mu, "I-125"))
+
+
+def test_tg43_delegates(tg43):
+    t = np.array([100., 168.])
+    np.testing.assert_allclose(tg43.calc_eff_time(t), [_eff_time(v, "I-125") for v in t], rtol=1e-12)
+    assert tg43.calc_eff_time(100., radionuclide="Pd-103") == pytest.approx(_eff_time(100., "Pd-103"), rel=1e-12)
+    assert tg43.calc_wall_time_from_eff_time(tg43.calc_eff_time(100.)) == pytest.approx(100., rel=1e-9)
+    tg43.radionuclide = "IR-192"
+    assert tg43.calc_eff_time(100.) == pytest.approx(_eff_time(100., "Ir-192"), rel=1e-12)
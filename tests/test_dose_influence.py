@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from conftest import load_tg43
+
+
+def _points(n=300, seed=0):
+    rng = np.random.default_rng(seed)
+    return(rng.uniform([-1., -1., -0.2], [1., 1., 2.], [n, 3]))
+
+
+def test_dense_matrix_matches_calc_at_points(coms16):
+    pts = _points()
+    m = coms16.influence_matrix(pts, chunk_size=1000)
+    src = coms16.sourceArrays()
+    per_source = coms16.calc_at_points(pts)
+    np.testing.assert_allclose(m.matrix*(src["strengths"]*src["dwell_times"])[:,None], per_source, rtol=1e-12)
+    np.testing.assert_allclose(m.dose(), np.sum(per_source, axis=0), rtol=1e-12)
+    np.testing.assert_allclose(m.dose(dose_rate=True), coms16.calc_at_points(pts, sum_sources=True, dose_rate=True), rtol=1e-12)
+    #other strengths and dwell times
+    rng = np.random.default_rng(1)
+    Sk = rng.uniform(1, 5, m.n_sources())
+    t = rng.uniform(50, 150, m.n_sources())
+    np.testing.assert_allclose(m.dose(strengths=Sk, dwell_times=t), (Sk*t).dot(m.matrix), rtol=1e-12)
+    effT = coms16.jkcm_TG43_calc_obj.calc_eff_time(np.array([100., 200.]))
+    np.testing.assert_allclose(m.dose_for_duration([100., 200.]), np.multiply.outer(effT, m.dose(dose_rate=True)), rtol=1e-12)
+
+
+def test_update_after_a_source_moves(coms16):
+    pts = _points()
+    m = coms16.influence_matrix(pts)
+    assert m.n_rows_computed == m.n_sources()
+    m.dose()
+    assert m.n_rows_computed == m.n_sources()
+    ids = sorted(coms16.source_center_dict.keys())
+    coms16.source_center_dict[ids[3]] = coms16.source_center_dict[ids[3]] + np.array([0, 0, 0.05])
+    coms16.source_tip_dict[ids[3]] = coms16.source_tip_dict[ids[3]] + np.array([0, 0, 0.05])
+    np.testing.assert_allclose(m.dose(), coms16.calc_at_points(pts, sum_sources=True), rtol=1e-12)
+    assert m.n_rows_computed == m.n_sources() + 1
+    #a removed source drops its row
+    del coms16.source_center_dict[ids[0]]
+    del coms16.source_tip_dict[ids[0]]
+    del coms16.source_strength_dict[ids[0]]
+    del coms16.source_dwell_time_dict[ids[0]]
+    np.testing.assert_allclose(m.dose(), coms16.calc_at_points(pts, sum_sources=True), rtol=1e-12)
+    assert m.n_sources() == len(ids) - 1
+    assert m.n_rows_computed == len(ids) + 1
+
+
+def test_append_points_and_invalidate(coms16):
+    pts = _points(200)
+    m = coms16.influence_matrix(pts[0:120])
+    cols = m.append_points(pts[120:])
+    np.testing.assert_array_equal(cols, np.arange(120, 200))
+    np.testing.assert_allclose(m.dose(), coms16.calc_at_points(pts, sum_sources=True), rtol=1e-12)
+    n = m.n_rows_computed
+    m.invalidate([sorted(coms16.source_center_dict.keys())[2]])
+    m.dose()
+    assert m.n_rows_computed == n + 1
+    #a new TG43 model recomputes every row
+    coms16.jkcm_TG43_calc_obj = load_tg43(g_r_kind="loglinear")
+    np.testing.assert_allclose(m.dose(), coms16.calc_at_points(pts, sum_sources=True), rtol=1e-12)
+    assert m.n_rows_computed == n + 1 + m.n_sources()
+
+
+@pytest.mark.parametrize("cutoff_cm, dose_threshold", [(0.8, None), (None, 0.05), (0.8, 0.05)])
+def test_sparse_matrix_within_its_bound(coms16, cutoff_cm, dose_threshold):
+    pts = _points(400)
+    dense = coms16.influence_matrix(pts)
+    m = coms16.influence_matrix(pts, chunk_size=500, cutoff_cm=cutoff_cm, dose_threshold=dose_threshold)
+    assert m.sparse and m.matrix.format == 'csc'
+    A = m.matrix.toarray()
+    #the kept entries are exact, the dropped ones are below the threshold or beyond the cutoff
+    kept = A != 0
+    np.testing.assert_allclose(A[kept], dense.matrix[kept], rtol=1e-12)
+    src = coms16.sourceArrays()
+    dist = np.linalg.norm(src["centers"][:, None, :] - pts[None, :, :], axis=2)
+    if(dose_threshold is not None):
+        assert np.all(A[kept] >= dose_threshold)
+    else:
+        np.testing.assert_array_equal(kept, dist <= cutoff_cm)
+    report = m.truncation_report()
+    assert report['nnz'] == np.count_nonzero(kept)
+    assert report['density'] == pytest.approx(np.mean(kept))
+    assert report['dense_memory_bytes'] == 8*A.size
+    dropped = np.sum(dense.matrix - A, axis=0)
+    assert np.all(dropped <= report['max_bound_per_U']*(1 + 1e-9))
+    np.testing.assert_allclose(m.dose(), (src["strengths"]*src["dwell_times"]).dot(A), rtol=1e-12)
+
+
+def test_sparse_update_after_a_source_moves(coms16):
+    pts = _points(300)
+    m = coms16.influence_matrix(pts, cutoff_cm=1.)
+    ids = sorted(coms16.source_center_dict.keys())
+    for i in [ids[1], ids[7]]:
+        coms16.source_center_dict[i] = coms16.source_center_dict[i] + np.array([0.1, 0, 0])
+        coms16.source_tip_dict[i] = coms16.source_tip_dict[i] + np.array([0.1, 0, 0])
+    n = m.n_rows_computed
+    m.update()
+    assert m.n_rows_computed == n + 2
+    rebuilt = coms16.influence_matrix(pts, cutoff_cm=1.)
+    np.testing.assert_allclose(m.matrix.toarray(), rebuilt.matrix.toarray(), rtol=1e-12)
+    m.append_points(_points(50, seed=3))
+    rebuilt.append_points(_points(50, seed=3))
+    np.testing.assert_allclose(m.dose(), rebuilt.dose(), rtol=1e-12)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from jkcm_dvh import jkcm_dvh, sphere, cylinder
+
+
+def _grid(uniform):
+    x = np.linspace(-1, 1, 21)
+    y = np.linspace(-1, 1, 17) if uniform else np.sort(np.concatenate([np.linspace(-1, 1, 11), [-0.55, 0.05, 0.33, 0.71]]))
+    z = np.linspace(0, 2, 13)
+    return([x, y, z])
+
+
+def _brute_force(axes, dose, inside, max_dose, n_bins):
+    """Histogram, volume, min, mean and max of the voxels inside, all at once."""
+    w = [np.abs(np.gradient(a)) for a in axes]
+    vol = (w[0][:,None,None]*w[1][None,:,None]*w[2][None,None,:]).ravel()[inside]
+    d = dose.ravel()[inside]
+    edges = np.append(max_dose/n_bins*np.arange(n_bins + 1), np.inf)
+    hist = np.histogram(d, bins=edges, weights=vol)[0]
+    return(hist, np.sum(vol), np.min(d), np.dot(vol, d)/np.sum(vol), np.max(d), d, vol)
+
+
+@pytest.mark.parametrize("uniform", [True, False])
+def test_against_brute_force(uniform):
+    axes = _grid(uniform)
+    pts = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+    dose = 100./(0.05 + np.sum((pts - [0.1, 0, 0.3])**2, axis=1))
+    mask = pts[:, 0] > 0.2
+    structures = {"ball": sphere([0, 0, 0.5], 0.6), "rod": cylinder([0, 0, 0], [0, 0, 2], 0.3), "mask": mask}
+    h = jkcm_dvh(axes, structures, max_dose=1000., n_bins=200)
+    for si in np.arange(0, len(dose), 333):
+        fi = min(si + 333, len(dose))
+        h.add_chunk(si, fi, dose[si:fi])
+    assert h.n_voxels_added == len(dose)
+    for name in h.names:
+        s = structures[name]
+        inside = s(pts) if callable(s) else s
+        hist, total, dmin, mean, dmax, d, vol = _brute_force(axes, dose, inside, 1000., 200)
+        np.testing.assert_allclose(h.hist[name], hist, rtol=1e-12, atol=1e-15)
+        m = h.metrics([name], D=[50], V=[300.])[name]
+        assert m['volume'] == pytest.approx(total, rel=1e-12)
+        assert (m['min'], m['max']) == (dmin, dmax)
+        assert m['mean'] == pytest.approx(mean, rel=1e-12)
+        assert m['nan_volume'] == 0.
+        #Vx from the sorted voxels, within the volume of the bins next to x
+        exact = 100*np.sum(vol[d >= 300.])/total
+        near = 100*np.sum(vol[np.abs(d - 300.) < 5.])/total
+        assert abs(m['V300'] - exact) <= near + 1e-9
+        #D50 is a dose where half the volume is at least that dose
+        order = np.argsort(-d)
+        d50 = d[order][np.searchsorted(np.cumsum(vol[order]), 0.5*total)]
+        assert abs(m['D50'] - d50) <= 5.
+
+
+def test_nan_dose_goes_to_overflow():
+    axes = _grid(True)
+    n = int(np.prod([len(a) for a in axes]))
+    dose = np.linspace(1., 99., n)
+    dose[[5, 17]] = np.nan
+    h = jkcm_dvh(axes, {"all": np.ones(n, dtype=bool)}, max_dose=100., n_bins=10)
+    h.add_chunk(0, n, dose)
+    voxel = 0.1*0.125*(2/12.)
+    m = h.metrics(D=[100, 0.01], V=[0., 150.])["all"]
+    assert m['nan_volume'] == pytest.approx(2*voxel)
+    assert h.hist["all"][-1] == pytest.approx(2*voxel)
+    assert m['volume'] == pytest.approx(n*voxel)
+    finite = dose[np.isfinite(dose)]
+    assert (m['min'], m['max']) == (np.min(finite), np.max(finite))
+    assert m['mean'] == pytest.approx(np.mean(finite), rel=1e-12)
+    #the nan voxels receive more than any finite dose
+    assert m['V0'] == pytest.approx(100.)
+    assert m['V150'] == pytest.approx(100*2/n)
+    assert m['D0.01'] == np.max(finite)
+
+
+def test_dvh_of_a_grid_through_a_source_center(coms16):
+    c = coms16.sourceArrays()["centers"][0]
+    x = c[0] + 0.1*np.arange(-3, 4)
+    y = c[1] + 0.1*np.arange(-2, 3)
+    z = c[2] + 0.1*np.arange(-1, 6)
+    structures = {"all": np.ones([len(x), len(y), len(z)], dtype=bool), "ball": sphere(c, 0.25)}
+    h = coms16.dvh(structures, 1e6, x=x, y=y, z=z, n_bins=500, chunk_size=40)
+    grid = coms16.calc_dose_grid(x, y, z)
+    finite = grid[np.isfinite(grid)]
+    m = h.metrics()
+    for name in ["all", "ball"]:
+        assert m[name]['nan_volume'] == pytest.approx(0.1**3)
+        assert np.isfinite(m[name]['mean'])
+    assert m["all"]['volume'] == pytest.approx(grid.size*0.1**3)
+    assert m["all"]['mean'] == pytest.approx(np.mean(finite), rel=1e-12)
+    assert (m["all"]['min'], m["all"]['max']) == (np.min(finite), np.max(finite))
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+import functools
+import io
+import numpy as np
+import pytest
+from conftest import write_smesh
+import Import_MCNPX_output as imo
+from Import_MCNPX_output import Import_MCNPX_output, index_MCNPX_output, read_MCNPX_mesh, add_in_quadrature
+
+
+_meshes = [(np.linspace(-1, 1, 5), np.linspace(-2, 2, 4), np.linspace(0, 3, 3)),
+           (np.linspace(0, 1, 3), np.linspace(0, 1, 6), np.linspace(0, 1, 4)),
+           (np.linspace(-3, 3, 7), np.linspace(-1, 1, 2), np.linspace(0, 2, 2))]
+
+
+def _check(mesh, bounds, expected, factor=1.):
+    np.testing.assert_allclose(mesh['xb'], bounds[0], rtol=1e-10, atol=1e-14)
+    np.testing.assert_allclose(mesh['yb'], bounds[1], rtol=1e-10, atol=1e-14)
+    np.testing.assert_allclose(mesh['zb'], bounds[2], rtol=1e-10, atol=1e-14)
+    np.testing.assert_allclose(mesh['tally_xyz'], factor*expected[0], rtol=1e-10)
+    np.testing.assert_allclose(mesh['unc_xyz'], expected[1], rtol=1e-10)
+
+
+def test_multi_mesh(tmp_path):
+    f = str(tmp_path / "out.txt")
+    expected = write_smesh(f, _meshes, nps=2.5e6)
+    m = Import_MCNPX_output(f, MESH_NUM=2, DOSE_FACTOR=3.)
+    assert m['nps'] == 2.5e6
+    assert m['dims'] == [2, 5, 3]
+    _check(m, _meshes[1], expected[1], 3.)
+
+    every = Import_MCNPX_output(f, MESH_NUM="all")
+    assert len(every) == 3
+    for i in np.arange(3):
+        _check(every[i], _meshes[i], expected[i])
+    some = Import_MCNPX_output(f, MESH_NUM=[3, 1])
+    _check(some[0], _meshes[2], expected[2])
+    _check(some[1], _meshes[0], expected[0])
+
+
+def test_index_and_read_mesh(tmp_path):
+    f = str(tmp_path / "out.txt")
+    expected = write_smesh(f, _meshes)
+    index = index_MCNPX_output(f)
+    assert len(index['offsets']) == 3
+    for i in [3, 1, 2]:
+        _check(read_MCNPX_mesh(index, MESH_NUM=i, DOSE_FACTOR=2.), _meshes[i-1], expected[i-1], 2.)
+
+
+@pytest.mark.parametrize("block_size", [5, 13, 64, 1 << 22])
+def test_read_lines(block_size):
+    lines = [("{0} ".format(i)*(i % 7)).encode() + b"\n" for i in np.arange(40)]
+    f = io.BytesIO(b"".join(lines))
+    assert imo._read_lines(f, 3, block_size=block_size) == b"".join(lines[0:3])
+    assert f.tell() == len(b"".join(lines[0:3]))
+    assert imo._read_lines(f, 30, keep=False, block_size=block_size) == b""
+    assert imo._read_lines(f, 7, block_size=block_size) == b"".join(lines[33:40])
+    assert f.tell() == len(f.getvalue())
+    assert imo._read_lines(f, 1, block_size=block_size) == b""
+
+
+@pytest.mark.parametrize("block_size", [61, 256])
+def test_mesh_spans_several_blocks(tmp_path, monkeypatch, block_size):
+    #rows of about 60 bytes: every block ends inside a row and most rows end inside a block
+    monkeypatch.setattr(imo, "_read_lines", functools.partial(imo._read_lines, block_size=block_size))
+    f = str(tmp_path / "out.txt")
+    expected = write_smesh(f, _meshes)
+    every = Import_MCNPX_output(f, MESH_NUM="all")
+    for i in np.arange(3):
+        _check(every[i], _meshes[i], expected[i])
+    _check(read_MCNPX_mesh(index_MCNPX_output(f), MESH_NUM=3), _meshes[2], expected[2])
+
+
+def test_element_count_mismatch_raises(tmp_path):
+    f = str(tmp_path / "out.txt")
+    write_smesh(f, _meshes[0:1])
+    with open(f) as fh:
+        lines = fh.readlines()
+    #drop a value from the last row of uncertainties
+    lines[-1] = " ".join(lines[-1].split()[:-1]) + "\n"
+    with open(f, 'w') as fh:
+        fh.writelines(lines)
+    with pytest.raises(ValueError, match=r"\(47\).*\(48\)"):
+        Import_MCNPX_output(f, mesh_geometry="rectilinear")
+
+
+def _quadrature_reference(runs, w):
+    """The weighted mean, quadrature and batch uncertainties computed directly."""
+    x = np.array([r[0] for r in runs])
+    u = np.array([r[1] for r in runs])
+    w = np.asarray(w, dtype=np.double)[:, None, None, None]
+    W = np.sum(w)
+    mean = np.sum(w*x, axis=0)/W
+    unc = np.sqrt(np.sum((w*x*u)**2, axis=0))/W/mean
+    sum_w2 = np.sum(w*w)
+    var_mean = np.sum(w*(x - mean)**2, axis=0)/(W - sum_w2/W)*sum_w2/W**2
+    return(mean, unc, np.sqrt(var_mean)/mean)
+
+
+@pytest.mark.parametrize("weights", ["equal", "nps", [1., 3., 0.5, 2.]])
+@pytest.mark.parametrize("workers", [1, 2])
+def test_add_in_quadrature(tmp_path, weights, workers):
+    files = []
+    runs = []
+    nps = [1e6, 2e6, 5e5, 3e6]
+    for i in np.arange(4):
+        f = str(tmp_path / "out{0}.txt".format(i))
+        runs.append(write_smesh(f, _meshes[0:1], nps=nps[i], seed=i)[0])
+        files.append(f)
+    res = add_in_quadrature(files, weights=weights, workers=workers)
+    w = {"equal": [1.]*4, "nps": nps}[weights] if isinstance(weights, str) else weights
+    mean, unc, unc_batch = _quadrature_reference(runs, w)
+    np.testing.assert_allclose(res['tally_xyz'], mean, rtol=1e-9)
+    np.testing.assert_allclose(res['unc_xyz'], unc, rtol=1e-9)
+    np.testing.assert_allclose(res['unc_batch_xyz'], unc_batch, rtol=1e-8)
+    assert res['nps'] == nps[-1]
+    assert res['nps_total'] == sum(nps)
+    np.testing.assert_allclose(res['xb'], _meshes[0][0], rtol=1e-10, atol=1e-14)
+
+
+def test_add_in_quadrature_single_file(tmp_path):
+    f = str(tmp_path / "out.txt")
+    tally, unc = write_smesh(f, _meshes[0:1])[0]
+    res = add_in_quadrature([f])
+    np.testing.assert_allclose(res['tally_xyz'], tally, rtol=1e-10)
+    np.testing.assert_allclose(res['unc_xyz'], unc, rtol=1e-9)
+    assert np.all(np.isnan(res['unc_batch_xyz']))
+
+
+_spherical = (np.array([0., 0.5, 1., 2.]), np.linspace(0, 180, 7), np.array([0., 360.]))
+_rect = (np.linspace(-1, 1, 5), np.linspace(1, 2, 3), np.linspace(0, 3, 3))
+
+
+@pytest.mark.parametrize("mesh_geometry", ["auto", ["spherical", "rectilinear"], ["spherical", "auto"]])
+def test_implicit_polar_zero(tmp_path, mesh_geometry):
+    f = str(tmp_path / "out.txt")
+    expected = write_smesh(f, [_spherical, _rect], implicit=(0,))
+    meshes = Import_MCNPX_output(f, MESH_NUM="all", mesh_geometry=mesh_geometry)
+    assert meshes[0]['dims'] == [3, 6, 1]
+    _check(meshes[0], _spherical, expected[0])
+    #the rectilinear mesh whose first y bound is above 0 keeps its bounds
+    _check(meshes[1], _rect, expected[1])
+    index = index_MCNPX_output(f, mesh_geometry=mesh_geometry)
+    assert index['header']['implicit_zero'] == [True, False]
+    _check(read_MCNPX_mesh(index, MESH_NUM=1), _spherical, expected[0])
+    _check(read_MCNPX_mesh(index, MESH_NUM=2), _rect, expected[1])
+
+
+def test_implicit_polar_zero_last_mesh(tmp_path):
+    f = str(tmp_path / "out.txt")
+    expected = write_smesh(f, [_rect, _spherical], implicit=(1,))
+    meshes = Import_MCNPX_output(f, MESH_NUM="all")
+    _check(meshes[0], _rect, expected[0])
+    _check(meshes[1], _spherical, expected[1])
+
+
+def test_implicit_polar_zero_as_rectilinear_fails(tmp_path):
+    f = str(tmp_path / "out.txt")
+    write_smesh(f, [_spherical], implicit=(0,))
+    with pytest.raises(AssertionError, match="spherical/cylindrical"):
+        Import_MCNPX_output(f, mesh_geometry="rectilinear")
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from scipy.optimize import linprog, lsq_linear
+from conftest import load_tg43
+from jkcm_samemodel_multisource_TG43 import jkcm_samemodel_multisource_TG43
+from jkcm_inverse_planning import inverse_plan, plan_points
+
+
+@pytest.fixture(scope="module")
+def implant():
+    """40 randomly oriented seeds in a 3 cm cube, target points inside and
+    critical points on a shell around it."""
+    rng = np.random.default_rng(0)
+    o = jkcm_samemodel_multisource_TG43()
+    o.jkcm_TG43_calc_obj = load_tg43()
+    c = rng.uniform(-1.5, 1.5, [40, 3])
+    d = rng.normal(size=[40, 3])
+    d /= np.linalg.norm(d, axis=1)[:, None]
+    for i in np.arange(40):
+        o.source_center_dict[i] = c[i]
+        o.source_tip_dict[i] = c[i] + 0.225*d[i]
+        o.source_strength_dict[i] = 1.
+        o.source_dwell_time_dict[i] = 1.
+    target = rng.uniform(-1.3, 1.3, [800, 3])
+    u = rng.normal(size=[800, 3])
+    critical = u/np.linalg.norm(u, axis=1)[:, None]*rng.uniform(2.2, 3., 800)[:, None]
+    m = o.influence_matrix(np.concatenate([target, critical]))
+    return(o, m, np.arange(800), np.arange(800, 1600))
+
+
+def _full_lp(m, ti, ci, rx, max_dose=None, ub=None):
+    A = m.matrix
+    A_ub = -A[:, ti].T
+    b_ub = -np.full(len(ti), rx)
+    if(max_dose is not None):
+        A_ub = np.concatenate([A_ub, A[:, ti].T])
+        b_ub = np.concatenate([b_ub, np.full(len(ti), max_dose)])
+    bounds = [(0, None if ub is None else ub[i]) for i in np.arange(m.n_sources())]
+    return(linprog(A[:, ci].sum(axis=1), A_ub=A_ub, b_ub=b_ub, bounds=bounds, method='highs'))
+
+
+@pytest.mark.parametrize("critical_weight", [0., 0.1])
+def test_lsq_matches_full_lsq_linear(implant, critical_weight):
+    o, m, ti, ci = implant
+    res = inverse_plan(m, ti, 100., ci, method="lsq", critical_weight=critical_weight)
+    assert res['success']
+    assert np.all(res['x'] >= 0)
+    #lsq_linear on the whole system, without the reduction to a square one
+    M = np.concatenate([m.matrix[:, ti].T, critical_weight*m.matrix[:, ci].T])
+    b = np.concatenate([np.full(len(ti), 100.), np.zeros(len(ci))])
+    full = lsq_linear(M, b, bounds=(0, np.inf), tol=1e-12)
+    cost = lambda x: np.sum((M.dot(x) - b)**2)
+    assert cost(res['x']) <= cost(full.x)*(1 + 1e-6)
+    np.testing.assert_allclose(res['dose'], m.dose(strengths=res['x']), rtol=1e-12)
+
+
+@pytest.mark.parametrize("max_fraction", [None, 0.5])
+def test_lp_matches_full_linprog(implant, max_fraction):
+    o, m, ti, ci = implant
+    max_dose = None
+    if(max_fraction is not None):
+        #an upper limit that the plan without one exceeds
+        max_dose = max_fraction*np.max(inverse_plan(m, ti, 100., ci, method="lp")['target_dose'])
+    res = inverse_plan(m, ti, 100., ci, method="lp", max_target_dose=max_dose)
+    full = _full_lp(m, ti, ci, 100., max_dose)
+    assert res['success'] and full.status == 0
+    assert np.all(res['x'] >= 0)
+    assert np.min(res['target_dose']) >= 100.*(1 - 1e-6)
+    if(max_dose is not None):
+        assert np.max(res['target_dose']) <= max_dose*(1 + 1e-6)
+    assert np.sum(res['critical_dose']) == pytest.approx(full.fun, rel=1e-6)
+
+
+def test_lp_with_excluded_sources_and_sparse_matrix(implant):
+    o, m, ti, ci = implant
+    ub = np.full(m.n_sources(), np.inf)
+    ub[0:5] = 0.
+    res = inverse_plan(m, ti, 100., ci, method="lp", bounds=(0, ub))
+    np.testing.assert_array_equal(res['x'][0:5], 0.)
+    full = _full_lp(m, ti, ci, 100., ub=np.where(np.isinf(ub), None, ub))
+    assert np.sum(res['critical_dose']) == pytest.approx(full.fun, rel=1e-6)
+    #a sparse matrix with every entry kept gives the same plan
+    sm = o.influence_matrix(m.points, dose_threshold=0.)
+    res_sparse = inverse_plan(sm, ti, 100., ci, method="lp", bounds=(0, ub))
+    assert np.sum(res_sparse['critical_dose']) == pytest.approx(full.fun, rel=1e-6)
+
+
+def test_lsq_with_two_seeds_at_the_same_position():
+    rng = np.random.default_rng(2)
+    o = jkcm_samemodel_multisource_TG43()
+    o.jkcm_TG43_calc_obj = load_tg43()
+    c = rng.uniform(-1., 1., [12, 3])
+    c[5] = c[4]
+    for i in np.arange(12):
+        o.source_center_dict[i] = c[i]
+        o.source_tip_dict[i] = c[i] + [0, 0, 0.225]
+        o.source_strength_dict[i] = 1.
+        o.source_dwell_time_dict[i] = 1.
+    pts = rng.uniform(-1.2, 1.2, [300, 3])
+    ti, ci = np.arange(200), np.arange(200, 300)
+    dense = o.influence_matrix(pts)
+    np.testing.assert_array_equal(dense.matrix[4], dense.matrix[5])
+    M = np.concatenate([dense.matrix[:, ti].T, 0.1*dense.matrix[:, ci].T])
+    b = np.concatenate([np.full(len(ti), 100.), np.zeros(len(ci))])
+    full = lsq_linear(M, b, bounds=(0, np.inf), tol=1e-12)
+    cost = lambda x: np.sum((M.dot(x) - b)**2)
+    for m in [dense, o.influence_matrix(pts, dose_threshold=0.)]:
+        res = inverse_plan(m, ti, 100., ci, method="lsq")
+        assert res['success']
+        assert np.all(np.isfinite(res['x'])) and np.all(res['x'] >= 0)
+        assert cost(res['x']) <= cost(full.x)*(1 + 1e-6)
+
+
+def test_dwell_time_and_duration(coms16):
+    pts = np.array([[0., 0., 0.5], [0.2, 0., 0.5], [0., 0.2, 0.5]])
+    res = plan_points(coms16, pts, 8500., np.array([[0., 0., 2.2]]), variable="strength", duration_h=100., method="lp")
+    effT = coms16.jkcm_TG43_calc_obj.calc_eff_time(100.)
+    np.testing.assert_allclose(res['dose'], res['influence'].dose(strengths=res['x'], dwell_times=np.repeat(effT, len(res['x']))))
+    assert np.min(res['target_dose']) >= 8500.*(1 - 1e-6)
+    res = plan_points(coms16, pts, 8500., variable="dwell_time", method="lp")
+    src = coms16.sourceArrays()
+    np.testing.assert_allclose(res['dose'], res['influence'].dose(dwell_times=res['x']))
+    assert np.min(res['target_dose']) >= 8500.*(1 - 1e-6)
+    assert np.all(res['x'] >= 0)
+    assert len(res['x']) == len(src["ids"])
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from jkcm_isodose import marching_squares, isodose_axis_plane, isodose_plane, plane_points
+
+
+def test_circle():
+    u = np.linspace(-2, 2, 81)
+    v = np.linspace(-1.5, 2.5, 61)
+    uu, vv = np.meshgrid(u, v)
+    values = np.sqrt(uu**2 + (vv - 0.5)**2)
+    lines = marching_squares(values, 1.2, u, v)
+    assert len(lines) == 1
+    line = lines[0]
+    #closed, and on the circle up to the linear interpolation of the distance
+    np.testing.assert_array_equal(line[0], line[-1])
+    r = np.sqrt(line[:, 0]**2 + (line[:, 1] - 0.5)**2)
+    np.testing.assert_allclose(r, 1.2, atol=2e-3)
+    #the polygon encloses the area of the circle
+    area = 0.5*abs(np.dot(line[:-1, 0], line[1:, 1]) - np.dot(line[1:, 0], line[:-1, 1]))
+    assert area == pytest.approx(np.pi*1.2**2, rel=1e-2)
+    #one point per crossed edge, none repeated
+    assert len(np.unique(line[:-1], axis=0)) == len(line) - 1
+
+
+def test_open_line_and_default_positions():
+    values = np.tile(np.arange(5.), (4, 1))   #increases along u
+    lines = marching_squares(values, 2.5)
+    assert len(lines) == 1
+    np.testing.assert_allclose(lines[0][:, 0], 2.5)
+    np.testing.assert_allclose(np.sort(lines[0][:, 1]), np.arange(4.))
+    assert marching_squares(values, 10.) == []
+    assert marching_squares(values[0:1], 2.5) == []
+
+
+@pytest.mark.parametrize("high, expected", [
+    #the mean of the corners is above the level: the high corners are joined
+    (3., [[(2/3., 0.), (1., 1/3.)], [(1/3., 1.), (0., 2/3.)]]),
+    #below the level: the segments cut off the high corners
+    (1.5, [[(0., 1/3.), (1/3., 0.)], [(1., 2/3.), (2/3., 1.)]])])
+def test_saddle(high, expected):
+    #bottom-left and top-right corners above the level 1, the other two at 0
+    values = np.array([[high, 0.], [0., high]])
+    lines = marching_squares(values, 1.)
+    assert len(lines) == 2
+    got = sorted(sorted(tuple(np.round(p, 12)) for p in l) for l in lines)
+    want = sorted(sorted(tuple(np.round(p, 12)) for p in l) for l in expected)
+    assert got == want
+
+
+def test_nan_cells_are_skipped():
+    u = np.linspace(-2, 2, 41)
+    uu, vv = np.meshgrid(u, u)
+    values = np.sqrt(uu**2 + vv**2)
+    values[20, 30] = np.nan   #(u, v) = (1, 0), on the level 1 line
+    lines = marching_squares(values, 1., u, u)
+    assert len(lines) == 1
+    line = lines[0]
+    assert np.all(np.isfinite(line))
+    #the line is open where it meets the cells around the nan
+    assert not np.array_equal(line[0], line[-1])
+    for end in [line[0], line[-1]]:
+        assert np.max(np.abs(end - [1., 0.])) <= 0.1 + 1e-12
+
+
+def test_isodose_lines_are_on_the_dose_level(coms16):
+    uVec = np.linspace(-1.2, 1.2, 121)
+    vVec = np.linspace(-0.1, 2.3, 121)
+    levels = [8500., 17000.]
+    res = isodose_axis_plane(coms16, levels, 1, 0., uVec, vVec, chunk_size=5000)
+    pts = plane_points([0., 0., 0.], [1., 0., 0.], [0., 0., 1.], uVec, vVec)
+    np.testing.assert_allclose(res['dose'], coms16.calc_at_points(pts.reshape(-1, 3), sum_sources=True).reshape(pts.shape[0:2]))
+    for k in np.arange(len(levels)):
+        assert len(res['contours'][k]) > 0
+        for line_uv, line in zip(res['contours_uv'][k], res['contours'][k]):
+            np.testing.assert_allclose(line[:, 0], line_uv[:, 0])
+            np.testing.assert_allclose(line[:, 1], 0.)
+            np.testing.assert_allclose(line[:, 2], line_uv[:, 1])
+            #linear interpolation between voxels 0.02 cm apart
+            dose = coms16.calc_at_points(line, sum_sources=True)
+            np.testing.assert_allclose(dose, levels[k], rtol=0.02)
+    #an oblique plane gives the same lines as the axis plane
+    oblique = isodose_plane(coms16, levels, [0., 0., 0.], [2., 0., 0.], [0., 0., 3.], uVec, vVec, chunk_size=5000)
+    np.testing.assert_allclose(oblique['dose'], res['dose'], rtol=1e-12)
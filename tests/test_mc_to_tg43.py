@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+import pytest
+from conftest import load_tg43, write_smesh
+from Import_MCNPX_output import geometry_r_theta, calc_centers_from_bounds
+from jkcm_mc_to_tg43 import run_pipeline
+
+L = 0.3
+_source_data = {"seed_length_cm":0.45, "effective_source_length_cm":L, "seed_diameter_cm":0.08,
+                "dose_rate_constant_cGy_per_U_per_h":0.981, "seed_model_name":"test-seed",
+                "seed_radionuclide":"I-125"}
+_rlist = [0.5, 1., 2., 3.]
+_thetalist = [0., 10., 30., 60., 90.]
+
+
+def _F(r, theta):
+    return(1 - 0.3*np.cos(np.radians(theta))**2*np.exp(-0.2*r))
+
+
+def _g(r):
+    return(np.exp(-0.1*(r - 1)))
+
+
+def _write_batches(tmp_path, n=2, scale=1.):
+    """Batch files of a spherical (r, theta) mesh with dose scale*G*g*F, bin centers
+    at 0.1 to 4 cm and 0 to 180 degrees."""
+    xb = np.arange(0.05, 4.1, 0.1)
+    yb = np.arange(-1., 182., 2.)
+    zb = np.array([0., 360.])
+    rc = calc_centers_from_bounds(xb)
+    tc = calc_centers_from_bounds(yb)
+    D = scale*geometry_r_theta(rc[:,None], tc[None,:], L=L)*_g(rc)[:,None]*_F(rc[:,None], tc[None,:])
+    files = []
+    for i in np.arange(n):
+        f = str(tmp_path / "batch{0}".format(i))
+        write_smesh(f, [(xb, yb, zb)], nps=1e6, values=[(D[:,:,None], np.full(D.shape + (1,), 0.01))])
+        files.append(f)
+    return(files)
+
+
+def _run(files, out_dir, rlist=_rlist, source_data=_source_data, **kwargs):
+    return(run_pipeline(files, "test", source_data, rlist, _thetalist, drlist=0.01, dthetalist=0.1,
+                        out_dir=out_dir, mesh_geometry="rectilinear", **kwargs))
+
+
+def test_model_matches_analytic_tables(tmp_path):
+    files = _write_batches(tmp_path)
+    res = _run(files, str(tmp_path / "model"))
+    assert res['ran'] == ["combine", "tables", "write"]
+    o = load_tg43(res['out_dir'])
+    r, th = np.meshgrid(_rlist, _thetalist)
+    np.testing.assert_allclose(o.eval_frtheta(r.ravel(), th.ravel()), _F(r.ravel(), th.ravel()), atol=5e-5)
+    np.testing.assert_allclose(o.eval_g_r_table(np.array(_rlist)), _g(np.array(_rlist)), atol=5e-5)
+    assert o.eff_source_length_cm == L
+    assert o.dose_rate_constant_cGy_per_h_per_U == 0.981
+
+
+def test_stages_are_skipped_and_rerun(tmp_path):
+    files = _write_batches(tmp_path)
+    out_dir = str(tmp_path / "model")
+    assert _run(files, out_dir)['ran'] == ["combine", "tables", "write"]
+    assert _run(files, out_dir)['ran'] == []
+    #a touched but unchanged batch file
+    st = os.stat(files[0])
+    os.utime(files[0], ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert _run(files, out_dir)['ran'] == []
+    #other radii redo the tables, other source data only the write stage
+    assert _run(files, out_dir, rlist=[1., 2.])['ran'] == ["tables", "write"]
+    assert _run(files, out_dir, rlist=[1., 2.])['ran'] == []
+    assert _run(files, out_dir, rlist=[1., 2.], source_data=dict(_source_data, seed_model_name="other"))['ran'] == ["write"]
+    #a missing output file is written again
+    os.remove(os.path.join(out_dir, "test_gr.txt"))
+    assert _run(files, out_dir, rlist=[1., 2.], source_data=dict(_source_data, seed_model_name="other"))['ran'] == ["write"]
+    assert _run(files, out_dir, force=True)['ran'] == ["combine", "tables", "write"]
+
+
+def test_tuple_arguments_are_skipped(tmp_path):
+    files = _write_batches(tmp_path)
+    out_dir = str(tmp_path / "model")
+    run = lambda: run_pipeline(tuple(files), "test", _source_data, tuple(_rlist), tuple(_thetalist),
+                               drlist=0.01, dthetalist=0.1, out_dir=out_dir, mesh_geometry=("rectilinear",))
+    assert run()['ran'] == ["combine", "tables", "write"]
+    assert run()['ran'] == []
+    #the same values as lists
+    assert run_pipeline(files, "test", _source_data, _rlist, _thetalist, drlist=0.01, dthetalist=0.1,
+                        out_dir=out_dir, mesh_geometry=["rectilinear"])['ran'] == []
+
+
+def test_changed_batch_file_reruns_everything(tmp_path):
+    files = _write_batches(tmp_path)
+    out_dir = str(tmp_path / "model")
+    _run(files, out_dir)
+    _write_batches(tmp_path, n=1, scale=2.)
+    st = os.stat(files[0])
+    os.utime(files[0], ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert _run(files, out_dir)['ran'] == ["combine", "tables", "write"]
+    #other combine weights
+    assert _run(files, out_dir, weights="equal")['ran'] == ["combine", "tables", "write"]
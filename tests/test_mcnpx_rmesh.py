@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from scipy.interpolate import RegularGridInterpolator
+from conftest import write_mdata
+from jkcm_mcnpx_rmesh import jkcm_mcnpx_rmesh
+
+
+@pytest.mark.parametrize("block_size", [1 << 24, 97])
+def test_import_from_mdata_ascii(tmp_path, block_size):
+    f = str(tmp_path / "m.mdata")
+    xb, yb, zb, tally, unc = write_mdata(f, 7, 13, 5)
+    o = jkcm_mcnpx_rmesh()
+    o.import_from_mdata_ascii(f, block_size=block_size)
+    assert o.nps == 123456789
+    np.testing.assert_allclose(o.xb, xb, rtol=1e-10)
+    np.testing.assert_allclose(o.yb, yb, rtol=1e-10)
+    np.testing.assert_allclose(o.zb, zb, rtol=1e-10)
+    np.testing.assert_allclose(o.tally_values, tally, rtol=1e-10)
+    np.testing.assert_allclose(o.unc_values, unc, rtol=1e-10)
+
+
+def test_mdata_bad_value_raises(tmp_path):
+    f = str(tmp_path / "m.mdata")
+    write_mdata(f, 2, 2, 2)
+    with open(f) as fh:
+        text = fh.read()
+    with open(f, 'w') as fh:
+        fh.write(text[:-4] + "x00\n")
+    with pytest.raises(ValueError):
+        jkcm_mcnpx_rmesh().import_from_mdata_ascii(f)
+
+
+def test_mdata_truncated_vals(tmp_path):
+    f = str(tmp_path / "m.mdata")
+    write_mdata(f, 3, 3, 3, per_line=1)
+    with open(f) as fh:
+        lines = fh.readlines()
+    with open(f, 'w') as fh:
+        fh.writelines(lines[:-2])
+    with pytest.raises(AssertionError):
+        jkcm_mcnpx_rmesh().import_from_mdata_ascii(f)
+
+
+def _mesh(uniform=True, order='C'):
+    rng = np.random.default_rng(1)
+    o = jkcm_mcnpx_rmesh()
+    o.xb = np.linspace(-1, 1, 9)
+    o.yb = np.linspace(-2, 2, 6) if uniform else np.array([-2., -1.7, -0.5, 0., 0.2, 1.1, 2.])
+    o.zb = np.linspace(0, 3, 5) if uniform else np.array([0., 0.1, 1.5, 2.2, 3.])
+    shape = [o.nx(), o.ny(), o.nz()]
+    o.tally_values = np.asarray(rng.random(shape), order=order)
+    o.unc_values = np.asarray(0.1*rng.random(shape), order=order)
+    return(o)
+
+
+def _reference(o, x, y, z, values="tally"):
+    """RegularGridInterpolator on the voxel centers, with the points clamped to the
+    outer centers and nan outside the bounds."""
+    T = o.tally_values if values == "tally" else o.unc_values
+    centers = [o.xc(), o.yc(), o.zc()]
+    interp = RegularGridInterpolator(centers, T)
+    q = [np.clip(v, c[0], c[-1]) for v, c in zip([x, y, z], centers)]
+    res = interp(np.column_stack(q))
+    inside = np.ones(len(x), dtype=bool)
+    for v, b in zip([x, y, z], [o.xb, o.yb, o.zb]):
+        inside &= (v >= b[0]) & (v <= b[-1])
+    res[~inside] = np.nan
+    return(res)
+
+
+@pytest.mark.parametrize("uniform", [True, False])
+@pytest.mark.parametrize("order", ['C', 'F'])
+def test_interp_points(uniform, order):
+    o = _mesh(uniform, order)
+    rng = np.random.default_rng(2)
+    x = rng.uniform(-1.2, 1.2, 500)
+    y = rng.uniform(-2.2, 2.2, 500)
+    z = rng.uniform(-0.2, 3.2, 500)
+    np.testing.assert_allclose(o.interp_points(x, y, z), _reference(o, x, y, z), rtol=1e-12)
+    np.testing.assert_allclose(o.interp_points(x, y, z, values="unc"), _reference(o, x, y, z, "unc"), rtol=1e-12)
+    #exact at the voxel centers
+    X, Y, Z = np.meshgrid(o.xc(), o.yc(), o.zc(), indexing='ij')
+    np.testing.assert_allclose(o.interp_points(X, Y, Z), o.tally_values, rtol=1e-12)
+
+
+@pytest.mark.parametrize("axis", [0, 1, 2])
+def test_interp_axis_plane(axis):
+    o = _mesh(uniform=False)
+    bounds = [o.xb, o.yb, o.zb]
+    other = [a for a in [0, 1, 2] if a != axis]
+    uVec = np.linspace(bounds[other[0]][0] - 0.1, bounds[other[0]][-1] + 0.1, 23)
+    vVec = np.linspace(bounds[other[1]][0] - 0.1, bounds[other[1]][-1] + 0.1, 17)
+    for position in [bounds[axis][0] + 0.01, 0.37, bounds[axis][-1] + 0.5]:
+        plane = o.interp_axis_plane(axis, position, uVec, vVec)
+        assert plane.shape == (len(vVec), len(uVec))
+        q = [None, None, None]
+        vv, uu = np.meshgrid(vVec, uVec, indexing='ij')
+        q[axis] = np.full(uu.size, position)
+        q[other[0]] = uu.ravel()
+        q[other[1]] = vv.ravel()
+        np.testing.assert_allclose(plane.ravel(), _reference(o, *q), rtol=1e-12)
+
+
+def test_interp_plane():
+    o = _mesh(uniform=False)
+    uVec = np.linspace(-1.5, 1.5, 31)
+    vVec = np.linspace(-2.5, 2.5, 41)
+    origin = np.array([0.1, -0.2, 1.4])
+    uDir = np.array([1., 1., 0.5])
+    vDir = np.array([-1., 1., 0.])
+    plane = o.interp_plane(origin, uDir, vDir, uVec, vVec)
+    uu, vv = np.meshgrid(uVec, vVec)
+    pts = origin + uu.ravel()[:,None]*uDir/np.linalg.norm(uDir) + vv.ravel()[:,None]*vDir/np.linalg.norm(vDir)
+    np.testing.assert_allclose(plane.ravel(), _reference(o, pts[:,0], pts[:,1], pts[:,2]), rtol=1e-12)
+    assert np.any(np.isnan(plane)) and np.any(np.isfinite(plane))
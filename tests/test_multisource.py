@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from conftest import scalar_dose
+
+
+def _points(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return(rng.uniform([-1.2, -1.2, -0.1], [1.2, 1.2, 2.3], size=(n, 3)))
+
+
+def test_calc_at_points_matches_scalar_path(coms16):
+    pts = _points(40)
+    expected = scalar_dose(coms16, pts)
+    np.testing.assert_allclose(coms16.calc_at_points(pts), expected, rtol=1e-10)
+    np.testing.assert_allclose(coms16.calc_at_points(pts, sum_sources=True), expected.sum(axis=0), rtol=1e-10)
+    np.testing.assert_allclose(coms16.calc_at_point(pts[3]), expected[:, 3], rtol=1e-10)
+
+
+def test_dose_rate_and_chunking(coms16):
+    pts = _points(300, seed=1)
+    dose = coms16.calc_at_points(pts, sum_sources=True)
+    np.testing.assert_allclose(coms16.calc_at_points(pts, sum_sources=True, dose_rate=True), dose/100., rtol=1e-12)
+    np.testing.assert_array_equal(coms16.calc_at_points(pts, sum_sources=True, chunk_size=37), dose)
+
+
+def test_grid_axes_from_bounds_include_both_ends(coms16):
+    xa, ya, za = coms16.gridAxes(bounds=[[-1, 1], [0, 0.5], [-0.1, 0.2]], spacing=[0.5, 0.1, 0.1])
+    np.testing.assert_allclose(xa, [-1, -0.5, 0, 0.5, 1])
+    assert len(ya) == 6 and np.isclose(ya[-1], 0.5)
+    assert len(za) == 4 and np.isclose(za[-1], 0.2)
+
+
+def test_calc_dose_grid_matches_points_and_chunks(coms16):
+    bounds = [[-1.2, 1.2], [-1.2, 1.2], [-0.05, 2.3]]
+    grid = coms16.calc_dose_grid(bounds=bounds, spacing=0.3, chunk_size=97)
+    pts = coms16.gridPoints(bounds=bounds, spacing=0.3)
+    assert grid.shape == tuple(len(a) for a in coms16.gridAxes(bounds=bounds, spacing=0.3))
+    np.testing.assert_array_equal(grid.ravel(), coms16.calc_at_points(pts, sum_sources=True))
+    stops = 0
+    for si, fi, dose in coms16.iter_dose_grid_chunks(bounds=bounds, spacing=0.3, chunk_size=97, dose_rate=True):
+        assert si == stops and fi - si <= 97
+        np.testing.assert_allclose(dose, grid.ravel()[si:fi]/100.)
+        stops = fi
+    assert stops == grid.size
+
+
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_parallel_grid_and_points_match_serial(coms16, executor):
+    bounds = [[-1.2, 1.2], [-1.2, 1.2], [-0.05, 2.3]]
+    serial = coms16.calc_dose_grid(bounds=bounds, spacing=0.2)
+    parallel = coms16.calc_dose_grid(bounds=bounds, spacing=0.2, chunk_size=500, workers=2, executor=executor)
+    np.testing.assert_array_equal(parallel, serial)
+    pts = _points(1000, seed=3)
+    np.testing.assert_array_equal(coms16.calc_at_points(pts, workers=2, executor=executor), coms16.calc_at_points(pts))
+
+
+def test_parallel_grid_respects_chunk_size(coms16):
+    calc_obj = coms16.jkcm_TG43_calc_obj
+    calc = calc_obj.calc_to_points_from_sources
+    sizes = []
+    def spy(centers, tips, arr):
+        sizes.append(len(arr))
+        return(calc(centers, tips, arr))
+    calc_obj.calc_to_points_from_sources = spy
+    coms16.calc_dose_grid(bounds=[[-1, 1], [-1, 1], [0, 1]], spacing=0.1, chunk_size=64, workers=2, executor="thread")
+    assert max(sizes) <= 64 and sum(sizes) == 21*21*11
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from jkcm_TG43_calc import jkcm_TG43_calc, read_keyed_text
+
+
+def _write(tmp_path, name, text):
+    p = tmp_path / name
+    p.write_text(text)
+    return(str(p))
+
+
+def test_fields_rows_comments_and_duplicates(tmp_path):
+    f = _write(tmp_path, "t.txt", "# header comment\n"
+                                  "radius_cm g_r   # column names\n"
+                                  "0.5 1.0\n\n"
+                                  "0.5 1.0\n"
+                                  "seed_model_name: IAI-125A\n"
+                                  "table: 1 2\n"
+                                  "3 4 # trailing\n"
+                                  "3 4\n")
+    rows, fields = read_keyed_text(f)
+    assert rows == [["radius_cm", "g_r"], ["0.5", "1.0"], ["0.5", "1.0"]]
+    assert fields["seed_model_name"] == ["IAI-125A"]
+    assert fields["table"] == ["1", "2", "3", "4", "3", "4"]
+
+
+def test_aniso_table_with_identical_rows(tmp_path):
+    f = _write(tmp_path, "a_frtheta.txt", "radius_cm:\n0.5 1.0 2.0\n"
+                                          "theta_deg:\n0\n45\n90\n"
+                                          "table:\n0.9 0.9 0.9\n0.9 0.9 0.9\n1 1 1\n")
+    o = jkcm_TG43_calc()
+    o.import_aniso_table(f)
+    np.testing.assert_array_equal(o.aniso_table_radii_cm, [0.5, 1, 2])
+    #the 0 to 90 degree table is reflected to 180 degrees
+    assert o.aniso_table.shape == (5, 3)
+    np.testing.assert_allclose(o.eval_frtheta(np.array([1., 1., 1.]), np.array([0., 90., 180.])), [0.9, 1., 0.9])
+
+
+def test_repository_models_parse(tg43):
+    assert tg43.aniso_table.shape == (len(tg43.aniso_table_thetas_degree), len(tg43.aniso_table_radii_cm))
+    assert len(tg43.g_r_table) == len(tg43.g_r_radii_cm)
+    assert tg43.radionuclide == "I-125"
+    assert tg43.eff_source_length_cm == 0.3
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import numpy as np
+import pytest
+from conftest import MODEL_DIR, load_tg43
+from jkcm_source_model_cache import load_model, model_files, cache_filename
+
+
+@pytest.fixture
+def model_dir(tmp_path):
+    d = tmp_path / "I125A_test"
+    d.mkdir()
+    for f in model_files(MODEL_DIR):
+        shutil.copy(f, str(d))
+    return(str(d))
+
+
+def _dose(o, pts):
+    o.setSourceCenterAndTipPos(0, 0, 0, 0, 0, 0.2)
+    return(o.calc_to_points(pts))
+
+
+PTS = np.random.default_rng(0).uniform(-3, 3, size=(200, 3))
+
+
+def test_cached_model_matches_text_tables(model_dir, capsys):
+    first = load_model(model_dir)
+    assert "building source model cache" in capsys.readouterr().out
+    assert os.path.isfile(cache_filename(model_dir))
+    second = load_model(model_dir)
+    assert "building source model cache" not in capsys.readouterr().out
+    reference = load_tg43(model_dir)
+    for o in (first, second):
+        np.testing.assert_array_equal(o.aniso_table, reference.aniso_table)
+        np.testing.assert_array_equal(o.g_r_table, reference.g_r_table)
+        assert o.radionuclide == reference.radionuclide
+        np.testing.assert_array_equal(_dose(o, PTS), _dose(reference, PTS))
+
+
+def test_cache_is_rebuilt_when_a_table_changes(model_dir, capsys):
+    base = _dose(load_model(model_dir), PTS)
+    #a new modification time with the same content keeps the cache
+    gr = model_files(model_dir)[1]
+    st = os.stat(gr)
+    os.utime(gr, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    capsys.readouterr()
+    np.testing.assert_array_equal(_dose(load_model(model_dir), PTS), base)
+    assert "building source model cache" not in capsys.readouterr().out
+    #new content rebuilds it
+    data = load_tg43(model_dir)
+    with open(gr, 'w') as f:
+        f.write("radius_cm g_r\n")
+        for r, g in zip(data.g_r_radii_cm, data.g_r_table):
+            f.write("{0} {1}\n".format(r, 2*g))
+    rebuilt = load_model(model_dir)
+    assert "building source model cache" in capsys.readouterr().out
+    np.testing.assert_allclose(_dose(rebuilt, PTS), 2*base, rtol=1e-12)
+
+
+def test_kernel_is_cached_per_g_r_kind(model_dir):
+    kernel = {"dr_cm": 0.05, "dtheta_deg": 1.}
+    loglinear = load_model(model_dir, g_r_kind="loglinear", kernel=kernel)
+    linear = load_model(model_dir, g_r_kind="linear", kernel=kernel)
+    fresh = load_tg43(model_dir, g_r_kind="linear")
+    fresh.build_dose_rate_kernel(**kernel)
+    np.testing.assert_array_equal(linear.dose_rate_kernel, fresh.dose_rate_kernel)
+    assert not np.array_equal(linear.dose_rate_kernel, loglinear.dose_rate_kernel)
+    #both are now in the cache
+    again = load_model(model_dir, g_r_kind="loglinear", kernel=kernel)
+    np.testing.assert_array_equal(again.dose_rate_kernel, loglinear.dose_rate_kernel)
+    assert again.use_dose_rate_kernel
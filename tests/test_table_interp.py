@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+from jkcm_TG43_calc import jkcm_frtheta_interp, jkcm_gr_interp
+
+
+def test_frtheta_interp_matches_bilinear_with_nearest_extrapolation(tg43):
+    radii, thetas, table = tg43.aniso_table_radii_cm, tg43.aniso_table_thetas_degree, tg43.aniso_table
+    f = jkcm_frtheta_interp(radii, thetas, table)
+    ref = RegularGridInterpolator((thetas, radii), table)
+    rng = np.random.default_rng(0)
+    r = rng.uniform(0, 1.5*radii[-1], 5000)
+    theta = rng.uniform(0, 180, 5000)
+    expected = ref(np.column_stack([np.clip(theta, thetas[0], thetas[-1]), np.clip(r, radii[0], radii[-1])]))
+    np.testing.assert_allclose(f(r, theta), expected, rtol=1e-12, atol=1e-14)
+    #table nodes and a scalar
+    np.testing.assert_allclose(f(radii[2], thetas[3]), table[3, 2])
+    np.testing.assert_allclose(f(np.full(len(thetas), radii[-1]), thetas), table[:, -1])
+
+
+def test_gr_interp_linear_and_loglinear(tg43):
+    radii, g = tg43.g_r_radii_cm, tg43.g_r_table
+    r = np.linspace(0, 2*radii[-1], 1000)
+    np.testing.assert_allclose(jkcm_gr_interp(radii, g)(r), np.interp(r, radii, g))
+    np.testing.assert_allclose(jkcm_gr_interp(radii, g, kind="loglinear")(r), np.exp(np.interp(r, radii, np.log(g))))
+    #nearest neighbor extrapolation on both ends
+    f = jkcm_gr_interp(radii, g)
+    assert f(0.) == g[0] and f(10*radii[-1]) == g[-1]
+
+
+def test_dose_grid_through_a_source_center(coms16):
+    src = coms16.sourceArrays()
+    c = src["centers"][0]
+    x = c[0] + 0.1*np.arange(-3, 4)
+    y = c[1] + 0.1*np.arange(-2, 3)
+    z = c[2] + 0.1*np.arange(-1, 6)
+    grid = coms16.calc_dose_grid(x, y, z, chunk_size=40)
+    at_center = np.zeros(grid.shape, dtype=bool)
+    at_center[3, 2, 1] = True
+    assert np.isnan(grid[at_center]).all()
+    assert np.all(np.isfinite(grid[~at_center]))
+    np.testing.assert_allclose(grid[~at_center], coms16.calc_at_points(coms16.gridPoints(x, y, z), sum_sources=True)[~at_center.ravel()])
+    m = coms16.influence_matrix(coms16.gridPoints(x, y, z))
+    assert np.isnan(m.matrix[0, np.ravel_multi_index((3, 2, 1), grid.shape)])
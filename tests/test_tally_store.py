@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+import pytest
+import Import_MCNPX_output
+import jkcm_mcnpx_rmesh
+from conftest import write_smesh, write_mdata
+from jkcm_tally_store import (save_tally_store, load_tally_store, is_store_current,
+                              MCNPX_output_to_store, mdata_to_store, META_FILENAME)
+
+_mesh = [(np.linspace(-1, 1, 5), np.linspace(-2, 2, 4), np.linspace(0, 3, 3))]
+
+
+def _touch(filename, text=None):
+    """Rewrites filename (with text if given) and moves its modification time forward."""
+    if(text is not None):
+        with open(filename, 'w') as f:
+            f.write(text)
+    st = os.stat(filename)
+    os.utime(filename, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+
+def _count_calls(monkeypatch, module, name):
+    calls = []
+    func = getattr(module, name)
+    def counted(*args, **kwargs):
+        calls.append(args)
+        return(func(*args, **kwargs))
+    monkeypatch.setattr(module, name, counted)
+    return(calls)
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_round_trip(tmp_path, mmap):
+    src = str(tmp_path / "out.txt")
+    write_smesh(src, _mesh)
+    tally = Import_MCNPX_output.Import_MCNPX_output(src)
+    path = str(tmp_path / "store")
+    save_tally_store(path, tally, [src], DOSE_FACTOR=1.0)
+    back = load_tally_store(path, mmap=mmap)
+    for k in ['tally_xyz', 'unc_xyz', 'xb', 'yb', 'zb']:
+        np.testing.assert_array_equal(back[k], tally[k])
+    assert isinstance(back['tally_xyz'], np.memmap) == mmap
+    assert back['nps'] == tally['nps']
+    assert back['dims'] == list(tally['tally_xyz'].shape)
+    assert back['meta']['provenance'] == {"DOSE_FACTOR": 1.0}
+    assert 'nps_total' not in back
+    #a combined tally also keeps the number of particles of all the files
+    combined = Import_MCNPX_output.add_in_quadrature([src, src])
+    save_tally_store(path, combined, [src])
+    back = load_tally_store(path, mmap=mmap)
+    assert (back['nps'], back['nps_total']) == (tally['nps'], 2*tally['nps'])
+
+
+def test_is_store_current(tmp_path):
+    src = str(tmp_path / "out.txt")
+    write_smesh(src, _mesh)
+    path = str(tmp_path / "store")
+    save_tally_store(path, Import_MCNPX_output.Import_MCNPX_output(src), [src])
+    assert is_store_current(path, [src])
+    assert not is_store_current(path, [src, src])
+    assert not is_store_current(str(tmp_path / "missing"), [src])
+
+    #touched without a change is still current
+    _touch(src)
+    assert is_store_current(path, [src])
+    #same size, different contents
+    with open(src) as f:
+        text = f.read()
+    _touch(src, text.replace("comment line", "comment lime"))
+    assert not is_store_current(path, [src])
+    #different size
+    _touch(src, text + "\n")
+    assert not is_store_current(path, [src])
+
+
+def test_interrupted_write_is_not_current(tmp_path):
+    src = str(tmp_path / "out.txt")
+    write_smesh(src, _mesh)
+    path = str(tmp_path / "store")
+    save_tally_store(path, Import_MCNPX_output.Import_MCNPX_output(src), [src])
+    os.remove(os.path.join(path, META_FILENAME))
+    assert not is_store_current(path, [src])
+
+
+def test_MCNPX_output_to_store(tmp_path, monkeypatch):
+    src = str(tmp_path / "out.txt")
+    expected = write_smesh(src, _mesh)
+    calls = _count_calls(monkeypatch, Import_MCNPX_output, "Import_MCNPX_output")
+    o = MCNPX_output_to_store(src, DOSE_FACTOR=2.)
+    np.testing.assert_allclose(o['tally_xyz'], 2*expected[0][0], rtol=1e-10)
+    assert len(calls) == 1
+    MCNPX_output_to_store(src, DOSE_FACTOR=2.)
+    assert len(calls) == 1
+    #other import arguments or a changed file convert again
+    o = MCNPX_output_to_store(src, DOSE_FACTOR=3.)
+    np.testing.assert_allclose(o['tally_xyz'], 3*expected[0][0], rtol=1e-10)
+    assert len(calls) == 2
+    expected = write_smesh(src, _mesh, seed=5)
+    _touch(src)
+    o = MCNPX_output_to_store(src, DOSE_FACTOR=3.)
+    np.testing.assert_allclose(o['tally_xyz'], 3*expected[0][0], rtol=1e-10)
+    assert len(calls) == 3
+    assert o["meta"]["provenance"]["DOSE_FACTOR"] == 3.
+
+
+def test_mdata_to_store(tmp_path, monkeypatch):
+    src = str(tmp_path / "m.mdata")
+    xb, yb, zb, tally, unc = write_mdata(src, 4, 3, 5)
+    calls = _count_calls(monkeypatch, jkcm_mcnpx_rmesh.jkcm_mcnpx_rmesh, "import_from_mdata_ascii")
+    for i in np.arange(2):
+        o = mdata_to_store(src)
+        np.testing.assert_allclose(o.tally_values, tally, rtol=1e-10)
+        np.testing.assert_allclose(o.unc_values, unc, rtol=1e-10)
+        np.testing.assert_allclose(o.zb, zb, rtol=1e-10)
+        assert o.nps == 123456789
+    assert len(calls) == 1
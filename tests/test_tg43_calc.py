@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from conftest import load_tg43
+
+
+def _random_points(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return(rng.uniform(-3, 3, size=(n, 3)))
+
+
+def test_calc_to_points_matches_scalar_path(tg43):
+    tg43.setSourceCenterAndTipPos(0.1, -0.2, 0.3, 0.1+0.15, -0.2, 0.3+0.15)
+    pts = np.vstack([_random_points(200), [[0.6, -0.2, 0.3], [0.1, -0.2, 2.3]]])
+    expected = np.array([tg43._calc_to_point(p) for p in pts])
+    np.testing.assert_allclose(tg43.calc_to_points(pts), expected, rtol=1e-10)
+
+
+def test_calc_to_points_from_sources_matches_per_source(tg43):
+    centers = np.array([[0, 0, 0], [0.5, 0.2, -0.1], [-1, 1, 0.5]], dtype=np.double)
+    tips = centers + np.array([[0, 0, 0.2], [0.2, 0, 0], [0.1, 0.1, 0.1]])
+    pts = _random_points(100, seed=1)
+    result = tg43.calc_to_points_from_sources(centers, tips, pts)
+    assert result.shape == (3, 100)
+    for s in np.arange(3):
+        tg43.setSourceCenterAndTipPos(*centers[s], *tips[s])
+        np.testing.assert_allclose(result[s], tg43.calc_to_points(pts), rtol=1e-10)
+
+
+def test_point_at_source_center_is_nan_not_an_error(tg43):
+    centers = np.array([[0, 0, 0], [1, 0, 0]], dtype=np.double)
+    tips = centers + [0, 0, 0.2]
+    pts = np.array([[0, 0, 0], [0, 0, 1], [1, 0, 0.]])
+    result = tg43.calc_to_points_from_sources(centers, tips, pts)
+    assert np.isnan(result[0, 0]) and np.isnan(result[1, 2])
+    assert np.all(np.isfinite(result[[0, 0, 1, 1], [1, 2, 0, 1]]))
+    tg43.setSourceCenterAndTipPos(0, 0, 0, 0, 0, 0.2)
+    np.testing.assert_allclose(result[0, 1:], [tg43._calc_to_point(p) for p in pts[1:]], rtol=1e-10)
+    assert np.isnan(tg43.eval_frtheta(np.nan, 90.))
+
+
+def test_dose_rate_kernel_matches_exact_path(tg43):
+    max_dev = tg43.build_dose_rate_kernel(dr_cm=0.01, dtheta_deg=0.25)
+    assert max_dev < 1e-3
+    tg43.setSourceCenterAndTipPos(0, 0, 0, 0.1, 0.1, 0.1)
+    pts = _random_points(20000, seed=2)
+    exact = tg43.calc_to_points(pts)
+    tg43.use_dose_rate_kernel = True
+    approx = tg43.calc_to_points(pts)
+    assert approx.dtype == np.double
+    np.testing.assert_allclose(approx, exact, rtol=2*max_dev)
+    #inside r_min and beyond r_max the exact path is used
+    r = np.sqrt(np.sum(pts**2, axis=1))
+    outside = (r < tg43.dose_rate_kernel_r0_cm) | (r > tg43.dose_rate_kernel_r0_cm + tg43.dose_rate_kernel_dr_cm*(tg43.dose_rate_kernel.shape[0]-1))
+    assert np.any(outside)
+    np.testing.assert_array_equal(approx[outside], exact[outside])
+
+
+def test_dose_rate_kernel_lattice_values(tg43):
+    tg43.build_dose_rate_kernel(dr_cm=0.05, dtheta_deg=1.)
+    r = tg43.dose_rate_kernel_r0_cm + 0.05*np.arange(5)
+    theta = np.array([0., 1., 45., 90., 180.])
+    rr, tt = np.meshgrid(r, theta, indexing='ij')
+    np.testing.assert_allclose(tg43.eval_dose_rate_kernel(rr, tt), tg43._calc_rate_exact(rr, tt), rtol=1e-6)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from Import_MCNPX_output import F_r_theta_table, g_r_table, F_r_theta, g_r, geometry_r_theta, calc_centers_from_bounds
+from jkcm_tally_store import save_tally_store, load_tally_store
+
+L = 0.3
+
+
+def _F(r, theta):
+    return(1 - 0.3*np.cos(np.radians(theta))**2*np.exp(-0.2*r))
+
+
+def _g(r):
+    return(np.exp(-0.1*(r - 1)))
+
+
+@pytest.fixture
+def tally():
+    """A spherical (r, theta) mesh whose dose is G(r,theta)*g(r)*F(r,theta), with bin
+    centers at 0.1 to 5 cm and 0 to 180 degrees, including 1 cm and 90 degrees."""
+    xb = np.arange(0.05, 5.1, 0.1)
+    yb = np.arange(-1., 182., 2.)
+    zb = np.array([0., 360.])
+    rc = calc_centers_from_bounds(xb)
+    tc = calc_centers_from_bounds(yb)
+    D = 7.*geometry_r_theta(rc[:,None], tc[None,:], L=L)*_g(rc)[:,None]*_F(rc[:,None], tc[None,:])
+    rng = np.random.default_rng(0)
+    unc = 0.01 + 0.01*rng.random(D.shape)
+    return({'tally_xyz':D[:,:,None], 'unc_xyz':unc[:,:,None], 'xb':xb, 'yb':yb, 'zb':zb, 'nps':1e6})
+
+
+def test_F_r_theta_table(tally):
+    rlist = [0.5, 1., 2.5, 5.]
+    thetalist = [0., 10., 44., 90., 150., 180.]
+    res = F_r_theta_table(tally, rlist, thetalist, L=L)
+    np.testing.assert_allclose(res['r'], rlist)
+    np.testing.assert_allclose(res['theta'], thetalist)
+    np.testing.assert_allclose(res['F'], _F(res['r'][:,None], res['theta'][None,:]), rtol=1e-12)
+    #fractional uncertainty of D(r,theta)/D(r,90)
+    u = tally['unc_xyz'][:,:,0]
+    ri = np.round((res['r'] - 0.1)/0.1).astype(int)
+    ti = np.round(res['theta']/2.).astype(int)
+    expected = np.sqrt(u[ri[:,None], ti[None,:]]**2 + u[ri, 45][:,None]**2)
+    expected[:, 3] = 0.
+    np.testing.assert_allclose(res['unc'], expected, rtol=1e-12)
+    #the single value functions agree with the table
+    assert F_r_theta(tally, 2.5, 44., L=L) == pytest.approx(res['F'][2, 2], rel=1e-12)
+
+
+def test_g_r_table(tally):
+    rlist = [0.3, 0.7, 1., 3.2, 5.]
+    res = g_r_table(tally, rlist, L=L, drlist=np.full(5, 0.01))
+    np.testing.assert_allclose(res['g'], _g(res['r']), rtol=1e-12)
+    u = tally['unc_xyz'][:,45,0]
+    ri = np.round((res['r'] - 0.1)/0.1).astype(int)
+    expected = np.sqrt(u[ri]**2 + u[9]**2)
+    expected[2] = 0.
+    np.testing.assert_allclose(res['unc'], expected, rtol=1e-12)
+    assert g_r(tally, 3.2, L=L, dr=0.01) == pytest.approx(res['g'][3], rel=1e-12)
+
+
+def test_tables_from_store(tally, tmp_path):
+    path = str(tmp_path / "store")
+    save_tally_store(path, tally)
+    stored = load_tally_store(path, mmap=True)
+    a = F_r_theta_table(tally, [1., 2.], [0., 90.], L=L)
+    b = F_r_theta_table(stored, [1., 2.], [0., 90.], L=L)
+    np.testing.assert_array_equal(a['F'], b['F'])
+    np.testing.assert_array_equal(g_r_table(tally, [0.5, 4.], L=L)['g'], g_r_table(stored, [0.5, 4.], L=L)['g'])
+
+
+def test_bin_matching_errors(tally):
+    with pytest.raises(AssertionError, match="did not find"):
+        F_r_theta_table(tally, [1.05], [90.], L=L)
+    with pytest.raises(AssertionError, match="more than 1"):
+        F_r_theta_table(tally, [1.], [90.], dthetalist=3., L=L)